@@ -1,13 +1,35 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response, g, has_request_context, send_file, send_from_directory, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.formparser import FormDataParser
+from werkzeug.exceptions import RequestEntityTooLarge
 import sqlite3
 import os
 import time
 import random
+import secrets
+import math
+import heapq
+import hashlib
+import re
+import sys
+import csv
+import json
+import atexit
+import pathlib
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import wraps
-from datetime import datetime
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from datetime import datetime, timedelta, timezone
 import io
+import click
 from dotenv import load_dotenv
 # SendGrid for email sending
 try:
@@ -16,6 +38,15 @@ try:
     SENDGRID_AVAILABLE = True
 except ImportError:
     SENDGRID_AVAILABLE = False
+# Optional psycopg2 import for the PostgreSQL backend
+try:
+    import psycopg2
+    import psycopg2.extras
+    import psycopg2.extensions
+    import psycopg2.pool
+    POSTGRES_AVAILABLE = True
+except ImportError:
+    POSTGRES_AVAILABLE = False
 # Optional ReportLab import for PDF generation
 try:
     from reportlab.lib.pagesizes import letter
@@ -26,6 +57,12 @@ try:
     REPORTLAB_AVAILABLE = True
 except ImportError:
     REPORTLAB_AVAILABLE = False
+# Optional Pillow import for resized product images
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
 
 # Load environment variables from .env file
 load_dotenv()
@@ -51,6 +88,108 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Resized product images (see /images/<size>/<filename>), cached on disk up to IMAGE_CACHE_MAX_MB
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', 'image_cache')
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_MB', '512')) * 1024 * 1024
+IMAGE_MAX_AGE = int(os.getenv('IMAGE_MAX_AGE', str(30 * 24 * 3600)))  # browser/CDN cache lifetime, seconds
+IMAGE_SIZES = {
+    # name: (width, height, mode) - crop fills the box, fit keeps the whole image inside it
+    'thumb': (160, 160, 'crop'),
+    'card': (480, 480, 'crop'),
+    'detail': (1200, 1200, 'fit'),
+}
+
+# Uploaded images are stored once per distinct content; one that no product or variant uses
+# any more is deleted after IMAGE_GC_GRACE seconds (see sweep_images)
+IMAGE_GC_GRACE = int(os.getenv('IMAGE_GC_GRACE', str(24 * 3600)))
+IMAGE_GC_BATCH = 100
+IMAGE_UPLOAD_CHUNK = 64 * 1024
+
+# Bulk image uploads: bytes per multi-file request, the largest original a chunked upload
+# accepts and its chunk size (below MAX_CONTENT_LENGTH), how long an unfinished chunked upload
+# is kept, and the threads that pre-render resized copies of new uploads
+IMAGE_BATCH_MAX_BYTES = int(os.getenv('IMAGE_BATCH_MAX_MB', '64')) * 1024 * 1024
+IMAGE_UPLOAD_MAX_BYTES = int(os.getenv('IMAGE_UPLOAD_MAX_MB', '100')) * 1024 * 1024
+IMAGE_CHUNK_SIZE = 4 * 1024 * 1024
+IMAGE_UPLOAD_TTL = 24 * 3600
+IMAGE_PARTIAL_DIR = os.getenv('IMAGE_PARTIAL_DIR', 'upload_parts')
+IMAGE_PROCESSING_WORKERS = int(os.getenv('IMAGE_PROCESSING_WORKERS', '2'))
+
+# Per-process cache of product variant payloads, invalidated through the shared catalog_version row
+VARIANT_CACHE_SIZE = int(os.getenv('VARIANT_CACHE_SIZE', '1024'))
+VARIANT_BATCH_MAX_OPERATIONS = 500
+VARIANT_EDITABLE_FIELDS = ['variant_name', 'variant_type', 'price', 'stock', 'sku', 'display_order']
+
+# product_listing column order (see init_db); listing templates index rows by these positions
+PRODUCT_LISTING_COLUMNS = ('product_id, name, category, subcategory, price, description, images, stock, sizes, '
+                           'colors, gender, has_variants, primary_image, image_count, min_price, max_price, '
+                           'total_stock, in_stock, variant_count')
+
+# Related products - neighbours kept per product and the weight of a shared wishlist vs a shared order
+RECOMMENDATIONS_PER_PRODUCT = int(os.getenv('RECOMMENDATIONS_PER_PRODUCT', '8'))
+RECOMMENDATION_WISHLIST_WEIGHT = float(os.getenv('RECOMMENDATION_WISHLIST_WEIGHT', '0.5'))
+
+# Trending products - score half-life and the weight of a wishlist add relative to one unit sold
+TRENDING_HALF_LIFE_DAYS = float(os.getenv('TRENDING_HALF_LIFE_DAYS', '7'))
+TRENDING_WISHLIST_WEIGHT = float(os.getenv('TRENDING_WISHLIST_WEIGHT', '0.3'))
+TRENDING_EPOCH = 1767225600  # 2026-01-01 UTC, reference point for forward decay
+
+# Idempotency keys are remembered this many seconds
+IDEMPOTENCY_KEY_TTL = 24 * 3600
+
+# Product ids accepted by one /wishlist_status request
+WISHLIST_STATUS_MAX_IDS = 200
+
+# Status moves admins may make, one order at a time or in bulk; an order never leaves
+# a status in ORDER_FINAL_STATUSES. Orders enter and leave ORDER_RETURN_STATUSES only
+# through the returns module (see RETURN_ACTIONS), which keeps the returns row, stock and
+# payment status in step.
+ORDER_STATUS_TRANSITIONS = {
+    'processing': ('confirmed', 'shipped', 'cancelled'),
+    'confirmed': ('shipped', 'cancelled'),
+    'shipped': ('out_for_delivery', 'delivered'),
+    'out_for_delivery': ('delivered',),
+}
+ORDER_FINAL_STATUSES = ('cancelled', 'refunded')
+ORDER_RETURN_STATUSES = ('return_requested', 'returned', 'refunded')
+ORDER_STATUSES = ('processing', 'confirmed', 'shipped', 'out_for_delivery', 'delivered', 'cancelled',
+                  'return_requested', 'returned', 'refunded')
+BULK_ORDER_STATUS_MAX = 5000  # orders one bulk status update may touch
+
+# Admin returns queue page size, and returns handled per transaction by the bulk actions
+RETURNS_PAGE_SIZE = 25
+RETURNS_BATCH_SIZE = 100
+
+# Guest carts live in the signed session cookie; lines beyond this are refused
+GUEST_CART_MAX_LINES = int(os.getenv('GUEST_CART_MAX_LINES', '50'))
+
+# Token-bucket rate limits on login, registration, password reset and payment (see @rate_limit)
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_LOCAL_SIZE = 10000  # buckets each worker mirrors in memory
+
+# Sessions are kept in the sessions table and the cookie only carries their id;
+# set SESSION_STORE=cookie to go back to Flask's signed cookie sessions
+SESSION_STORE = os.getenv('SESSION_STORE', 'database')
+
+# Password hashing runs in a per-worker process pool. Changing PASSWORD_HASH_METHOD
+# (any werkzeug method, e.g. scrypt:32768:8:1) rehashes each password at its next login.
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv('PASSWORD_HASH_QUEUE_LIMIT', '16'))  # queued + running; more get a 503
+
+# Bulk catalog import/export
+IMPORT_BATCH_SIZE = 500  # products written per transaction
+IMPORT_MAX_ERRORS = 1000  # row errors kept in the import report
+CATALOG_PRODUCT_COLUMNS = ['handle', 'product_id', 'name', 'category', 'subcategory', 'gender', 'price',
+                           'description', 'images', 'stock', 'sizes', 'colors']
+CATALOG_VARIANT_COLUMNS = ['variant_name', 'variant_type', 'variant_price', 'variant_stock', 'variant_sku',
+                           'variant_images']
+
+# Order export - rows fetched and written per chunk
+EXPORT_CHUNK_SIZE = 1000
+ORDER_EXPORT_COLUMNS = ['order_id', 'order_date', 'customer_name', 'customer_email', 'total_amount',
+                        'payment_method', 'payment_status', 'order_status', 'shipping_address', 'phone_number']
+
 # Mock Payment System - No external service needed!
 MOCK_PAYMENT_ENABLED = True
 
@@ -59,6 +198,81 @@ MOCK_PAYMENT_ENABLED = True
 OTP_STORAGE = {}  # Format: {email: {'otp': '123456', 'timestamp': time.time(), 'verified': False, 'type': 'register'}}
 OTP_EXPIRY = 300  # 5 minutes
 
+# Database configuration
+# DATABASE_URL selects the backend: unset uses the SQLite file at DATABASE_PATH,
+# postgresql://... uses PostgreSQL so several app nodes can share one database
+DATABASE = os.getenv('DATABASE_PATH', 'database.db')
+DATABASE_URL = os.getenv('DATABASE_URL', '')
+DB_BACKEND = 'postgres' if DATABASE_URL.startswith(('postgres://', 'postgresql://')) else 'sqlite'
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '10'))  # seconds a writer waits for the lock
+
+# PostgreSQL connection pools (one per worker process) and optional hot standby
+REPLICA_DATABASE_URL = os.getenv('REPLICA_DATABASE_URL', '')
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+POSTGRES_POOLS = {}  # Format: {(pid, 'primary' or 'replica'): ThreadedConnectionPool}
+POSTGRES_POOL_LOCK = threading.Lock()
+
+if DB_BACKEND == 'postgres' and not POSTGRES_AVAILABLE:
+    raise RuntimeError("DATABASE_URL points to PostgreSQL but psycopg2 is not installed. "
+                       "Run: pip install psycopg2-binary")
+
+# Read replica for analytics - a snapshot of the primary copied with the SQLite
+# backup API at most every REPLICA_REFRESH_SECONDS. Empty disables the replica
+# and analytics read the primary through a read-only connection instead.
+REPLICA_DATABASE = os.getenv('REPLICA_DATABASE_PATH', 'database_replica.db')
+REPLICA_REFRESH_SECONDS = float(os.getenv('REPLICA_REFRESH_SECONDS', '300'))
+REPLICA_LOCK = threading.Lock()
+
+# SQL instrumentation - per-request query log and slow-query threshold
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '100'))
+SQL_STATS = {}  # Format: {endpoint: {'requests': 0, 'queries': 0, 'db_ms': 0.0, 'max_queries': 0, 'statements': {sql: {...}}}}
+SQL_STATS_MAX_STATEMENTS = 200  # Distinct statements tracked per endpoint
+SLOW_QUERY_LOG = deque(maxlen=100)
+SQL_STATS_LOCK = threading.Lock()
+
+# Metrics - each worker process keeps its own registry and periodically writes a
+# snapshot to METRICS_DIR; /metrics sums the snapshots of all workers.
+# Clear METRICS_DIR when (re)deploying so counters from old processes are dropped.
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'textile_store_metrics'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))  # seconds
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # Bearer token for scrapers (optional)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_DEFINITIONS = {
+    'http_requests_total': ('counter', 'HTTP requests by endpoint, method and status code'),
+    'http_request_duration_seconds': ('histogram', 'HTTP request latency by endpoint'),
+    'db_queries_total': ('counter', 'SQL statements executed by endpoint'),
+    'db_query_seconds_total': ('counter', 'Time spent in SQL statements by endpoint'),
+    'orders_placed_total': ('counter', 'Orders placed by payment method'),
+    'order_revenue_total': ('counter', 'Order value placed by payment method'),
+    'otp_emails_sent_total': ('counter', 'OTP emails accepted by SendGrid'),
+    'otp_email_failures_total': ('counter', 'OTP emails that could not be sent, by reason'),
+    'invoice_renders_total': ('counter', 'PDF invoices rendered'),
+    'cache_requests_total': ('counter', 'Cache lookups by cache name and result'),
+    'rate_limited_total': ('counter', 'Requests rejected by a rate limit, by endpoint, key and where it was decided'),
+    'password_hash_rejected_total': ('counter', 'Requests turned away because the password hashing queue was full'),
+    'password_rehashes_total': ('counter', 'Stored password hashes upgraded to PASSWORD_HASH_METHOD at login'),
+    'image_cache_evictions_total': ('counter', 'Resized images removed from IMAGE_CACHE_DIR to stay under IMAGE_CACHE_MAX_MB'),
+    'image_uploads_total': ('counter', 'Image uploads, by whether the content was new or already stored'),
+}
+METRICS = {'counters': {}, 'histograms': {}}  # Format: {(name, ((label, value), ...)): value}
+METRICS_LOCK = threading.Lock()
+METRICS_LAST_FLUSH = [0.0]
+
+# Sampling profiler - off unless PROFILING_SAMPLE_RATE > 0, an admin enables it
+# from /admin/profiles, or an admin sends the X-Profile-Request header
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILING_INTERVAL = float(os.getenv('PROFILING_INTERVAL_MS', '5')) / 1000
+PROFILING_STATE = {
+    'sample_rate': float(os.getenv('PROFILING_SAMPLE_RATE', '0')),
+    'checked': 0.0,
+    'sampler': None
+}
+PROFILE_SETTINGS_CHECK_INTERVAL = 5  # seconds between re-reading the admin toggle
+ACTIVE_PROFILES = {}  # Format: {thread_id: {'endpoint': 'products', 'stacks': {folded_stack: samples}}}
+PROFILES_LOCK = threading.Lock()
+PROFILES_WAKEUP = threading.Event()
+
 # Ensure upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
@@ -114,11 +328,13 @@ def send_otp_email(recipient_email, otp, purpose='registration'):
     """Send OTP via SendGrid - SECURE email verification"""
     # Check if SendGrid is available and configured
     if not SENDGRID_AVAILABLE:
+        inc_counter('otp_email_failures_total', {'purpose': purpose, 'reason': 'sendgrid_missing'})
         print("WARNING: SendGrid library not installed! Run: pip install sendgrid")
         print(f"OTP for {recipient_email}: {otp}")
         return True, f"[DEMO MODE - SendGrid not installed] Your OTP is: {otp}"
     
     if not SENDGRID_API_KEY:
+        inc_counter('otp_email_failures_total', {'purpose': purpose, 'reason': 'not_configured'})
         print("WARNING: SENDGRID_API_KEY not configured in .env file!")
         print(f"OTP for {recipient_email}: {otp}")
         return True, f"[DEMO MODE - Email not configured] Your OTP is: {otp}"
@@ -178,6 +394,7 @@ Textile Store Team
         response = sg.send(message)
         
         print(f"SUCCESS: OTP email sent via SendGrid to {recipient_email} (Status: {response.status_code})")
+        inc_counter('otp_emails_sent_total', {'purpose': purpose})
         return True, "OTP sent to your email! Please check your inbox (and spam folder)."
         
     except Exception as e:
@@ -187,17 +404,680 @@ Textile Store Team
         
         # Provide helpful error messages
         if "401" in error_msg or "Unauthorized" in error_msg:
+            inc_counter('otp_email_failures_total', {'purpose': purpose, 'reason': 'unauthorized'})
             return True, f"[Email config error - Wrong API Key] Your OTP is: {otp}"
         elif "403" in error_msg or "Forbidden" in error_msg:
+            inc_counter('otp_email_failures_total', {'purpose': purpose, 'reason': 'forbidden'})
             return True, f"[Email config error - Verify sender email] Your OTP is: {otp}"
         else:
+            inc_counter('otp_email_failures_total', {'purpose': purpose, 'reason': 'send_error'})
             return True, f"[Email failed - Demo Mode] Your OTP is: {otp}"
 
+# SQL Instrumentation
+def normalize_sql(sql):
+    """Collapse whitespace so the same statement is always reported the same way"""
+    return ' '.join(sql.split())
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times every statement (including fetches) for the current request"""
+
+    def execute(self, sql, parameters=()):
+        self._query = start_query(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            finish_query(self._query, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._query = start_query(sql, ())
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            finish_query(self._query, time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            finish_query(getattr(self, '_query', None), time.perf_counter() - start)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            finish_query(getattr(self, '_query', None), time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            finish_query(getattr(self, '_query', None), time.perf_counter() - start)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors are all instrumented"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+def translate_sql(sql):
+    """Rewrite the SQLite dialect used throughout app.py for PostgreSQL"""
+    sql = sql.replace('%', '%%').replace('?', '%s')
+    sql = re.sub(r'\bLIKE\b', 'ILIKE', sql)  # SQLite LIKE is case-insensitive
+    if sql.lstrip().upper().startswith('CREATE TABLE'):
+        sql = sql.replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY')
+        sql = re.sub(r'\bREAL\b', 'DOUBLE PRECISION', sql)
+    return sql
+
+class PostgresCursor:
+    """psycopg2 cursor that accepts the app's SQLite-style SQL and is instrumented"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._query = None
+
+    def execute(self, sql, parameters=()):
+        self._query = start_query(sql, parameters)
+        start = time.perf_counter()
+        try:
+            self._cursor.execute(translate_sql(sql), parameters)
+            return self
+        finally:
+            finish_query(self._query, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._query = start_query(sql, ())
+        start = time.perf_counter()
+        try:
+            psycopg2.extras.execute_batch(self._cursor, translate_sql(sql), seq_of_parameters)
+            return self
+        finally:
+            finish_query(self._query, time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return self._cursor.fetchone()
+        finally:
+            finish_query(self._query, time.perf_counter() - start)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return self._cursor.fetchmany(self._cursor.arraysize if size is None else size)
+        finally:
+            finish_query(self._query, time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return self._cursor.fetchall()
+        finally:
+            finish_query(self._query, time.perf_counter() - start)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+class PostgresConnection:
+    """Pooled psycopg2 connection with the subset of the sqlite3 API app.py uses"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def cursor(self):
+        return PostgresCursor(self._conn.cursor())
+
+    def server_side_cursor(self, chunk_size):
+        """Named cursor - rows stay on the server and are fetched chunk_size at a time"""
+        cursor = self._conn.cursor(name=f'stream_{id(self)}_{time.monotonic_ns()}')
+        cursor.itersize = chunk_size
+        return PostgresCursor(cursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        if self._conn is None:
+            return
+        # Like closing a SQLite connection, anything not committed is discarded
+        try:
+            self._conn.rollback()
+            self._pool.putconn(self._conn)
+        except psycopg2.Error:
+            self._pool.putconn(self._conn, close=True)
+        self._conn = None
+
+def get_postgres_pool(role='primary'):
+    """Connection pool for this worker process (pools must not be shared across fork)"""
+    key = (os.getpid(), role)
+    pool = POSTGRES_POOLS.get(key)
+    if pool is None:
+        with POSTGRES_POOL_LOCK:
+            pool = POSTGRES_POOLS.get(key)
+            if pool is None:
+                dsn = REPLICA_DATABASE_URL if role == 'replica' else DATABASE_URL
+                pool = POSTGRES_POOLS[key] = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, dsn)
+    return pool
+
+if DB_BACKEND == 'postgres':
+    # Return dates and timestamps as text, the same shape the SQLite backend gives
+    # templates, invoices and JSON responses
+    psycopg2.extensions.register_type(psycopg2.extensions.new_type(
+        (1082, 1114, 1184), 'SQLITE_STYLE_DATETIME', lambda value, cursor: value[:19] if value else value))
+
+def insert_returning_id(cursor, sql, parameters=()):
+    """Run an INSERT and return the new row's id on either backend"""
+    if DB_BACKEND == 'postgres':
+        cursor.execute(sql.rstrip() + ' RETURNING id', parameters)
+        return cursor.fetchone()[0]
+    cursor.execute(sql, parameters)
+    return cursor.lastrowid
+
+def iter_query(conn, sql, parameters=(), chunk_size=1000):
+    """Yield result rows chunk by chunk without materializing the whole result.
+
+    PostgreSQL uses a server-side (named) cursor; SQLite steps the statement
+    lazily, so fetchmany already keeps memory bounded.
+    """
+    if DB_BACKEND == 'postgres':
+        cursor = conn.server_side_cursor(chunk_size)
+    else:
+        cursor = conn.cursor()
+    cursor.execute(sql, parameters)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield from rows
+    cursor.close()
+
+def get_db_connection(readonly=False, snapshot=False):
+    """Open an instrumented connection to the store database.
+
+    Writes use the primary (writer) connection. readonly=True opens the same
+    file with mode=ro and query_only, so storefront reads can never take a
+    write lock; snapshot=True reads from the periodically refreshed replica
+    used for long analytics queries. On PostgreSQL both read modes use
+    read-only transactions, on the hot standby when REPLICA_DATABASE_URL is set.
+    """
+    if DB_BACKEND == 'postgres':
+        role = 'replica' if (readonly or snapshot) and REPLICA_DATABASE_URL else 'primary'
+        pool = get_postgres_pool(role)
+        conn = pool.getconn()
+        conn.set_session(readonly=bool(readonly or snapshot))
+        return PostgresConnection(pool, conn)
+
+    if snapshot and REPLICA_DATABASE:
+        refresh_replica()
+        uri = pathlib.Path(REPLICA_DATABASE).resolve().as_uri() + '?mode=ro'
+    elif readonly or snapshot:
+        uri = pathlib.Path(DATABASE).resolve().as_uri() + '?mode=ro'
+    else:
+        return sqlite3.connect(DATABASE, timeout=DB_BUSY_TIMEOUT, factory=InstrumentedConnection)
+
+    conn = sqlite3.connect(uri, uri=True, timeout=DB_BUSY_TIMEOUT, factory=InstrumentedConnection)
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+def refresh_replica():
+    """Copy the primary into the replica file when it is older than REPLICA_REFRESH_SECONDS"""
+    try:
+        age = time.time() - os.path.getmtime(REPLICA_DATABASE)
+    except OSError:
+        age = None
+    if age is not None and age < REPLICA_REFRESH_SECONDS:
+        return
+
+    with REPLICA_LOCK:
+        # Another thread may have refreshed it while we waited
+        try:
+            if time.time() - os.path.getmtime(REPLICA_DATABASE) < REPLICA_REFRESH_SECONDS:
+                return
+        except OSError:
+            pass
+        tmp_path = f'{REPLICA_DATABASE}.{os.getpid()}.tmp'
+        source = sqlite3.connect(pathlib.Path(DATABASE).resolve().as_uri() + '?mode=ro', uri=True)
+        target = sqlite3.connect(tmp_path)
+        try:
+            source.backup(target)
+            target.execute('PRAGMA journal_mode = DELETE')  # so mode=ro readers need no -wal/-shm
+        finally:
+            target.close()
+            source.close()
+        # Readers still holding the old replica keep their file handle
+        os.replace(tmp_path, REPLICA_DATABASE)
+
+def start_query(sql, parameters):
+    """Register a statement in the current request's query log"""
+    if not has_request_context() or 'sql_queries' not in g:
+        return None
+    query = {'sql': sql, 'params': parameters, 'ms': 0.0}
+    g.sql_queries.append(query)
+    return query
+
+def finish_query(query, elapsed):
+    """Add execution/fetch time to a logged statement"""
+    if query is not None:
+        query['ms'] += elapsed * 1000
+
+def explain_query(sql, parameters):
+    """Return EXPLAIN QUERY PLAN output for a statement (uninstrumented connection)"""
+    if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+        return []
+    if DB_BACKEND == 'postgres':
+        pool = get_postgres_pool()
+        conn = pool.getconn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('EXPLAIN ' + translate_sql(sql), parameters)
+            return [row[0] for row in cursor.fetchall()]
+        except psycopg2.Error as e:
+            return [f'EXPLAIN failed: {e}']
+        finally:
+            conn.rollback()
+            pool.putconn(conn)
+    conn = sqlite3.connect(pathlib.Path(DATABASE).resolve().as_uri() + '?mode=ro', uri=True)
+    try:
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+        return [row[3] for row in rows]
+    except sqlite3.Error as e:
+        return [f'EXPLAIN failed: {e}']
+    finally:
+        conn.close()
+
+@app.before_request
+def start_sql_log():
+    g.sql_queries = []
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_sql_stats(response):
+    queries = g.pop('sql_queries', None)
+    if queries is None:
+        return response
+    db_ms = sum(q['ms'] for q in queries)
+    total_ms = (time.perf_counter() - g.request_start) * 1000
+    response.headers['Server-Timing'] = (
+        f'db;desc="{len(queries)} queries";dur={db_ms:.2f}, app;dur={total_ms:.2f}'
+    )
+
+    endpoint = request.endpoint or 'unknown'
+    slow_queries = [q for q in queries if q['ms'] >= SLOW_QUERY_THRESHOLD_MS]
+    inc_counter('db_queries_total', {'endpoint': endpoint}, len(queries))
+    inc_counter('db_query_seconds_total', {'endpoint': endpoint}, db_ms / 1000)
+
+    with SQL_STATS_LOCK:
+        stats = SQL_STATS.setdefault(endpoint, {
+            'requests': 0, 'queries': 0, 'db_ms': 0.0, 'max_queries': 0, 'statements': {}
+        })
+        stats['requests'] += 1
+        stats['queries'] += len(queries)
+        stats['db_ms'] += db_ms
+        stats['max_queries'] = max(stats['max_queries'], len(queries))
+        for q in queries:
+            sql = normalize_sql(q['sql'])
+            statement = stats['statements'].get(sql)
+            if statement is None:
+                if len(stats['statements']) >= SQL_STATS_MAX_STATEMENTS:
+                    continue
+                statement = stats['statements'][sql] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+            statement['count'] += 1
+            statement['total_ms'] += q['ms']
+            statement['max_ms'] = max(statement['max_ms'], q['ms'])
+
+    # Slow queries are explained after the response is built so the plan lookup
+    # never counts against the statement's own timing
+    for q in slow_queries:
+        sql = normalize_sql(q['sql'])
+        plan = explain_query(q['sql'], q['params'])
+        print(f"SLOW QUERY ({q['ms']:.1f}ms) in {endpoint}: {sql}")
+        for line in plan:
+            print(f"    PLAN: {line}")
+        SLOW_QUERY_LOG.append({
+            'endpoint': endpoint,
+            'sql': sql,
+            'ms': round(q['ms'], 2),
+            'plan': plan,
+            'timestamp': datetime.now().isoformat(timespec='seconds')
+        })
+
+    return response
+
+# Metrics
+def metric_key(name, labels):
+    return (name, tuple(sorted((labels or {}).items())))
+
+def inc_counter(name, labels=None, amount=1):
+    """Increment a counter in this process's registry"""
+    key = metric_key(name, labels)
+    with METRICS_LOCK:
+        METRICS['counters'][key] = METRICS['counters'].get(key, 0) + amount
+
+def observe_histogram(name, value, labels=None, buckets=LATENCY_BUCKETS):
+    """Record an observation in a histogram"""
+    key = metric_key(name, labels)
+    with METRICS_LOCK:
+        histogram = METRICS['histograms'].get(key)
+        if histogram is None:
+            histogram = METRICS['histograms'][key] = {
+                'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0
+            }
+        for i, bound in enumerate(histogram['buckets']):
+            if value <= bound:
+                histogram['counts'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+def record_cache_access(cache, hit):
+    """Count a cache hit or miss"""
+    inc_counter('cache_requests_total', {'cache': cache, 'result': 'hit' if hit else 'miss'})
+
+def flush_metrics():
+    """Write this process's metrics snapshot for the /metrics aggregator"""
+    with METRICS_LOCK:
+        snapshot = {
+            'counters': [[name, list(labels), value]
+                         for (name, labels), value in METRICS['counters'].items()],
+            'histograms': [[name, list(labels), h['buckets'], h['counts'], h['sum'], h['count']]
+                           for (name, labels), h in METRICS['histograms'].items()]
+        }
+        METRICS_LAST_FLUSH[0] = time.time()
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f'metrics_{os.getpid()}.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"WARNING: could not write metrics snapshot: {e}")
+
+def collect_metrics():
+    """Sum the snapshots of every worker process"""
+    counters = {}
+    histograms = {}
+    try:
+        filenames = [f for f in os.listdir(METRICS_DIR) if f.startswith('metrics_') and f.endswith('.json')]
+    except OSError:
+        filenames = []
+    for filename in filenames:
+        try:
+            with open(os.path.join(METRICS_DIR, filename)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, counts, total, count in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            histogram = histograms.setdefault(key, {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+            histogram['counts'] = [a + b for a, b in zip(histogram['counts'], counts)]
+            histogram['sum'] += total
+            histogram['count'] += count
+    return counters, histograms
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+def render_metrics(counters, histograms):
+    """Render metrics in the Prometheus text exposition format"""
+    lines = []
+    for name, (metric_type, help_text) in METRIC_DEFINITIONS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        if metric_type == 'counter':
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        else:
+            for (key_name, labels), h in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(h['buckets'], h['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels, [("le", "+Inf")])} {h["count"]}')
+                lines.append(f'{name}_sum{format_labels(labels)} {h["sum"]}')
+                lines.append(f'{name}_count{format_labels(labels)} {h["count"]}')
+    return '\n'.join(lines) + '\n'
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' in g:
+        endpoint = request.endpoint or 'unknown'
+        elapsed = time.perf_counter() - g.request_start
+        inc_counter('http_requests_total', {'endpoint': endpoint, 'method': request.method,
+                                            'status': str(response.status_code)})
+        observe_histogram('http_request_duration_seconds', elapsed, {'endpoint': endpoint})
+    if time.time() - METRICS_LAST_FLUSH[0] >= METRICS_FLUSH_INTERVAL:
+        flush_metrics()
+    return response
+
+atexit.register(flush_metrics)
+
+# Sampling Profiler
+def profile_settings_path():
+    return os.path.join(PROFILE_DIR, 'settings.json')
+
+def current_profile_sample_rate():
+    """Sample rate shared by all workers via the admin settings file"""
+    now = time.time()
+    if now - PROFILING_STATE['checked'] >= PROFILE_SETTINGS_CHECK_INTERVAL:
+        PROFILING_STATE['checked'] = now
+        try:
+            with open(profile_settings_path()) as f:
+                PROFILING_STATE['sample_rate'] = float(json.load(f).get('sample_rate', 0))
+        except (OSError, ValueError):
+            pass
+    return PROFILING_STATE['sample_rate']
+
+def folded_stack(frame):
+    """Render a frame chain root-first in the folded format used by flamegraph.pl"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def profile_sampler():
+    """Background thread: sample the stacks of every thread serving a profiled request"""
+    while True:
+        PROFILES_WAKEUP.wait()
+        frames = sys._current_frames()
+        with PROFILES_LOCK:
+            if not ACTIVE_PROFILES:
+                PROFILES_WAKEUP.clear()
+                continue
+            for thread_id, profile in ACTIVE_PROFILES.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stack = folded_stack(frame)
+                    profile['stacks'][stack] = profile['stacks'].get(stack, 0) + 1
+        del frames
+        time.sleep(PROFILING_INTERVAL)
+
+def ensure_profile_sampler():
+    if PROFILING_STATE['sampler'] is None or not PROFILING_STATE['sampler'].is_alive():
+        PROFILING_STATE['sampler'] = threading.Thread(target=profile_sampler, name='profile-sampler', daemon=True)
+        PROFILING_STATE['sampler'].start()
+
+def save_profile(endpoint, stacks):
+    """Append a request's samples to the endpoint's folded-stack file"""
+    if not stacks:
+        return
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, secure_filename(endpoint) + '.folded'), 'a') as f:
+            for stack, samples in stacks.items():
+                f.write(f'{stack} {samples}\n')
+    except OSError as e:
+        print(f"WARNING: could not save profile for {endpoint}: {e}")
+
+@app.before_request
+def maybe_start_profiling():
+    requested = request.headers.get('X-Profile-Request') == '1' and session.get('is_admin')
+    sample_rate = current_profile_sample_rate()
+    if not requested and (sample_rate <= 0 or random.random() >= sample_rate):
+        return
+    ensure_profile_sampler()
+    with PROFILES_LOCK:
+        ACTIVE_PROFILES[threading.get_ident()] = {'endpoint': request.endpoint or 'unknown', 'stacks': {}}
+    PROFILES_WAKEUP.set()
+    g.profiling = True
+
+@app.teardown_request
+def stop_profiling(exc):
+    if not g.pop('profiling', False):
+        return
+    with PROFILES_LOCK:
+        profile = ACTIVE_PROFILES.pop(threading.get_ident(), None)
+    if profile:
+        save_profile(profile['endpoint'], profile['stacks'])
+
+# Schema changes to tables that already exist, applied once each in order by init_db.
+# Append new entries; never edit or reorder applied ones.
+MIGRATIONS = [
+    ('0001_cart_order_item_variants', [
+        # 0 = no variant, so (user_id, product_id, variant_id) can be unique
+        'ALTER TABLE cart ADD COLUMN variant_id INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE order_items ADD COLUMN variant_id INTEGER',
+    ]),
+    ('0002_unique_cart_lines', [
+        # Merge duplicate cart lines into the oldest one so add_to_cart can upsert
+        '''UPDATE cart SET quantity = (
+               SELECT SUM(c2.quantity) FROM cart c2
+               WHERE c2.user_id = cart.user_id AND c2.product_id = cart.product_id
+                 AND c2.variant_id = cart.variant_id)
+           WHERE id IN (SELECT MIN(id) FROM cart GROUP BY user_id, product_id, variant_id HAVING COUNT(*) > 1)''',
+        'DELETE FROM cart WHERE id NOT IN (SELECT MIN(id) FROM cart GROUP BY user_id, product_id, variant_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_cart_user_product_variant ON cart (user_id, product_id, variant_id)',
+    ]),
+    ('0003_order_events', [
+        # Append-only history of order status changes; from_status is NULL when the order is placed
+        '''CREATE TABLE IF NOT EXISTS order_events (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               order_id INTEGER NOT NULL,
+               from_status TEXT,
+               to_status TEXT NOT NULL,
+               actor_id INTEGER,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (order_id) REFERENCES orders (id)
+           )''',
+        'CREATE INDEX IF NOT EXISTS idx_order_events_order ON order_events (order_id)',
+        'CREATE INDEX IF NOT EXISTS idx_order_events_created ON order_events (created_at)',
+        '''INSERT INTO order_events (order_id, from_status, to_status, created_at)
+           SELECT id, NULL, COALESCE(order_status, 'processing'), order_date FROM orders''',
+        # Orders and order value per status, kept up to date by record_order_status
+        '''CREATE TABLE IF NOT EXISTS order_status_counts (
+               status TEXT PRIMARY KEY,
+               order_count INTEGER NOT NULL,
+               total_amount REAL NOT NULL
+           )''',
+        lambda cursor: rebuild_order_status_counts(cursor),
+    ]),
+    ('0004_returns', [
+        # return_order used to create this table on demand; databases that saw a return have it already
+        '''CREATE TABLE IF NOT EXISTS returns (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               order_id INTEGER NOT NULL,
+               user_id INTEGER NOT NULL,
+               reason TEXT NOT NULL,
+               status TEXT DEFAULT 'pending',
+               request_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (order_id) REFERENCES orders (id),
+               FOREIGN KEY (user_id) REFERENCES users (id)
+           )''',
+        'ALTER TABLE returns ADD COLUMN resolved_at TIMESTAMP',
+        'ALTER TABLE returns ADD COLUMN refund_amount REAL',
+        'CREATE INDEX IF NOT EXISTS idx_returns_order ON returns (order_id)',
+        'CREATE INDEX IF NOT EXISTS idx_returns_status ON returns (status, id)',
+    ]),
+    ('0005_image_blobs', [
+        '''CREATE TABLE image_blobs (
+               filename TEXT PRIMARY KEY,
+               size_bytes INTEGER,
+               ref_count INTEGER NOT NULL DEFAULT 0,
+               upload_count INTEGER NOT NULL DEFAULT 0,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               released_at REAL
+           )''',
+        'CREATE INDEX idx_image_blobs_released ON image_blobs (released_at)',
+        lambda cursor: rebuild_image_refs(cursor),
+    ]),
+    ('0006_image_uploads', [
+        '''CREATE TABLE image_uploads (
+               id TEXT PRIMARY KEY,
+               filename TEXT NOT NULL,
+               total_bytes INTEGER NOT NULL,
+               received_bytes INTEGER NOT NULL DEFAULT 0,
+               updated_at REAL NOT NULL
+           )''',
+        'CREATE INDEX idx_image_uploads_updated ON image_uploads (updated_at)',
+    ]),
+]
+
+def apply_migrations(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('SELECT name FROM schema_migrations')
+    applied = {row[0] for row in cursor.fetchall()}
+    for name, steps in MIGRATIONS:
+        if name in applied:
+            continue
+        for step in steps:
+            if callable(step):
+                step(cursor)
+            else:
+                cursor.execute(step)
+        cursor.execute('INSERT INTO schema_migrations (name) VALUES (?)', (name,))
+        print(f"Applied migration {name}")
+        # The analytics replica still has the old schema; drop it so the next read recopies it
+        if DB_BACKEND == 'sqlite' and REPLICA_DATABASE and os.path.exists(REPLICA_DATABASE):
+            os.remove(REPLICA_DATABASE)
+
 # Database initialization
 def init_db():
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
+    # WAL lets read-only connections keep reading while checkout writes commit
+    if DB_BACKEND == 'sqlite':
+        cursor.execute('PRAGMA journal_mode = WAL')
+    
     # Create users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -223,7 +1103,7 @@ def init_db():
             sizes TEXT,
             colors TEXT,
             gender TEXT,
-            has_variants BOOLEAN DEFAULT 0
+            has_variants BOOLEAN DEFAULT FALSE
         )
     ''')
     
@@ -250,7 +1130,7 @@ def init_db():
             variant_id INTEGER NOT NULL,
             image_path TEXT NOT NULL,
             display_order INTEGER DEFAULT 0,
-            is_primary BOOLEAN DEFAULT 0,
+            is_primary BOOLEAN DEFAULT FALSE,
             alt_text TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (variant_id) REFERENCES product_variants (id) ON DELETE CASCADE
@@ -311,6 +1191,110 @@ def init_db():
         )
     ''')
     
+    # Single-row counter bumped on every catalog write; workers compare it to drop cached product data
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT INTO catalog_version (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING')
+    
+    # Indexes for order listings, exports and analytics date/status filters
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_order_date ON orders (order_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_order_status ON orders (order_status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items (order_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_variants_product_id ON product_variants (product_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_variant_images_variant_id ON variant_images (variant_id)')
+    
+    apply_migrations(cursor)
+    
+    # Listing projection: one precomputed row per product for catalog pages, kept current by
+    # refresh_product_listing(). Columns 0-11 mirror products so templates index it the same way.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_listing (
+            product_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            category TEXT NOT NULL,
+            subcategory TEXT,
+            price REAL NOT NULL,
+            description TEXT,
+            images TEXT,
+            stock INTEGER DEFAULT 0,
+            sizes TEXT,
+            colors TEXT,
+            gender TEXT,
+            has_variants BOOLEAN DEFAULT FALSE,
+            primary_image TEXT,
+            image_count INTEGER DEFAULT 0,
+            min_price REAL,
+            max_price REAL,
+            total_stock INTEGER DEFAULT 0,
+            in_stock BOOLEAN DEFAULT FALSE,
+            variant_count INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_listing_category ON product_listing (category)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_listing_gender ON product_listing (gender)')
+    
+    # Idempotency keys of recent write requests, so a retried or double-submitted request
+    # is applied once; rows older than IDEMPOTENCY_KEY_TTL are swept
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            response TEXT,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (user_id, idempotency_key)
+        )
+    ''')
+    
+    # Server-side sessions (see DatabaseSessionInterface); expired rows are swept
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    
+    # Token buckets of @rate_limit, shared by all workers; idle buckets are swept
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            bucket TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    
+    # Time-decayed popularity per product, updated incrementally by checkout and wishlist toggles
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_trending (
+            product_id INTEGER PRIMARY KEY,
+            sales_score REAL NOT NULL DEFAULT 0,
+            wishlist_score REAL NOT NULL DEFAULT 0,
+            score REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_trending_score ON product_trending (score)')
+    
+    # Top-K related products per product, rebuilt offline by `flask build-recommendations`
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_recommendations (
+            product_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            related_product_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (product_id, rank)
+        )
+    ''')
+    
+    # Backfill or repair the projection when it has drifted from products
+    cursor.execute('SELECT (SELECT COUNT(*) FROM products), (SELECT COUNT(*) FROM product_listing)')
+    product_count, listing_count = cursor.fetchone()
+    if product_count != listing_count:
+        rebuild_product_listing(cursor)
+    
     conn.commit()
     conn.close()
 
@@ -332,7 +1316,7 @@ def admin_required(f):
             flash('Please log in to access this page.', 'error')
             return redirect(url_for('login'))
         
-        conn = sqlite3.connect('database.db')
+        conn = get_db_connection(readonly=True)
         cursor = conn.cursor()
         cursor.execute('SELECT is_admin FROM users WHERE id = ?', (session['user_id'],))
         user = cursor.fetchone()
@@ -344,17 +1328,325 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# ===== SERVER-SIDE SESSIONS =====
+#
+# The session cookie holds only a random id; the data lives in the sessions table.
+# A session is read from the database the first time a request touches it (static files
+# and most anonymous pages never do) and written back only when it was changed, or when
+# less than half of its lifetime is left.
+
+class DatabaseSession(SessionMixin):
+    def __init__(self, interface, sid=None):
+        self.interface = interface
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        self.expires_at = None
+        self.loaded_user_id = None
+        self._data = {} if sid is None else None
+    
+    def _load(self):
+        self.accessed = True
+        if self._data is None:
+            self._data, self.expires_at = self.interface.load(self.sid)
+            if self.expires_at is None:
+                self.sid = None  # unknown or expired id; never adopt an id the client made up
+            self.loaded_user_id = self._data.get('user_id')
+        return self._data
+    
+    def __getitem__(self, key):
+        return self._load()[key]
+    
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+    
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+    
+    def __iter__(self):
+        return iter(self._load())
+    
+    def __len__(self):
+        return len(self._load())
+
+class DatabaseSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+    
+    def open_session(self, app, request):
+        return DatabaseSession(self, request.cookies.get(self.get_cookie_name(app)) or None)
+    
+    def load(self, sid):
+        """(data, expires_at) of a live session, or ({}, None)"""
+        conn = get_db_connection(readonly=True)
+        cursor = conn.cursor()
+        cursor.execute('SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?', (sid, time.time()))
+        row = cursor.fetchone()
+        conn.close()
+        if not row:
+            return {}, None
+        return self.serializer.loads(row[0]), row[1]
+    
+    def save_session(self, app, session, response):
+        if session.accessed:
+            response.vary.add('Cookie')
+        if session._data is None:
+            return  # never read, so nothing can have changed
+        
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        cookie_name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        
+        if not session._data:
+            if session.modified and session.sid:
+                conn = get_db_connection()
+                conn.execute('DELETE FROM sessions WHERE id = ?', (session.sid,))
+                conn.commit()
+                conn.close()
+                response.delete_cookie(cookie_name, domain=domain, path=path)
+            return
+        
+        refresh = session.expires_at is not None and session.expires_at - now < lifetime / 2
+        if not (session.modified or refresh or session.sid is None):
+            return
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if session.sid and session._data.get('user_id') != session.loaded_user_id:
+            # Logging in or out gets a new id, so an id known before login is useless after it
+            cursor.execute('DELETE FROM sessions WHERE id = ?', (session.sid,))
+            session.sid = None
+        
+        created = session.sid is None
+        if created:
+            session.sid = secrets.token_urlsafe(16)
+        if random.random() < 0.01:
+            cursor.execute('DELETE FROM sessions WHERE expires_at < ?', (now,))
+        cursor.execute('''
+            INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at
+        ''', (session.sid, self.serializer.dumps(dict(session._data)), now + lifetime))
+        conn.commit()
+        conn.close()
+        
+        if created or session.permanent:
+            response.set_cookie(cookie_name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+if SESSION_STORE == 'database':
+    app.session_interface = DatabaseSessionInterface()
+
+# ===== END SERVER-SIDE SESSIONS =====
+
+# ===== PASSWORD HASHING =====
+#
+# Password hashes are deliberately slow. They run in a small process pool so a burst of
+# logins cannot take every request thread's CPU, and at most PASSWORD_HASH_QUEUE_LIMIT
+# may wait or run at once: beyond that the request gets a 503 straight away instead of
+# queueing behind the burst.
+
+class PasswordHashingBusy(Exception):
+    pass
+
+PASSWORD_HASH_POOL = [None]
+PASSWORD_HASH_POOL_LOCK = threading.Lock()
+PASSWORD_HASH_SLOTS = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE_LIMIT)
+PASSWORD_HASH_PREFIX = [None]  # PASSWORD_HASH_METHOD as werkzeug writes it, e.g. pbkdf2 -> pbkdf2:sha256:600000
+
+def run_password_hash(fn, *args):
+    if not PASSWORD_HASH_SLOTS.acquire(blocking=False):
+        raise PasswordHashingBusy()
+    try:
+        if PASSWORD_HASH_WORKERS <= 0:
+            return fn(*args)
+        with PASSWORD_HASH_POOL_LOCK:
+            if PASSWORD_HASH_POOL[0] is None:
+                # Never fork: this process already runs request threads that may hold locks
+                start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                PASSWORD_HASH_POOL[0] = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                                                            mp_context=multiprocessing.get_context(start_method))
+            pool = PASSWORD_HASH_POOL[0]
+        try:
+            return pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # A pool process died; start a fresh pool for the next request
+            with PASSWORD_HASH_POOL_LOCK:
+                if PASSWORD_HASH_POOL[0] is pool:
+                    PASSWORD_HASH_POOL[0] = None
+            raise
+    finally:
+        PASSWORD_HASH_SLOTS.release()
+
+def hash_password(password):
+    return run_password_hash(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+def verify_password(password_hash, password):
+    return run_password_hash(check_password_hash, password_hash, password)
+
+def password_needs_rehash(password_hash):
+    """True when password_hash was made with other parameters than PASSWORD_HASH_METHOD"""
+    if PASSWORD_HASH_PREFIX[0] is None:
+        PASSWORD_HASH_PREFIX[0] = hash_password('').split('$', 1)[0]
+    return password_hash.split('$', 1)[0] != PASSWORD_HASH_PREFIX[0]
+
+@app.errorhandler(PasswordHashingBusy)
+def password_hashing_busy(error):
+    inc_counter('password_hash_rejected_total', {'endpoint': request.endpoint})
+    if request.is_json:
+        response = jsonify({'error': 'The server is busy. Please try again in a moment.'})
+    else:
+        response = make_response('The server is busy. Please try again in a moment.')
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+@atexit.register
+def shutdown_password_hash_pool():
+    if PASSWORD_HASH_POOL[0] is not None:
+        PASSWORD_HASH_POOL[0].shutdown(wait=False, cancel_futures=True)
+
+# ===== END PASSWORD HASHING =====
+
+# ===== RATE LIMITING =====
+#
+# Token buckets: a bucket holds up to `capacity` tokens, refills at capacity/period tokens
+# per second and each request takes one. Buckets live in the rate_limits table so every
+# worker sees the same count; one upsert refills, checks and takes a token atomically.
+# Each worker also mirrors the buckets it has touched: the mirror is the shared count as
+# of this worker's last allowed request, which can only be higher than the real count,
+# so a bucket that is empty in the mirror is rejected without touching the database.
+
+RATE_LIMIT_LOCAL = {}  # bucket -> (tokens, updated_at)
+RATE_LIMIT_LOCK = threading.Lock()
+RATE_LIMIT_IDLE_TTL = [0.0]  # longest refill time of any declared limit; fuller buckets are swept
+
+def rate_limit_keys(kind):
+    """The value a limit is keyed on for the current request, or None if it does not apply"""
+    if kind == 'ip':
+        return request.remote_addr
+    if kind == 'email':
+        email = request.form.get('email')
+        if not email and 'login_data' in session:
+            email = session['login_data'].get('email')
+        return email.strip().lower()[:254] if email else None
+    if kind == 'user':
+        return session.get('user_id')
+    raise ValueError(f'Unknown rate limit key: {kind}')
+
+def take_local_token(bucket, capacity, rate, now):
+    """True unless this worker's mirror says the bucket is empty"""
+    with RATE_LIMIT_LOCK:
+        state = RATE_LIMIT_LOCAL.get(bucket)
+    if state is None:
+        return True
+    tokens, updated_at = state
+    return min(capacity, tokens + (now - updated_at) * rate) >= 1
+
+def remember_local_tokens(states):
+    """Update this worker's mirror with {bucket: (tokens, updated_at)} read from the shared buckets"""
+    with RATE_LIMIT_LOCK:
+        if len(RATE_LIMIT_LOCAL) + len(states) > RATE_LIMIT_LOCAL_SIZE:
+            RATE_LIMIT_LOCAL.clear()
+        RATE_LIMIT_LOCAL.update(states)
+
+def take_shared_token(cursor, bucket, capacity, rate, now):
+    """Refill the shared bucket and take a token. Returns the tokens left, or None when empty."""
+    refilled = 'rate_limits.tokens + (excluded.updated_at - rate_limits.updated_at) * ?'
+    cursor.execute(f'''
+        INSERT INTO rate_limits (bucket, tokens, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT (bucket) DO UPDATE
+        SET tokens = CASE WHEN {refilled} > ? THEN ? ELSE {refilled} END - 1,
+            updated_at = excluded.updated_at
+        WHERE {refilled} >= 1
+        RETURNING tokens
+    ''', (bucket, capacity - 1, now, rate, capacity, capacity, rate, rate))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def rate_limit(**limits):
+    """Limit POSTs to a route. Each keyword names what to count by ('ip', 'email' or 'user')
+    and gives (capacity, period_seconds):
+
+        @rate_limit(ip=(20, 300), email=(5, 300))
+
+    allows a burst of 20 requests per client IP, refilling over 5 minutes, and 5 per email."""
+    for capacity, period in limits.values():
+        RATE_LIMIT_IDLE_TTL[0] = max(RATE_LIMIT_IDLE_TTL[0], period)
+    
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not RATE_LIMIT_ENABLED or request.method != 'POST':
+                return f(*args, **kwargs)
+            
+            now = time.time()
+            buckets = []
+            for kind, (capacity, period) in limits.items():
+                key = rate_limit_keys(kind)
+                if key is None:
+                    continue
+                bucket = f'{f.__name__}:{kind}:{key}'
+                rate = capacity / period
+                if not take_local_token(bucket, capacity, rate, now):
+                    return rate_limited(kind, 'local', period / capacity)
+                buckets.append((kind, bucket, capacity, rate))
+            
+            if buckets:
+                conn = get_db_connection()
+                cursor = conn.cursor()
+                if random.random() < 0.01:
+                    cursor.execute('DELETE FROM rate_limits WHERE updated_at < ?', (now - RATE_LIMIT_IDLE_TTL[0],))
+                taken = {}
+                for kind, bucket, capacity, rate in buckets:
+                    tokens = take_shared_token(cursor, bucket, capacity, rate, now)
+                    if tokens is None:
+                        # Hand back the tokens taken from the other buckets of this request
+                        conn.rollback()
+                        conn.close()
+                        remember_local_tokens({bucket: (0, now)})
+                        return rate_limited(kind, 'shared', 1 / rate)
+                    taken[bucket] = (tokens, now)
+                conn.commit()
+                conn.close()
+                remember_local_tokens(taken)
+            
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+def rate_limited(kind, decided, retry_after):
+    inc_counter('rate_limited_total', {'endpoint': request.endpoint, 'key': kind, 'decided': decided})
+    retry_after = max(1, math.ceil(retry_after))
+    if request.is_json:
+        response = jsonify({'error': 'Too many requests. Please try again later.'})
+        response.status_code = 429
+    else:
+        flash(f'Too many attempts. Please wait {retry_after} seconds and try again.', 'error')
+        response = redirect(request.referrer or url_for('index'))
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+# ===== END RATE LIMITING =====
+
 # Routes
 @app.route('/')
 def index():
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM products LIMIT 6')
-    featured_products = cursor.fetchall()
+    featured_products = listing_rows(get_trending_products(cursor, 6))
     conn.close()
     return render_template('index.html', products=featured_products)
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limit(ip=(20, 300), email=(10, 300))
 def login():
     if request.method == 'POST':
         # Step 1: Verify credentials and send OTP
@@ -362,22 +1654,34 @@ def login():
             email = request.form['email']
             password = request.form['password']
             
-            conn = sqlite3.connect('database.db')
+            conn = get_db_connection(readonly=True)
             cursor = conn.cursor()
             cursor.execute('SELECT id, name, password, is_admin FROM users WHERE email = ?', (email,))
             user = cursor.fetchone()
             conn.close()
             
-            if not user or not check_password_hash(user[2], password):
+            if not user or not verify_password(user[2], password):
                 flash('Invalid email or password.', 'error')
                 return render_template('login.html')
             
+            # Upgrade hashes made with older parameters while the plaintext is at hand
+            if password_needs_rehash(user[2]):
+                conn = get_db_connection()
+                cursor = conn.cursor()
+                cursor.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?',
+                               (hash_password(password), user[0], user[2]))
+                conn.commit()
+                conn.close()
+                inc_counter('password_rehashes_total')
+            
             # Check if user is admin - skip OTP for admins
             if user[3]:  # is_admin
                 session['user_id'] = user[0]
                 session['user_name'] = user[1]
                 session['is_admin'] = user[3]
                 flash('✅ Admin login successful! (OTP skipped for admin)', 'success')
+                if merge_guest_cart(user[0]):
+                    return redirect(url_for('cart'))
                 return redirect(url_for('index'))
             
             # For regular users, send OTP
@@ -429,11 +1733,14 @@ def login():
             session.pop('login_data', None)
             
             flash('✅ Login successful! OTP verified.', 'success')
+            if merge_guest_cart(login_data['user_id']):
+                return redirect(url_for('cart'))
             return redirect(url_for('index'))
     
     return render_template('login.html')
 
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limit(ip=(10, 3600), email=(3, 600))
 def register():
     if request.method == 'POST':
         # DEBUG: Print what's in the form
@@ -479,7 +1786,7 @@ def register():
                 flash('Password must contain at least one special character (!@#$%^&* etc.)!', 'error')
                 return render_template('register.html')
             
-            conn = sqlite3.connect('database.db')
+            conn = get_db_connection(readonly=True)
             cursor = conn.cursor()
             
             # Check if user already exists
@@ -491,10 +1798,11 @@ def register():
             conn.close()
             
             # Store registration data in session temporarily
+            # Only the hash is kept until the OTP is verified
             session['register_data'] = {
                 'name': name,
                 'email': email,
-                'password': password
+                'password_hash': hash_password(password)
             }
             
             # Generate and store OTP
@@ -528,12 +1836,11 @@ def register():
                 return render_template('register.html', show_otp_field=True, email=email)
             
             # OTP verified - complete registration
-            conn = sqlite3.connect('database.db')
+            conn = get_db_connection()
             cursor = conn.cursor()
             
-            hashed_password = generate_password_hash(reg_data['password'])
             cursor.execute('INSERT INTO users (name, email, password) VALUES (?, ?, ?)', 
-                          (reg_data['name'], email, hashed_password))
+                          (reg_data['name'], email, reg_data['password_hash']))
             conn.commit()
             conn.close()
             
@@ -554,6 +1861,7 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route('/forgot_password', methods=['GET', 'POST'])
+@rate_limit(ip=(10, 3600), email=(3, 600))
 def forgot_password():
     if request.method == 'POST':
         if 'send_otp' in request.form:
@@ -561,7 +1869,7 @@ def forgot_password():
             email = request.form['email']
             
             # Check if user exists
-            conn = sqlite3.connect('database.db')
+            conn = get_db_connection(readonly=True)
             cursor = conn.cursor()
             cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
             user = cursor.fetchone()
@@ -644,9 +1952,9 @@ def forgot_password():
                 return render_template('forgot_password.html', show_password_field=True, email=email)
             
             # Update password in database
-            conn = sqlite3.connect('database.db')
+            conn = get_db_connection()
             cursor = conn.cursor()
-            hashed_password = generate_password_hash(new_password)
+            hashed_password = hash_password(new_password)
             cursor.execute('UPDATE users SET password = ? WHERE email = ?', (hashed_password, email))
             conn.commit()
             conn.close()
@@ -675,7 +1983,7 @@ def profile():
                 flash('Name must be at least 2 characters long!', 'error')
                 return redirect(url_for('profile'))
             
-            conn = sqlite3.connect('database.db')
+            conn = get_db_connection()
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET name = ? WHERE id = ?', (new_name, user_id))
             conn.commit()
@@ -692,13 +2000,13 @@ def profile():
             confirm_password = request.form.get('confirm_password', '')
             
             # Verify current password
-            conn = sqlite3.connect('database.db')
+            conn = get_db_connection(readonly=True)
             cursor = conn.cursor()
             cursor.execute('SELECT password FROM users WHERE id = ?', (user_id,))
             user = cursor.fetchone()
             conn.close()
             
-            if not user or not check_password_hash(user[0], current_password):
+            if not user or not verify_password(user[0], current_password):
                 flash('Current password is incorrect!', 'error')
                 return redirect(url_for('profile'))
             
@@ -730,9 +2038,9 @@ def profile():
                 return redirect(url_for('profile'))
             
             # Update password
-            conn = sqlite3.connect('database.db')
+            conn = get_db_connection()
             cursor = conn.cursor()
-            hashed_password = generate_password_hash(new_password)
+            hashed_password = hash_password(new_password)
             cursor.execute('UPDATE users SET password = ? WHERE id = ?', (hashed_password, user_id))
             conn.commit()
             conn.close()
@@ -741,7 +2049,7 @@ def profile():
             return redirect(url_for('profile'))
     
     # Get user data
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
     cursor.execute('SELECT name, email FROM users WHERE id = ?', (session['user_id'],))
     user = cursor.fetchone()
@@ -759,10 +2067,10 @@ def products():
     price_range = request.args.get('price_range', '')
     sort = request.args.get('sort', '')
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
     
-    query = 'SELECT * FROM products WHERE 1=1'
+    query = f'SELECT {PRODUCT_LISTING_COLUMNS} FROM product_listing WHERE 1=1'
     params = []
     
     if category:
@@ -788,15 +2096,15 @@ def products():
     # Price range filter
     if price_range:
         if price_range == '0-500':
-            query += ' AND price < 500'
+            query += ' AND min_price < 500'
         elif price_range == '500-1000':
-            query += ' AND price BETWEEN 500 AND 1000'
+            query += ' AND min_price BETWEEN 500 AND 1000'
         elif price_range == '1000-2000':
-            query += ' AND price BETWEEN 1000 AND 2000'
+            query += ' AND min_price BETWEEN 1000 AND 2000'
         elif price_range == '2000-5000':
-            query += ' AND price BETWEEN 2000 AND 5000'
+            query += ' AND min_price BETWEEN 2000 AND 5000'
         elif price_range == '5000+':
-            query += ' AND price > 5000'
+            query += ' AND min_price > 5000'
     
     # Sorting
     if sort == 'name_asc':
@@ -804,33 +2112,38 @@ def products():
     elif sort == 'name_desc':
         query += ' ORDER BY name DESC'
     elif sort == 'price_asc':
-        query += ' ORDER BY price ASC'
+        query += ' ORDER BY min_price ASC'
     elif sort == 'price_desc':
-        query += ' ORDER BY price DESC'
+        query += ' ORDER BY min_price DESC'
     elif sort == 'newest':
-        query += ' ORDER BY id DESC'
+        query += ' ORDER BY product_id DESC'
     else:
         query += ' ORDER BY name'
     
     cursor.execute(query, params)
-    products = cursor.fetchall()
+    products = listing_rows(cursor.fetchall())
+    
+    # Rendered into the page so cards need no per-product status requests
+    wishlist_ids = set()
+    if 'user_id' in session:
+        wishlist_ids = get_wishlist_ids(cursor, session['user_id'], [product[0] for product in products])
     
     # Get unique values for filters
-    cursor.execute('SELECT DISTINCT category FROM products WHERE category IS NOT NULL')
+    cursor.execute('SELECT DISTINCT category FROM product_listing WHERE category IS NOT NULL')
     categories = [row[0] for row in cursor.fetchall()]
     
-    cursor.execute('SELECT DISTINCT gender FROM products WHERE gender IS NOT NULL')
+    cursor.execute('SELECT DISTINCT gender FROM product_listing WHERE gender IS NOT NULL')
     genders = [row[0] for row in cursor.fetchall()]
     
     # Get all available sizes and colors
-    cursor.execute('SELECT DISTINCT sizes FROM products WHERE sizes IS NOT NULL')
+    cursor.execute('SELECT DISTINCT sizes FROM product_listing WHERE sizes IS NOT NULL')
     all_sizes = set()
     for row in cursor.fetchall():
         if row[0]:
             all_sizes.update(row[0].split(','))
     sizes = sorted(list(all_sizes))
     
-    cursor.execute('SELECT DISTINCT colors FROM products WHERE colors IS NOT NULL')
+    cursor.execute('SELECT DISTINCT colors FROM product_listing WHERE colors IS NOT NULL')
     all_colors = set()
     for row in cursor.fetchall():
         if row[0]:
@@ -838,7 +2151,7 @@ def products():
     colors = sorted(list(all_colors))
     
     conn.close()
-    return render_template('product.html', products=products, categories=categories, 
+    return render_template('product.html', products=products, wishlist_ids=wishlist_ids, categories=categories, 
                           genders=genders, sizes=sizes, colors=colors,
                           selected_category=category, selected_gender=gender,
                           selected_size=size, selected_color=color, search_term=search,
@@ -847,7 +2160,7 @@ def products():
 @app.route('/product/<int:product_id>')
 def product_detail(product_id):
     """Product detail page with variant support"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
     
     # Get product details
@@ -858,73 +2171,65 @@ def product_detail(product_id):
         flash('Product not found', 'error')
         return redirect(url_for('products'))
     
-    # Check if product has variants
-    has_variants = product[11] if len(product) > 11 else False
+    # Variant data comes from the same loader as the variants API; availability from product_listing
+    availability = get_product_availability(cursor, product_id)
+    has_variants = bool(availability and availability['variant_count'])
     
     variants_data = []
     if has_variants:
-        # Get all variants with their images
-        cursor.execute('''
-            SELECT id, variant_name, variant_type, price, stock, sku, display_order
-            FROM product_variants
-            WHERE product_id = ?
-            ORDER BY display_order, id
-        ''', (product_id,))
-        variants = cursor.fetchall()
-        
-        for variant in variants:
-            variant_id = variant[0]
-            
-            # Get images for this variant
-            cursor.execute('''
-                SELECT id, image_path, display_order, is_primary, alt_text
-                FROM variant_images
-                WHERE variant_id = ?
-                ORDER BY display_order, id
-            ''', (variant_id,))
-            images = cursor.fetchall()
-            
-            variants_data.append({
-                'id': variant[0],
-                'name': variant[1],
-                'type': variant[2],
-                'price': variant[3] if variant[3] else product[4],  # Use variant price or product price
-                'stock': variant[4],
-                'sku': variant[5],
-                'display_order': variant[6],
-                'images': [{
-                    'id': img[0],
-                    'path': img[1],
-                    'order': img[2],
-                    'is_primary': img[3],
-                    'alt_text': img[4] or variant[1]
-                } for img in images]
-            })
+        for variant in load_product_variants(cursor, product_id):
+            variant['price'] = variant['price'] if variant['price'] else product[4]  # Use variant price or product price
+            for img in variant['images']:
+                img['alt_text'] = img['alt_text'] or variant['name']
+            variants_data.append(variant)
     
     conn.close()
     return render_template('product_detail.html', product=product, 
-                          has_variants=has_variants, variants=variants_data)
+                          has_variants=has_variants, variants=variants_data,
+                          availability=availability)
 
 @app.route('/add_to_cart', methods=['POST'])
-@login_required
 def add_to_cart():
-    product_id = request.form['product_id']
+    product_id = int(request.form['product_id'])
     quantity = int(request.form['quantity'])
+    variant_id = int(request.form.get('variant_id') or 0)
+    
+    if 'user_id' not in session:
+        return add_to_guest_cart(product_id, variant_id, quantity)
     
-    conn = sqlite3.connect('database.db')
+    if quantity < 1:
+        flash('Please choose a quantity of at least 1.', 'error')
+        return redirect(request.referrer or url_for('products'))
+    
+    conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Check if item already in cart
-    cursor.execute('SELECT id, quantity FROM cart WHERE user_id = ? AND product_id = ?', 
-                   (session['user_id'], product_id))
-    existing = cursor.fetchone()
+    # A repeated submit of the same form is acknowledged without adding again
+    if claim_idempotency_key(cursor, session['user_id']) is not None:
+        conn.close()
+        flash('Product added to cart!', 'success')
+        return redirect(url_for('products'))
     
-    if existing:
-        cursor.execute('UPDATE cart SET quantity = quantity + ? WHERE id = ?', 
-                      (quantity, existing[0]))
-    else:
-        cursor.execute('INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, ?)', 
-                      (session['user_id'], product_id, quantity))
+    available = available_stock(cursor, product_id, variant_id)
+    if available is None:
+        conn.close()
+        flash('Please choose an option for this product.', 'warning')
+        return redirect(url_for('product_detail', product_id=product_id))
+    
+    # One statement adds the line or increases it, unless the total would exceed stock
+    cursor.execute('''
+        INSERT INTO cart (user_id, product_id, variant_id, quantity)
+        SELECT ?, ?, ?, ? WHERE ? <= ?
+        ON CONFLICT (user_id, product_id, variant_id) DO UPDATE
+        SET quantity = cart.quantity + excluded.quantity
+        WHERE cart.quantity + excluded.quantity <= ?
+    ''', (session['user_id'], product_id, variant_id, quantity, quantity, available, available))
+    
+    if cursor.rowcount != 1:
+        conn.rollback()
+        conn.close()
+        flash(f'Sorry, only {available} of this item left in stock.', 'error')
+        return redirect(request.referrer or url_for('products'))
     
     conn.commit()
     conn.close()
@@ -932,15 +2237,63 @@ def add_to_cart():
     flash('Product added to cart!', 'success')
     return redirect(url_for('products'))
 
-@app.route('/cart')
-@login_required
+def add_to_guest_cart(product_id, variant_id, quantity):
+    """add_to_cart for guests: the stock check is a read, the cart itself is the session"""
+    if quantity < 1:
+        flash('Please choose a quantity of at least 1.', 'error')
+        return redirect(request.referrer or url_for('products'))
+    
+    # The last form key is remembered in the session so a double submit adds once
+    key = get_idempotency_key()
+    if key and session.get('guest_cart_key') == key:
+        flash('Product added to cart!', 'success')
+        return redirect(url_for('products'))
+    
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    available = available_stock(cursor, product_id, variant_id)
+    conn.close()
+    
+    if available is None:
+        flash('Please choose an option for this product.', 'warning')
+        return redirect(url_for('product_detail', product_id=product_id))
+    
+    guest_cart = load_guest_cart()
+    line = (product_id, variant_id)
+    if line not in guest_cart and len(guest_cart) >= GUEST_CART_MAX_LINES:
+        flash('Your cart is full. Please log in to add more items.', 'warning')
+        return redirect(request.referrer or url_for('products'))
+    
+    new_quantity = guest_cart.get(line, 0) + quantity
+    if new_quantity > available:
+        flash(f'Sorry, only {available} of this item left in stock.', 'error')
+        return redirect(request.referrer or url_for('products'))
+    
+    guest_cart[line] = new_quantity
+    save_guest_cart(guest_cart)
+    if key:
+        session['guest_cart_key'] = key
+    
+    flash('Product added to cart!', 'success')
+    return redirect(url_for('products'))
+
+@app.route('/cart')
 def cart():
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
+    if 'user_id' not in session:
+        cart_items = guest_cart_rows(cursor, load_guest_cart())
+        conn.close()
+        total = sum(float(item[2] or 0) * item[3] for item in cart_items)
+        return render_template('cart.html', cart_items=cart_items, total=total)
+    
     cursor.execute('''
-        SELECT c.id, p.name, p.price, c.quantity, p.images, p.id as product_id
+        SELECT c.id,
+               CASE WHEN v.id IS NULL THEN p.name ELSE p.name || ' - ' || v.variant_name END,
+               COALESCE(v.price, p.price), c.quantity, p.images, p.id as product_id, c.variant_id
         FROM cart c
         JOIN products p ON c.product_id = p.id
+        LEFT JOIN product_variants v ON v.id = c.variant_id
         WHERE c.user_id = ?
     ''', (session['user_id'],))
     cart_items = cursor.fetchall()
@@ -959,11 +2312,22 @@ def cart():
     return render_template('cart.html', cart_items=cart_items, total=total)
 
 @app.route('/remove_from_cart', methods=['POST'])
-@login_required
 def remove_from_cart():
     cart_id = request.form['cart_id']
     
-    conn = sqlite3.connect('database.db')
+    if 'user_id' not in session:
+        # Guest lines are keyed "product_id:variant_id"
+        guest_cart = load_guest_cart()
+        try:
+            line = tuple(int(part) for part in cart_id.split(':'))
+        except ValueError:
+            line = None
+        if guest_cart.pop(line, None) is not None:
+            save_guest_cart(guest_cart)
+        flash('Item removed from cart.', 'info')
+        return redirect(url_for('cart'))
+    
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('DELETE FROM cart WHERE id = ? AND user_id = ?', 
                    (cart_id, session['user_id']))
@@ -976,35 +2340,46 @@ def remove_from_cart():
 @app.route('/toggle_wishlist', methods=['POST'])
 @login_required
 def toggle_wishlist():
+    """Add or remove a wishlist entry. Send "action": "add"/"remove" for an idempotent
+    request; without it the entry is toggled."""
     data = request.get_json()
     product_id = data.get('product_id')
+    action = data.get('action', 'toggle')
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Check if item already in wishlist
-    cursor.execute('SELECT id FROM wishlist WHERE user_id = ? AND product_id = ?', 
-                   (session['user_id'], product_id))
-    existing = cursor.fetchone()
-    
-    if existing:
-        # Remove from wishlist
-        cursor.execute('DELETE FROM wishlist WHERE id = ?', (existing[0],))
-        conn.commit()
+    previous = claim_idempotency_key(cursor, session['user_id'])
+    if previous is not None:
         conn.close()
-        return jsonify({'status': 'removed', 'message': 'Removed from wishlist'})
+        return jsonify(json.loads(previous or '{}'))
+    
+    removed = False
+    if action in ('remove', 'toggle'):
+        cursor.execute('DELETE FROM wishlist WHERE user_id = ? AND product_id = ?', 
+                       (session['user_id'], product_id))
+        removed = cursor.rowcount > 0
+    
+    if removed or action == 'remove':
+        result = {'status': 'removed', 'message': 'Removed from wishlist'}
     else:
-        # Add to wishlist
-        cursor.execute('INSERT INTO wishlist (user_id, product_id) VALUES (?, ?)', 
-                      (session['user_id'], product_id))
-        conn.commit()
-        conn.close()
-        return jsonify({'status': 'added', 'message': 'Added to wishlist'})
+        cursor.execute('''
+            INSERT INTO wishlist (user_id, product_id) VALUES (?, ?)
+            ON CONFLICT (user_id, product_id) DO NOTHING
+        ''', (session['user_id'], product_id))
+        if cursor.rowcount:
+            record_trending(cursor, [(product_id, 0, 1)])
+        result = {'status': 'added', 'message': 'Added to wishlist'}
+    
+    store_idempotent_response(cursor, session['user_id'], json.dumps(result))
+    conn.commit()
+    conn.close()
+    return jsonify(result)
 
 @app.route('/wishlist')
 @login_required
 def wishlist():
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
     cursor.execute('''
         SELECT w.id, p.id, p.name, p.price, p.images, p.category, p.description
@@ -1021,7 +2396,7 @@ def wishlist():
 @app.route('/get_wishlist_status/<int:product_id>')
 @login_required
 def get_wishlist_status(product_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
     cursor.execute('SELECT id FROM wishlist WHERE user_id = ? AND product_id = ?', 
                    (session['user_id'], product_id))
@@ -1030,13 +2405,41 @@ def get_wishlist_status(product_id):
     
     return jsonify({'in_wishlist': existing is not None})
 
+def get_wishlist_ids(cursor, user_id, product_ids):
+    """The subset of product_ids in the user's wishlist, via the (user_id, product_id) unique index"""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return set()
+    placeholders = ','.join('?' * len(product_ids))
+    cursor.execute(f'SELECT product_id FROM wishlist WHERE user_id = ? AND product_id IN ({placeholders})',
+                   [user_id] + product_ids)
+    return {row[0] for row in cursor.fetchall()}
+
+@app.route('/wishlist_status')
+@login_required
+def wishlist_status():
+    """Wishlist status for many products: /wishlist_status?ids=1,2,3"""
+    try:
+        product_ids = [int(product_id) for product_id in request.args.get('ids', '').split(',') if product_id]
+    except ValueError:
+        return jsonify({'error': 'ids must be a comma-separated list of product ids'}), 400
+    if len(product_ids) > WISHLIST_STATUS_MAX_IDS:
+        return jsonify({'error': f'At most {WISHLIST_STATUS_MAX_IDS} ids per request'}), 400
+    
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    wishlist_ids = get_wishlist_ids(cursor, session['user_id'], product_ids)
+    conn.close()
+    
+    return jsonify({'in_wishlist': sorted(wishlist_ids)})
+
 @app.route('/admin')
 @admin_required
 def admin():
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM products ORDER BY name')
-    products = cursor.fetchall()
+    cursor.execute(f'SELECT {PRODUCT_LISTING_COLUMNS} FROM product_listing ORDER BY name')
+    products = listing_rows(cursor.fetchall())
     conn.close()
     return render_template('admin.html', products=products)
 
@@ -1048,7 +2451,7 @@ def admin_analytics():
     # Get time period filter (default: month)
     period = request.args.get('period', 'month')
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(snapshot=True)
     cursor = conn.cursor()
     
     # Calculate date range based on period
@@ -1088,14 +2491,30 @@ def admin_analytics():
     # Calculate average order value
     avg_order_value = total_revenue / total_orders if total_orders > 0 else 0
     
-    # Get sales by status
+    # Get sales by status - all time comes straight from the counters
+    if period == 'all':
+        status_stats = sorted((status, count, amount)
+                              for status, (count, amount) in get_order_status_counts(cursor).items())
+    else:
+        cursor.execute('''
+            SELECT order_status, COUNT(*), SUM(total_amount)
+            FROM orders
+            WHERE order_date >= ?
+            GROUP BY order_status
+        ''', (start_date,))
+        status_stats = cursor.fetchall()
+    
+    # Orders shipped and delivered per day
     cursor.execute('''
-        SELECT order_status, COUNT(*), SUM(total_amount)
-        FROM orders
-        WHERE order_date >= ?
-        GROUP BY order_status
+        SELECT DATE(created_at) as date,
+               SUM(CASE WHEN to_status = 'shipped' THEN 1 ELSE 0 END),
+               SUM(CASE WHEN to_status = 'delivered' THEN 1 ELSE 0 END)
+        FROM order_events
+        WHERE created_at >= ? AND to_status IN ('shipped', 'delivered')
+        GROUP BY DATE(created_at)
+        ORDER BY date
     ''', (start_date,))
-    status_stats = cursor.fetchall()
+    fulfillment = cursor.fetchall()
     
     # Get top selling products
     cursor.execute('''
@@ -1153,11 +2572,123 @@ def admin_analytics():
                           total_products_sold=total_products_sold,
                           avg_order_value=avg_order_value,
                           status_stats=status_stats,
+                          fulfillment=fulfillment,
                           top_products=top_products,
                           daily_sales=daily_sales,
                           category_revenue=category_revenue,
                           recent_orders=recent_orders)
 
+@app.route('/admin/sql_stats')
+@admin_required
+def admin_sql_stats():
+    """Aggregated per-endpoint SQL statistics and the recent slow-query log"""
+    if request.args.get('reset') == '1':
+        with SQL_STATS_LOCK:
+            SQL_STATS.clear()
+            SLOW_QUERY_LOG.clear()
+
+    with SQL_STATS_LOCK:
+        endpoints = []
+        for endpoint, stats in SQL_STATS.items():
+            statements = sorted(stats['statements'].items(), key=lambda s: s[1]['total_ms'], reverse=True)
+            endpoints.append({
+                'endpoint': endpoint,
+                'requests': stats['requests'],
+                'queries': stats['queries'],
+                'avg_queries': round(stats['queries'] / stats['requests'], 2),
+                'max_queries': stats['max_queries'],
+                'db_ms': round(stats['db_ms'], 2),
+                'avg_db_ms': round(stats['db_ms'] / stats['requests'], 2),
+                'statements': [{
+                    'sql': sql,
+                    'count': s['count'],
+                    'total_ms': round(s['total_ms'], 2),
+                    'avg_ms': round(s['total_ms'] / s['count'], 2),
+                    'max_ms': round(s['max_ms'], 2)
+                } for sql, s in statements[:20]]
+            })
+        slow_queries = list(SLOW_QUERY_LOG)
+
+    endpoints.sort(key=lambda e: e['db_ms'], reverse=True)
+    return jsonify({
+        'slow_query_threshold_ms': SLOW_QUERY_THRESHOLD_MS,
+        'endpoints': endpoints,
+        'slow_queries': slow_queries
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint - aggregated across all worker processes"""
+    if METRICS_TOKEN:
+        if request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            return 'Unauthorized', 401
+    elif request.remote_addr not in ('127.0.0.1', '::1') and not session.get('is_admin'):
+        return 'Forbidden', 403
+
+    flush_metrics()
+    counters, histograms = collect_metrics()
+    response = make_response(render_metrics(counters, histograms))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
+
+@app.route('/admin/profiles', methods=['GET', 'POST'])
+@admin_required
+def admin_profiles():
+    """List collected profiles and change the sampling rate for all workers"""
+    if request.method == 'POST':
+        try:
+            sample_rate = float(request.form.get('sample_rate', 0))
+        except ValueError:
+            sample_rate = -1
+        if not 0 <= sample_rate <= 1:
+            flash('Sample rate must be between 0 and 1.', 'error')
+            return redirect(url_for('admin_profiles'))
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(profile_settings_path(), 'w') as f:
+            json.dump({'sample_rate': sample_rate}, f)
+        PROFILING_STATE['sample_rate'] = sample_rate
+        PROFILING_STATE['checked'] = time.time()
+        flash(f'Profiling sample rate set to {sample_rate:.2%}', 'success')
+        return redirect(url_for('admin_profiles'))
+
+    profiles = []
+    if os.path.isdir(PROFILE_DIR):
+        for filename in sorted(os.listdir(PROFILE_DIR)):
+            if not filename.endswith('.folded'):
+                continue
+            path = os.path.join(PROFILE_DIR, filename)
+            samples = 0
+            with open(path) as f:
+                for line in f:
+                    samples += int(line.rsplit(' ', 1)[1])
+            profiles.append({
+                'filename': filename,
+                'endpoint': filename[:-len('.folded')],
+                'samples': samples,
+                'size_kb': os.path.getsize(path) / 1024,
+                'modified': datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%d %H:%M:%S')
+            })
+
+    return render_template('admin_profiles.html', profiles=profiles,
+                          sample_rate=current_profile_sample_rate(),
+                          interval_ms=PROFILING_INTERVAL * 1000)
+
+@app.route('/admin/profiles/<filename>')
+@admin_required
+def download_profile(filename):
+    return send_from_directory(os.path.abspath(PROFILE_DIR), secure_filename(filename),
+                               as_attachment=True, mimetype='text/plain')
+
+@app.route('/admin/profiles/<filename>/delete', methods=['POST'])
+@admin_required
+def delete_profile(filename):
+    filepath = os.path.join(PROFILE_DIR, secure_filename(filename))
+    if filepath.endswith('.folded') and os.path.exists(filepath):
+        os.remove(filepath)
+        flash(f'Deleted {filename}', 'success')
+    return redirect(url_for('admin_profiles'))
+
 @app.route('/admin/upload_image', methods=['POST'])
 @admin_required
 def upload_image():
@@ -1169,15 +2700,13 @@ def upload_image():
         return jsonify({'error': 'No selected file'}), 400
     
     if file and allowed_file(file.filename):
-        # Create unique filename with timestamp
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-        unique_filename = timestamp + filename
-        
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        filename = store_image_blob(cursor, file)
+        conn.commit()
+        conn.close()
         
-        return jsonify({'filename': unique_filename, 'success': True}), 200
+        return jsonify({'filename': filename, 'success': True}), 200
     
     return jsonify({'error': 'File type not allowed'}), 400
 
@@ -1190,34 +2719,793 @@ def delete_image():
     if not filename:
         return jsonify({'error': 'No filename provided'}), 400
     
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    # The same file may be used by other products, and by this one until the edit is saved,
+    # so it is only dropped from disk by sweep_images once nothing references it
+    if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(filename))):
+        return jsonify({'error': 'File not found'}), 404
+    maybe_sweep_images()
+    
+    return jsonify({'success': True}), 200
+
+# ===== IMAGE STORAGE =====
+#
+# Uploads are stored once per distinct content: the file is named after the SHA-256 of its
+# bytes (computed while it is copied to disk), so the same photo uploaded for ten variants
+# is one file. image_blobs keeps a row per file with the number of references to it from
+# products.images and variant_images; every write to those goes through change_image_refs.
+# Nothing is deleted when a reference goes away. sweep_images later removes files that have
+# been unreferenced for IMAGE_GC_GRACE seconds, after checking the tables themselves, so a
+# drifted count can never delete an image still in use. Only files that came in through an
+# upload (upload_count > 0) are ever removed from disk.
+
+CONTENT_ADDRESSED_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+LEGACY_UPLOAD_NAME = re.compile(r'^\d{8}_\d{6}_.+|.+_\d{10}\.[A-Za-z0-9]+$')  # names the old upload routes gave
+
+def is_uploaded_name(filename):
+    return bool(CONTENT_ADDRESSED_NAME.match(filename) or LEGACY_UPLOAD_NAME.match(filename))
+
+class HashingFile:
+    """A temporary file in the upload folder that hashes everything written to it"""
+    
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.upload')
+        self.file = os.fdopen(fd, 'w+b')
+        self.digest = hashlib.sha256()
+        self.size = 0
+    
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+    
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+    
+    def discard(self):
+        """Close and remove the file unless it has been moved into place"""
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def image_extension(filename):
+    ext = os.path.splitext(secure_filename(filename))[1].lower()
+    return '.jpg' if ext == '.jpeg' else ext
+
+def store_image_blob(cursor, file):
+    """Save an uploaded file under the hash of its contents and return the stored filename.
+    An upload whose content is already stored reuses the existing file."""
+    sink = file.stream if isinstance(file.stream, HashingFile) else None
+    try:
+        if sink is None:
+            sink = HashingFile()
+            for chunk in iter(lambda: file.stream.read(IMAGE_UPLOAD_CHUNK), b''):
+                sink.write(chunk)
+        sink.file.close()
+        return place_image_blob(cursor, sink.path, sink.digest.hexdigest(), sink.size,
+                                image_extension(file.filename))
+    finally:
+        if sink is not None:
+            sink.discard()
+
+def place_image_blob(cursor, path, sha256, size, ext):
+    """Register the file at path, whose contents hash to sha256, and move it into the upload
+    folder under that name; if the content is already stored the file is deleted instead."""
+    filename = sha256 + ext
+    
+    # Upsert before placing the file: a sweep deleting this blob holds the row until it has
+    # removed the file, so once the upsert returns the file is ours to keep or recreate
+    cursor.execute('''
+        INSERT INTO image_blobs (filename, size_bytes, ref_count, upload_count, released_at)
+        VALUES (?, ?, 0, 1, ?)
+        ON CONFLICT (filename) DO UPDATE
+        SET upload_count = image_blobs.upload_count + 1,
+            size_bytes = excluded.size_bytes,
+            released_at = CASE WHEN image_blobs.ref_count > 0 THEN NULL ELSE excluded.released_at END
+        RETURNING upload_count
+    ''', (filename, size, time.time()))
+    duplicate = cursor.fetchone()[0] > 1
+    
+    target = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if os.path.exists(target):
+        os.remove(path)
+    else:
+        os.chmod(path, 0o644)  # mkstemp files are private to the app user; uploads are public
+        shutil.move(path, target)
+    
+    inc_counter('image_uploads_total', {'result': 'duplicate' if duplicate else 'stored'})
+    return filename
+
+def change_image_refs(cursor, removed=(), added=()):
+    """Record that references to the `removed` filenames went away and `added` ones appeared.
+    Both are lists of filenames; a name listed twice counts twice."""
+    delta = Counter(name for name in added if name)
+    delta.subtract(name for name in removed if name)
+    gained = [(name, count) for name, count in delta.items() if count > 0]
+    lost = [(name, -count) for name, count in delta.items() if count < 0]
+    
+    if gained:
+        cursor.executemany('''
+            INSERT INTO image_blobs (filename, ref_count, upload_count) VALUES (?, ?, ?)
+            ON CONFLICT (filename) DO UPDATE
+            SET ref_count = image_blobs.ref_count + excluded.ref_count, released_at = NULL
+        ''', [(name, count, int(is_uploaded_name(name))) for name, count in gained])
+    if lost:
+        now = time.time()
+        cursor.executemany('''
+            UPDATE image_blobs
+            SET ref_count = ref_count - ?,
+                released_at = CASE WHEN ref_count - ? > 0 THEN NULL ELSE ? END
+            WHERE filename = ?
+        ''', [(count, count, now, name) for name, count in lost])
+
+def count_image_references(cursor, filenames=None):
+    """Counter of references per filename from products.images and variant_images, read from
+    the tables themselves. Limited to `filenames` when given."""
+    references = Counter()
+    if filenames is None:
+        cursor.execute('SELECT images FROM products')
+        for (images,) in cursor.fetchall():
+            references.update(split_image_list(images))
+        cursor.execute('SELECT image_path, COUNT(*) FROM variant_images GROUP BY image_path')
+        for image_path, count in cursor.fetchall():
+            references[image_path] += count
+        return references
+    
+    filenames = sorted(set(filenames))
+    if not filenames:
+        return references
+    cursor.execute(f"SELECT images FROM products WHERE {' OR '.join(['images LIKE ?'] * len(filenames))}",
+                   ['%' + name + '%' for name in filenames])
+    wanted = set(filenames)
+    for (images,) in cursor.fetchall():
+        references.update(name for name in split_image_list(images) if name in wanted)
+    cursor.execute(f'''
+        SELECT image_path, COUNT(*) FROM variant_images
+        WHERE image_path IN ({','.join('?' * len(filenames))})
+        GROUP BY image_path
+    ''', filenames)
+    for image_path, count in cursor.fetchall():
+        references[image_path] += count
+    return references
+
+def sweep_images(limit=IMAGE_GC_BATCH):
+    """Delete up to `limit` images unreferenced for IMAGE_GC_GRACE seconds.
+    Returns (blobs examined, filenames removed from disk)."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cutoff = time.time() - IMAGE_GC_GRACE
+    cursor.execute('''
+        SELECT filename FROM image_blobs
+        WHERE released_at < ? AND ref_count <= 0
+        ORDER BY released_at
+        LIMIT ?
+    ''', (cutoff, limit))
+    candidates = [row[0] for row in cursor.fetchall()]
+    if not candidates:
+        conn.close()
+        return 0, []
+    
+    # A count that drifted from the tables is repaired instead of trusted
+    references = count_image_references(cursor, candidates)
+    if references:
+        cursor.executemany('UPDATE image_blobs SET ref_count = ?, released_at = NULL WHERE filename = ?',
+                           [(count, name) for name, count in references.items()])
+    garbage = [name for name in candidates if not references[name]]
+    
+    removed = []
+    if garbage:
+        cursor.execute(f'''
+            DELETE FROM image_blobs
+            WHERE filename IN ({','.join('?' * len(garbage))}) AND ref_count <= 0 AND released_at < ?
+            RETURNING filename, upload_count
+        ''', garbage + [cutoff])
+        # Files go before the commit, while the deleted rows still hold off a re-upload of the same image
+        for filename, upload_count in cursor.fetchall():
+            if upload_count <= 0:
+                continue  # registered by reference only, e.g. a bundled static image
+            remove_image_derivatives(filename)
+            try:
+                os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                removed.append(filename)
+            except FileNotFoundError:
+                pass
+    conn.commit()
+    conn.close()
+    return len(candidates), removed
+
+def maybe_sweep_images():
+    """Run a small sweep on roughly 1 in 100 calls, for routes that drop image references"""
+    if random.random() < 0.01:
+        sweep_images()
+
+def rebuild_image_refs(cursor):
+    """Reset every ref_count from the tables; blobs that lose their last reference start their
+    grace period. Also registers the images of a database that predates image_blobs."""
+    references = count_image_references(cursor)
+    cursor.execute('SELECT filename, ref_count FROM image_blobs')
+    current = dict(cursor.fetchall())
+    now = time.time()
+    cursor.executemany('''
+        INSERT INTO image_blobs (filename, size_bytes, ref_count, upload_count) VALUES (?, ?, ?, ?)
+        ON CONFLICT (filename) DO UPDATE SET ref_count = excluded.ref_count, released_at = NULL
+    ''', [(name, image_file_size(name), count, int(is_uploaded_name(name)))
+          for name, count in references.items() if current.get(name) != count])
+    cursor.executemany('UPDATE image_blobs SET ref_count = 0, released_at = ? WHERE filename = ?',
+                       [(now, name) for name, count in current.items() if count > 0 and not references[name]])
+
+def image_file_size(filename):
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    return os.path.getsize(path) if os.path.isfile(path) else None
+
+def image_blob_stats(cursor):
+    cursor.execute('''
+        SELECT COUNT(*), COALESCE(SUM(size_bytes), 0), COALESCE(SUM(upload_count), 0),
+               COALESCE(SUM(CASE WHEN upload_count > 1 THEN (upload_count - 1) * size_bytes ELSE 0 END), 0),
+               COALESCE(SUM(CASE WHEN ref_count > 1 THEN 1 ELSE 0 END), 0),
+               COALESCE(SUM(CASE WHEN ref_count <= 0 THEN 1 ELSE 0 END), 0),
+               COALESCE(SUM(CASE WHEN ref_count <= 0 THEN size_bytes ELSE 0 END), 0)
+        FROM image_blobs
+        WHERE upload_count > 0
+    ''')
+    files, stored_bytes, uploads, saved_bytes, shared, unreferenced, unreferenced_bytes = cursor.fetchone()
+    return {
+        'files': files,
+        'stored_bytes': stored_bytes,
+        'uploads': uploads,
+        'duplicate_uploads': uploads - files,
+        'bytes_saved': saved_bytes,
+        'shared_files': shared,
+        'unreferenced_files': unreferenced,
+        'unreferenced_bytes': unreferenced_bytes,
+    }
+
+@app.route('/admin/image_stats')
+@admin_required
+def admin_image_stats():
+    """Deduplication and garbage collection statistics for uploaded images"""
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    stats = image_blob_stats(cursor)
+    conn.close()
+    return jsonify(stats)
+
+@app.cli.command('gc-images')
+def gc_images_command():
+    """Recount image references from the tables, then delete images unused for IMAGE_GC_GRACE"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        rebuild_image_refs(cursor)
+        
+        # Content-named files with no row at all were left behind by an interrupted upload
+        cursor.execute('SELECT filename FROM image_blobs')
+        known = {row[0] for row in cursor.fetchall()}
+        conn.commit()
+    finally:
+        conn.close()
     
-    if os.path.exists(filepath):
+    cutoff = time.time() - IMAGE_GC_GRACE
+    orphans = 0
+    with os.scandir(app.config['UPLOAD_FOLDER']) as it:
+        for entry in it:
+            if (CONTENT_ADDRESSED_NAME.match(entry.name) and entry.name not in known
+                    and entry.stat().st_mtime < cutoff):
+                os.remove(entry.path)
+                orphans += 1
+    
+    removed = 0
+    while True:
+        examined, batch = sweep_images()
+        removed += len(batch)
+        if examined < IMAGE_GC_BATCH:
+            break
+    
+    conn = get_db_connection(readonly=True)
+    stats = image_blob_stats(conn.cursor())
+    conn.close()
+    click.echo(f'Removed {removed} unused images and {orphans} orphaned files')
+    click.echo(json.dumps(stats, indent=2))
+
+# ===== END IMAGE STORAGE =====
+
+# ===== IMAGE SERVING =====
+#
+# /images/<size>/<filename> serves an uploaded image scaled to one of IMAGE_SIZES. The first
+# request renders the derivative into IMAGE_CACHE_DIR; later ones are a stat and a sendfile.
+# Derivatives are named after the source's path, length and mtime, so a replaced upload is
+# never served stale. Serving a derivative bumps its mtime (at most every
+# IMAGE_CACHE_TOUCH_INTERVAL seconds) and eviction removes the oldest mtimes first once the
+# cache outgrows IMAGE_CACHE_MAX_BYTES.
+
+IMAGE_CACHE_TOUCH_INTERVAL = 3600
+IMAGE_CACHE_STATE = {'bytes': None}  # this worker's running estimate of the cache size
+IMAGE_CACHE_LOCK = threading.Lock()
+IMAGE_EVICTION_LOCK = threading.Lock()
+IMAGE_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.webp': 'WEBP'}  # GIFs are served as uploaded
+
+def image_cache_path(source, size):
+    """Where the derivative of source at size lives, or None for formats that are not resized"""
+    ext = os.path.splitext(source)[1].lower()
+    if ext not in IMAGE_FORMATS:
+        return None
+    stat = os.stat(source)
+    digest = hashlib.sha1(f'{source}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+    return os.path.join(IMAGE_CACHE_DIR, size, digest + ext)
+
+def remove_image_derivatives(filename):
+    """Delete the cached derivatives of an upload at every size. Must run while the upload is
+    still on disk, since derivative names come from its length and mtime."""
+    source = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if source is None or not os.path.isfile(source):
+        return
+    freed = 0
+    for size in IMAGE_SIZES:
+        target = image_cache_path(source, size)
+        if target is None:
+            return
         try:
-            os.remove(filepath)
-            return jsonify({'success': True}), 200
-        except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            length = os.path.getsize(target)
+            os.remove(target)
+            freed += length
+        except FileNotFoundError:
+            pass
+    with IMAGE_CACHE_LOCK:
+        if IMAGE_CACHE_STATE['bytes'] is not None:
+            IMAGE_CACHE_STATE['bytes'] -= freed
+
+def render_image(source, target, size):
+    """Write source scaled to size at target and return the bytes written"""
+    width, height, mode = IMAGE_SIZES[size]
+    image_format = IMAGE_FORMATS[os.path.splitext(target)[1].lower()]
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image_format == 'JPEG' or image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if image_format != 'JPEG' and image.mode in ('LA', 'P', 'PA') else 'RGB')
+        if mode == 'crop':
+            image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        else:
+            image.thumbnail((width, height), Image.LANCZOS)
     
-    return jsonify({'error': 'File not found'}), 404
+    # Write to a temporary file first so concurrent requests never see a partial image
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            image.save(temp_file, image_format, quality=85, optimize=True)
+        os.replace(temp_path, target)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return os.path.getsize(target)
 
-# ===== PRODUCT VARIANT MANAGEMENT ROUTES =====
+def evict_image_cache(keep=None):
+    """Remove the least recently served derivatives, other than keep, until the cache is back
+    under 90% of IMAGE_CACHE_MAX_BYTES. Returns the cache size afterwards."""
+    entries = []
+    for size in IMAGE_SIZES:
+        directory = os.path.join(IMAGE_CACHE_DIR, size)
+        if not os.path.isdir(directory):
+            continue
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    total = sum(length for _, length, _ in entries)
+    if total > IMAGE_CACHE_MAX_BYTES:
+        for _, length, path in sorted(entries):
+            if total <= IMAGE_CACHE_MAX_BYTES * 0.9:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= length
+            inc_counter('image_cache_evictions_total')
+    return total
 
-@app.route('/api/product/<int:product_id>/variants')
-def get_product_variants(product_id):
-    """Get all variants and their images for a product"""
-    conn = sqlite3.connect('database.db')
+def note_image_cache_bytes(target, added):
+    """Account for a new derivative and evict when this worker thinks the cache is over budget.
+    Other workers write to the same directory, so the estimate is re-read from disk now and then."""
+    with IMAGE_CACHE_LOCK:
+        if IMAGE_CACHE_STATE['bytes'] is not None and random.random() >= 0.01:
+            IMAGE_CACHE_STATE['bytes'] += added
+            if IMAGE_CACHE_STATE['bytes'] <= IMAGE_CACHE_MAX_BYTES:
+                return
+    
+    if IMAGE_EVICTION_LOCK.acquire(blocking=False):
+        try:
+            total = evict_image_cache(keep=target)
+            with IMAGE_CACHE_LOCK:
+                IMAGE_CACHE_STATE['bytes'] = total
+        finally:
+            IMAGE_EVICTION_LOCK.release()
+
+def cached_image(filename, size):
+    """Path of filename scaled to size, rendering it on a miss. Falls back to the original when
+    the image cannot be resized; None when there is no such upload."""
+    source = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if source is None or not os.path.isfile(source):
+        return None
+    target = image_cache_path(source, size) if PIL_AVAILABLE else None
+    if target is None:
+        return source
+    
+    try:
+        stat = os.stat(target)
+    except FileNotFoundError:
+        stat = None
+    record_cache_access('images', stat is not None)
+    if stat is not None:
+        if time.time() - stat.st_mtime > IMAGE_CACHE_TOUCH_INTERVAL:
+            try:
+                os.utime(target)  # recently served, keep it through the next eviction
+            except OSError:
+                pass
+        return target
+    
+    try:
+        added = render_image(source, target, size)
+    except (OSError, Image.DecompressionBombError) as e:
+        print(f"Could not resize {filename}: {e}")
+        return source
+    note_image_cache_bytes(target, added)
+    return target
+
+@app.route('/images/<size>/<path:filename>')
+def product_image(size, filename):
+    """An uploaded image at one of IMAGE_SIZES. Upload names are unique, so responses are
+    cacheable by browsers and CDNs for IMAGE_MAX_AGE."""
+    if size not in IMAGE_SIZES:
+        return jsonify({'error': 'Unknown image size'}), 404
+    path = cached_image(filename, size)
+    if path is None:
+        return jsonify({'error': 'Image not found'}), 404
+    return send_file(os.path.abspath(path), max_age=IMAGE_MAX_AGE, conditional=True)
+
+@app.context_processor
+def inject_image_url():
+    """image_url(filename, size) for templates"""
+    return {'image_url': lambda filename, size='card': url_for('product_image', size=size, filename=(filename or 'tshirt.jpg').strip())}
+
+@app.cli.command('warm-image-cache')
+@click.option('--limit', default=6, help='Featured products to warm (the home page shows 6)')
+def warm_image_cache_command(limit):
+    """Render the card, detail and thumbnail images of the featured products ahead of traffic"""
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
+    products = listing_rows(get_trending_products(cursor, limit))
+    conn.close()
     
-    # Get product info
-    cursor.execute('SELECT * FROM products WHERE id = ?', (product_id,))
-    product = cursor.fetchone()
+    rendered = 0
+    for product in products:
+        wanted = [(product[12], 'card')]
+        wanted += [(image, size) for image in split_image_list(product[6]) for size in ('detail', 'thumb')]
+        for filename, size in wanted:
+            if cached_image(filename, size) is not None:
+                rendered += 1
+    click.echo(f'Warmed {rendered} images for {len(products)} featured products')
+
+# ===== END IMAGE SERVING =====
+
+# ===== BULK IMAGE UPLOADS =====
+#
+# The admin product form sends small images together to /admin/upload_images and large
+# originals in chunks through /admin/uploads. Neither holds a file in memory: the multipart
+# parser writes each part straight into a HashingFile, and each chunk is copied from the
+# request stream into a partial file in IMAGE_PARTIAL_DIR. A chunked upload can be resumed
+# from any worker: GET /admin/uploads/<id> says how many bytes have arrived. Once a file is
+# stored, every size in IMAGE_SIZES is pre-rendered on IMAGE_PROCESSING_POOL threads.
+
+IMAGE_PROCESSING_POOL = [None]  # ThreadPoolExecutor, created on first use
+IMAGE_PROCESSING_LOCK = threading.Lock()
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+def process_uploaded_images(filenames):
+    """Render the resized copies of freshly stored images in the background"""
+    if not PIL_AVAILABLE or not filenames:
+        return
+    with IMAGE_PROCESSING_LOCK:
+        if IMAGE_PROCESSING_POOL[0] is None:
+            IMAGE_PROCESSING_POOL[0] = ThreadPoolExecutor(max_workers=IMAGE_PROCESSING_WORKERS,
+                                                          thread_name_prefix='image-processing')
+        pool = IMAGE_PROCESSING_POOL[0]
+    for filename in filenames:
+        for size in IMAGE_SIZES:
+            pool.submit(cached_image, filename, size)
+
+@atexit.register
+def shutdown_image_processing_pool():
+    if IMAGE_PROCESSING_POOL[0] is not None:
+        IMAGE_PROCESSING_POOL[0].shutdown(wait=False, cancel_futures=True)
+
+@app.route('/admin/upload_images', methods=['POST'])
+@admin_required
+def upload_images():
+    """Store every file sent in the `files` fields of one multipart request, up to
+    IMAGE_BATCH_MAX_BYTES in total. Returns {'files': [{'name', 'filename' or 'error'}]} in order."""
+    sinks = []
     
-    if not product:
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        sink = HashingFile()
+        sinks.append(sink)
+        return sink
+    
+    parser = FormDataParser(stream_factory=stream_factory, max_content_length=IMAGE_BATCH_MAX_BYTES, silent=False)
+    try:
+        try:
+            _, _, files = parser.parse_from_environ(request.environ)
+        except RequestEntityTooLarge:
+            return jsonify({'error': f'At most {IMAGE_BATCH_MAX_BYTES // (1024 * 1024)}MB per request'}), 413
+        
+        uploads = [file for file in files.getlist('files') if file.filename]
+        if not uploads:
+            return jsonify({'error': 'No files provided'}), 400
+        
+        results = []
+        stored = []
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        for file in uploads:
+            if not allowed_file(file.filename):
+                results.append({'name': file.filename, 'error': 'File type not allowed'})
+                continue
+            filename = store_image_blob(cursor, file)
+            results.append({'name': file.filename, 'filename': filename})
+            stored.append(filename)
+        conn.commit()
         conn.close()
-        return jsonify({'error': 'Product not found'}), 404
+    finally:
+        for sink in sinks:
+            sink.discard()
+    
+    process_uploaded_images(list(dict.fromkeys(stored)))
+    return jsonify({'success': True, 'files': results}), 200
+
+def partial_upload_path(upload_id):
+    return os.path.join(IMAGE_PARTIAL_DIR, upload_id + '.part')
+
+def sweep_partial_uploads():
+    """Drop chunked uploads nobody has added to for IMAGE_UPLOAD_TTL seconds"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM image_uploads WHERE updated_at < ? RETURNING id', (time.time() - IMAGE_UPLOAD_TTL,))
+    for (upload_id,) in cursor.fetchall():
+        if os.path.exists(partial_upload_path(upload_id)):
+            os.remove(partial_upload_path(upload_id))
+    conn.commit()
+    conn.close()
+
+@app.route('/admin/uploads', methods=['POST'])
+@admin_required
+def start_chunked_upload():
+    """Start a resumable upload. Body: {"filename": ..., "size": <bytes>}. Send the bytes with
+    PUT /admin/uploads/<upload_id> and a Content-Range header, in pieces of at most chunk_size."""
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename') or ''
+    size = data.get('size')
+    
+    if not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'error': 'size must be a positive number of bytes'}), 400
+    if size > IMAGE_UPLOAD_MAX_BYTES:
+        return jsonify({'error': f'Images can be at most {IMAGE_UPLOAD_MAX_BYTES // (1024 * 1024)}MB'}), 413
+    
+    if random.random() < 0.01:
+        sweep_partial_uploads()
+    
+    upload_id = secrets.token_urlsafe(16)
+    os.makedirs(IMAGE_PARTIAL_DIR, exist_ok=True)
+    open(partial_upload_path(upload_id), 'wb').close()
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO image_uploads (id, filename, total_bytes, received_bytes, updated_at)
+        VALUES (?, ?, ?, 0, ?)
+    ''', (upload_id, filename, size, time.time()))
+    conn.commit()
+    conn.close()
+    
+    return jsonify({'upload_id': upload_id, 'received': 0, 'chunk_size': IMAGE_CHUNK_SIZE}), 201
+
+@app.route('/admin/uploads/<upload_id>', methods=['GET'])
+@admin_required
+def chunked_upload_status(upload_id):
+    """How many bytes of an upload have arrived, for resuming after a failed chunk"""
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    cursor.execute('SELECT total_bytes, received_bytes FROM image_uploads WHERE id = ?', (upload_id,))
+    upload = cursor.fetchone()
+    conn.close()
+    
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({'upload_id': upload_id, 'size': upload[0], 'received': upload[1]})
+
+@app.route('/admin/uploads/<upload_id>', methods=['PUT'])
+@admin_required
+def upload_chunk(upload_id):
+    """Append the request body at the range given by Content-Range: bytes <first>-<last>/<size>.
+    A chunk must start where the previous one ended; otherwise 409 with the bytes received.
+    The last chunk stores the image and returns its filename."""
+    match = CONTENT_RANGE.match(request.headers.get('Content-Range', ''))
+    if not match:
+        return jsonify({'error': 'Content-Range: bytes <first>-<last>/<size> is required'}), 400
+    first, last, total = (int(value) for value in match.groups())
+    length = last - first + 1
+    if length <= 0 or request.content_length != length:
+        return jsonify({'error': 'Content-Range does not match the body length'}), 400
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT filename, total_bytes, received_bytes FROM image_uploads WHERE id = ?', (upload_id,))
+    upload = cursor.fetchone()
+    if not upload:
+        conn.close()
+        return jsonify({'error': 'Upload not found'}), 404
+    filename, total_bytes, received = upload
+    if total != total_bytes or last >= total_bytes:
+        conn.close()
+        return jsonify({'error': f'The upload is {total_bytes} bytes'}), 400
+    if first != received:
+        conn.close()
+        return jsonify({'error': 'Chunk does not start at the next byte', 'received': received}), 409
+    
+    # Copy the body to its place in the partial file a piece at a time
+    written = 0
+    with open(partial_upload_path(upload_id), 'r+b') as partial:
+        partial.seek(first)
+        for chunk in iter(lambda: request.stream.read(IMAGE_UPLOAD_CHUNK), b''):
+            partial.write(chunk)
+            written += len(chunk)
+    if written != length:
+        conn.close()
+        return jsonify({'error': 'Chunk ended early', 'received': received}), 400
+    
+    cursor.execute('''
+        UPDATE image_uploads SET received_bytes = ?, updated_at = ?
+        WHERE id = ? AND received_bytes = ?
+        RETURNING received_bytes
+    ''', (last + 1, time.time(), upload_id, first))
+    if not cursor.fetchone():
+        # Another request for the same range got there first
+        cursor.execute('SELECT received_bytes FROM image_uploads WHERE id = ?', (upload_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if not row:
+            return jsonify({'error': 'Upload not found'}), 404
+        return jsonify({'error': 'Chunk was already received', 'received': row[0]}), 409
+    
+    if last + 1 < total_bytes:
+        conn.commit()
+        conn.close()
+        return jsonify({'upload_id': upload_id, 'received': last + 1})
+    
+    # Last chunk: hash the assembled file and store it like any other upload
+    path = partial_upload_path(upload_id)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as partial:
+        for chunk in iter(lambda: partial.read(IMAGE_UPLOAD_CHUNK), b''):
+            digest.update(chunk)
+    stored = place_image_blob(cursor, path, digest.hexdigest(), total_bytes, image_extension(filename))
+    cursor.execute('DELETE FROM image_uploads WHERE id = ?', (upload_id,))
+    conn.commit()
+    conn.close()
     
-    # Get variants
+    process_uploaded_images([stored])
+    return jsonify({'success': True, 'upload_id': upload_id, 'received': total_bytes, 'filename': stored})
+
+# ===== END BULK IMAGE UPLOADS =====
+
+# ===== CATALOG CACHE =====
+
+VARIANT_CACHE = {}  # product_id -> (catalog_version, variants payload)
+VARIANT_CACHE_LOCK = threading.Lock()
+
+def get_catalog_version(cursor):
+    cursor.execute('SELECT version FROM catalog_version WHERE id = 1')
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def invalidate_product_caches(cursor, product_ids):
+    """Refresh the listing projection and mark cached data for the given products stale;
+    call once per write transaction, before commit"""
+    refresh_product_listing(cursor, product_ids)
+    cursor.execute('UPDATE catalog_version SET version = version + 1 WHERE id = 1')
+
+def split_attribute_list(value):
+    """Split a comma-separated column into trimmed, de-duplicated values"""
+    values = []
+    for item in (value or '').split(','):
+        item = item.strip()
+        if item and item not in values:
+            values.append(item)
+    return values
+
+def refresh_product_listing(cursor, product_ids):
+    """Recompute product_listing rows for the given products (deleted products lose their row)"""
+    product_ids = [int(product_id) for product_id in product_ids]
+    for start in range(0, len(product_ids), IMPORT_BATCH_SIZE):
+        chunk = product_ids[start:start + IMPORT_BATCH_SIZE]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'DELETE FROM product_listing WHERE product_id IN ({placeholders})', chunk)
+        cursor.execute(f'''
+            SELECT p.id, p.name, p.category, p.subcategory, p.price, p.description, p.images, p.stock,
+                   p.sizes, p.colors, p.gender, p.has_variants,
+                   COUNT(v.id), MIN(COALESCE(v.price, p.price)), MAX(COALESCE(v.price, p.price)),
+                   COALESCE(SUM(v.stock), 0),
+                   (SELECT vi.image_path
+                    FROM variant_images vi
+                    JOIN product_variants pv ON pv.id = vi.variant_id
+                    WHERE pv.product_id = p.id
+                    ORDER BY pv.display_order, pv.id, vi.is_primary DESC, vi.display_order, vi.id
+                    LIMIT 1)
+            FROM products p
+            LEFT JOIN product_variants v ON v.product_id = p.id
+            WHERE p.id IN ({placeholders})
+            GROUP BY p.id
+        ''', chunk)
+        
+        rows = []
+        for product in cursor.fetchall():
+            variant_count = product[12]
+            images = split_attribute_list(product[6])
+            if not images:
+                images = [product[16] or 'tshirt.jpg']
+            total_stock = product[15] if variant_count else (product[7] or 0)
+            rows.append((product[0], product[1], product[2], product[3], product[4], product[5],
+                         ','.join(images), product[7], ','.join(split_attribute_list(product[8])),
+                         ','.join(split_attribute_list(product[9])), product[10], bool(product[11]),
+                         images[0], len(images),
+                         product[13] if variant_count else product[4],
+                         product[14] if variant_count else product[4],
+                         total_stock, total_stock > 0, variant_count))
+        if rows:
+            cursor.executemany(f'''
+                INSERT INTO product_listing ({PRODUCT_LISTING_COLUMNS})
+                VALUES ({','.join('?' * 19)})
+            ''', rows)
+
+def rebuild_product_listing(cursor):
+    """Recompute the whole listing projection"""
+    cursor.execute('DELETE FROM product_listing')
+    cursor.execute('SELECT id FROM products')
+    refresh_product_listing(cursor, [row[0] for row in cursor.fetchall()])
+
+def listing_rows(rows):
+    """Turn product_listing rows into template rows with images, sizes and colors as lists"""
+    return [row[:6] + (row[6].split(','),) + row[7:8]
+            + ((row[8].split(',') if row[8] else []), (row[9].split(',') if row[9] else []))
+            + row[10:] for row in rows]
+
+def variant_product_ids(cursor, variant_ids=(), image_ids=()):
+    """Product ids owning the given variants and variant images"""
+    product_ids = set()
+    if variant_ids:
+        placeholders = ','.join('?' * len(variant_ids))
+        cursor.execute(f'SELECT DISTINCT product_id FROM product_variants WHERE id IN ({placeholders})',
+                       list(variant_ids))
+        product_ids.update(row[0] for row in cursor.fetchall())
+    if image_ids:
+        placeholders = ','.join('?' * len(image_ids))
+        cursor.execute(f'''
+            SELECT DISTINCT v.product_id
+            FROM variant_images vi
+            JOIN product_variants v ON v.id = vi.variant_id
+            WHERE vi.id IN ({placeholders})
+        ''', list(image_ids))
+        product_ids.update(row[0] for row in cursor.fetchall())
+    return product_ids
+
+def load_product_variants(cursor, product_id):
+    """Variants of a product with their images, in display order"""
     cursor.execute('''
         SELECT id, variant_name, variant_type, price, stock, sku, display_order
         FROM product_variants
@@ -1225,38 +3513,283 @@ def get_product_variants(product_id):
         ORDER BY display_order, id
     ''', (product_id,))
     variants = cursor.fetchall()
+    if not variants:
+        return []
+    
+    placeholders = ','.join('?' * len(variants))
+    cursor.execute(f'''
+        SELECT variant_id, id, image_path, display_order, is_primary, alt_text
+        FROM variant_images
+        WHERE variant_id IN ({placeholders})
+        ORDER BY display_order, id
+    ''', [variant[0] for variant in variants])
+    images_by_variant = {}
+    for img in cursor.fetchall():
+        images_by_variant.setdefault(img[0], []).append({
+            'id': img[1],
+            'path': img[2],
+            'order': img[3],
+            'is_primary': img[4],
+            'alt_text': img[5]
+        })
+    
+    return [{
+        'id': variant[0],
+        'name': variant[1],
+        'type': variant[2],
+        'price': variant[3],
+        'stock': variant[4],
+        'sku': variant[5],
+        'display_order': variant[6],
+        'images': images_by_variant.get(variant[0], [])
+    } for variant in variants]
+
+# ===== END CATALOG CACHE =====
+
+# ===== STOCK AND PRICING =====
+#
+# Sellable stock lives on the variant when a product has variants, otherwise on the
+# product. product_listing carries the aggregates (min/max price, total stock, in-stock)
+# and is adjusted by delta at checkout instead of being recomputed.
+
+def available_stock(cursor, product_id, variant_id=0):
+    """Units that can be sold, or None when the product needs a variant chosen"""
+    if variant_id:
+        cursor.execute('SELECT stock FROM product_variants WHERE id = ? AND product_id = ?',
+                       (variant_id, product_id))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    
+    # Variants are looked up directly rather than through variant_count, which may lag
+    cursor.execute('''
+        SELECT stock, EXISTS (SELECT 1 FROM product_variants v WHERE v.product_id = l.product_id)
+        FROM product_listing l WHERE product_id = ?
+    ''', (product_id,))
+    row = cursor.fetchone()
+    if not row:
+        return 0
+    return None if row[1] else row[0]
+
+def apply_stock_sale(cursor, items):
+    """Adjust product_listing for sold cart rows (item[1] product_id, item[4] quantity, item[5] variant_id)"""
+    deltas = {}  # product_id -> [product quantity, variant quantity]
+    for item in items:
+        delta = deltas.setdefault(item[1], [0, 0])
+        delta[1 if item[5] else 0] += item[4]
+    
+    cursor.executemany('''
+        UPDATE product_listing
+        SET stock = stock - ?,
+            total_stock = total_stock - ? - CASE WHEN variant_count = 0 THEN ? ELSE 0 END,
+            in_stock = (total_stock - ? - CASE WHEN variant_count = 0 THEN ? ELSE 0 END > 0)
+        WHERE product_id = ?
+    ''', [(product_qty, variant_qty, product_qty, variant_qty, product_qty, product_id)
+          for product_id, (product_qty, variant_qty) in deltas.items()])
+    
+    # Cached variant payloads include per-variant stock
+    if any(variant_qty for _, variant_qty in deltas.values()):
+        cursor.execute('UPDATE catalog_version SET version = version + 1 WHERE id = 1')
+
+def get_product_availability(cursor, product_id):
+    """Aggregated price range and stock for a product page"""
+    cursor.execute('''
+        SELECT min_price, max_price, total_stock, in_stock, variant_count
+        FROM product_listing
+        WHERE product_id = ?
+    ''', (product_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {
+        'min_price': row[0],
+        'max_price': row[1],
+        'total_stock': row[2],
+        'in_stock': bool(row[3]),
+        'variant_count': row[4]
+    }
+
+# ===== END STOCK AND PRICING =====
+
+# ===== IDEMPOTENCY KEYS =====
+#
+# Clients send an Idempotency-Key header (or idempotency_key form field) on write requests.
+# The key is claimed inside the request's own transaction, so the claim commits or rolls
+# back with the write; a concurrent duplicate waits on the primary key and then sees it.
+
+def get_idempotency_key():
+    key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+    return key[:128] if key else None
+
+def claim_idempotency_key(cursor, user_id):
+    """Claim the request's key. Returns None when there is no key or it is new, otherwise
+    the stored response of the earlier request ('' when it stored none)."""
+    key = get_idempotency_key()
+    if not key:
+        return None
+    
+    now = time.time()
+    if random.random() < 0.01:
+        cursor.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (now - IDEMPOTENCY_KEY_TTL,))
     
-    result = []
-    for variant in variants:
-        variant_id = variant[0]
+    cursor.execute('''
+        INSERT INTO idempotency_keys (user_id, idempotency_key, created_at) VALUES (?, ?, ?)
+        ON CONFLICT (user_id, idempotency_key) DO NOTHING
+    ''', (user_id, key, now))
+    if cursor.rowcount:
+        return None
+    
+    cursor.execute('SELECT response FROM idempotency_keys WHERE user_id = ? AND idempotency_key = ?',
+                   (user_id, key))
+    row = cursor.fetchone()
+    return (row[0] or '') if row else ''
+
+def store_idempotent_response(cursor, user_id, response):
+    key = get_idempotency_key()
+    if key:
+        cursor.execute('UPDATE idempotency_keys SET response = ? WHERE user_id = ? AND idempotency_key = ?',
+                       (response, user_id, key))
+
+@app.context_processor
+def inject_idempotency_key():
+    """new_idempotency_key() for forms: one key per rendered form, so a double submit counts once"""
+    return {'new_idempotency_key': lambda: secrets.token_urlsafe(16)}
+
+# ===== END IDEMPOTENCY KEYS =====
+
+# ===== GUEST CART =====
+#
+# Guests shop without a cart table row: their lines are kept in the session as
+# "product_id:variant_id:quantity" entries joined by commas, which keeps a full cart well
+# under the cookie size limit. Nothing is written to the database until login, when
+# merge_guest_cart() moves the lines into the user's cart in one batch.
+
+def load_guest_cart():
+    """The guest cart as {(product_id, variant_id): quantity}"""
+    guest_cart = {}
+    for entry in session.get('guest_cart', '').split(','):
+        try:
+            product_id, variant_id, quantity = (int(part) for part in entry.split(':'))
+        except ValueError:
+            continue
+        if quantity > 0:
+            guest_cart[(product_id, variant_id)] = quantity
+    return guest_cart
+
+def save_guest_cart(guest_cart):
+    if guest_cart:
+        session['guest_cart'] = ','.join(f'{product_id}:{variant_id}:{quantity}'
+                                         for (product_id, variant_id), quantity in guest_cart.items())
+    else:
+        session.pop('guest_cart', None)
+
+def guest_cart_rows(cursor, guest_cart):
+    """Guest cart lines shaped like the cart query rows:
+    (line key, name, price, quantity, images, product_id, variant_id)"""
+    if not guest_cart:
+        return []
+    
+    product_ids = sorted({product_id for product_id, _ in guest_cart})
+    placeholders = ','.join('?' * len(product_ids))
+    cursor.execute(f'SELECT id, name, price, images FROM products WHERE id IN ({placeholders})', product_ids)
+    products = {row[0]: row for row in cursor.fetchall()}
+    
+    variants = {}
+    variant_ids = sorted({variant_id for _, variant_id in guest_cart if variant_id})
+    if variant_ids:
+        placeholders = ','.join('?' * len(variant_ids))
+        cursor.execute(f'SELECT id, product_id, variant_name, price FROM product_variants WHERE id IN ({placeholders})',
+                       variant_ids)
+        variants = {row[0]: row for row in cursor.fetchall()}
+    
+    rows = []
+    for (product_id, variant_id), quantity in guest_cart.items():
+        product = products.get(product_id)
+        variant = variants.get(variant_id)
+        if not product or (variant_id and (not variant or variant[1] != product_id)):
+            continue  # removed from the catalog since it was added
+        name = f'{product[1]} - {variant[2]}' if variant else product[1]
+        price = variant[3] if variant and variant[3] is not None else product[2]
+        rows.append((f'{product_id}:{variant_id}', name, price, quantity, product[3], product_id, variant_id))
+    return rows
+
+def merge_guest_cart(user_id):
+    """Move the guest cart into user_id's cart; quantities of lines already there add up.
+    Lines are held to the same checks as add_to_cart: a line whose variant no longer fits
+    the product is dropped, and one that would exceed stock is cut down to what is left.
+    The user is told when that happens. Returns the number of lines merged."""
+    guest_cart = load_guest_cart()
+    if not guest_cart:
+        session.pop('guest_cart', None)
+        return 0
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT product_id, variant_id, quantity FROM cart WHERE user_id = ?', (user_id,))
+    in_cart = {(row[0], row[1]): row[2] for row in cursor.fetchall()}
+    
+    merged = 0
+    adjusted = 0
+    for (product_id, variant_id), quantity in guest_cart.items():
+        available = available_stock(cursor, product_id, variant_id)
+        wanted = quantity
+        if available is not None:
+            quantity = min(quantity, available - in_cart.get((product_id, variant_id), 0))
+        if available is None or quantity < 1:
+            adjusted += 1
+            continue
         
-        # Get images for this variant
+        # Selecting from products skips a product deleted in the meantime, and the stock
+        # guard skips a line that a concurrent add has already filled up
         cursor.execute('''
-            SELECT id, image_path, display_order, is_primary, alt_text
-            FROM variant_images
-            WHERE variant_id = ?
-            ORDER BY display_order, id
-        ''', (variant_id,))
-        images = cursor.fetchall()
-        
-        result.append({
-            'id': variant[0],
-            'name': variant[1],
-            'type': variant[2],
-            'price': variant[3],
-            'stock': variant[4],
-            'sku': variant[5],
-            'display_order': variant[6],
-            'images': [{
-                'id': img[0],
-                'path': img[1],
-                'order': img[2],
-                'is_primary': img[3],
-                'alt_text': img[4]
-            } for img in images]
-        })
+            INSERT INTO cart (user_id, product_id, variant_id, quantity)
+            SELECT ?, id, ?, ? FROM products WHERE id = ?
+            ON CONFLICT (user_id, product_id, variant_id) DO UPDATE
+            SET quantity = cart.quantity + excluded.quantity
+            WHERE cart.quantity + excluded.quantity <= ?
+        ''', (user_id, variant_id, quantity, product_id, available))
+        if cursor.rowcount == 1:
+            merged += 1
+        if cursor.rowcount != 1 or quantity < wanted:
+            adjusted += 1
+    conn.commit()
+    conn.close()
+    
+    # Only now that the lines are stored is the guest copy let go
+    session.pop('guest_cart', None)
+    if adjusted:
+        flash('Some items in your cart were reduced or removed to match the stock available.', 'warning')
+    return merged
+
+# ===== END GUEST CART =====
+
+# ===== PRODUCT VARIANT MANAGEMENT ROUTES =====
+
+@app.route('/api/product/<int:product_id>/variants')
+def get_product_variants(product_id):
+    """Get all variants and their images for a product"""
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
     
+    version = get_catalog_version(cursor)
+    cached = VARIANT_CACHE.get(product_id)
+    record_cache_access('product_variants', cached is not None and cached[0] == version)
+    if cached is not None and cached[0] == version:
+        conn.close()
+        return jsonify({'variants': cached[1]})
+    
+    cursor.execute('SELECT id FROM products WHERE id = ?', (product_id,))
+    if not cursor.fetchone():
+        conn.close()
+        return jsonify({'error': 'Product not found'}), 404
+    
+    result = load_product_variants(cursor, product_id)
     conn.close()
+    
+    with VARIANT_CACHE_LOCK:
+        if len(VARIANT_CACHE) >= VARIANT_CACHE_SIZE:
+            VARIANT_CACHE.clear()
+        VARIANT_CACHE[product_id] = (version, result)
+    
     return jsonify({'variants': result})
 
 @app.route('/admin/product/<int:product_id>/add_variant', methods=['POST'])
@@ -1275,19 +3808,18 @@ def add_variant(product_id):
     if not variant_name:
         return jsonify({'error': 'Variant name is required'}), 400
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        cursor.execute('''
+        variant_id = insert_returning_id(cursor, '''
             INSERT INTO product_variants (product_id, variant_name, variant_type, price, stock, sku, display_order)
             VALUES (?, ?, ?, ?, ?, ?, ?)
         ''', (product_id, variant_name, variant_type, price, stock, sku, display_order))
         
-        variant_id = cursor.lastrowid
-        
         # Update product to have_variants flag
-        cursor.execute('UPDATE products SET has_variants = 1 WHERE id = ?', (product_id,))
+        cursor.execute('UPDATE products SET has_variants = ? WHERE id = ?', (True, product_id))
+        invalidate_product_caches(cursor, [product_id])
         
         conn.commit()
         conn.close()
@@ -1303,7 +3835,7 @@ def edit_variant(variant_id):
     """Edit an existing variant"""
     data = request.get_json()
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -1336,6 +3868,7 @@ def edit_variant(variant_id):
         query = f"UPDATE product_variants SET {', '.join(updates)} WHERE id = ?"
         
         cursor.execute(query, params)
+        invalidate_product_caches(cursor, variant_product_ids(cursor, variant_ids=[variant_id]))
         conn.commit()
         conn.close()
         
@@ -1348,28 +3881,23 @@ def edit_variant(variant_id):
 @admin_required
 def delete_variant(variant_id):
     """Delete a variant and all its images"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        # Get all images for this variant
+        # Image files may be shared with other variants; sweep_images removes them once unused
         cursor.execute('SELECT image_path FROM variant_images WHERE variant_id = ?', (variant_id,))
-        images = cursor.fetchall()
+        change_image_refs(cursor, removed=[row[0] for row in cursor.fetchall()])
         
-        # Delete image files
-        for img in images:
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], img[0])
-            if os.path.exists(filepath):
-                try:
-                    os.remove(filepath)
-                except:
-                    pass
+        product_ids = variant_product_ids(cursor, variant_ids=[variant_id])
         
-        # Delete variant (cascade will delete images from DB)
+        cursor.execute('DELETE FROM variant_images WHERE variant_id = ?', (variant_id,))
         cursor.execute('DELETE FROM product_variants WHERE id = ?', (variant_id,))
+        invalidate_product_caches(cursor, product_ids)
         
         conn.commit()
         conn.close()
+        maybe_sweep_images()
         
         return jsonify({'success': True}), 200
     except Exception as e:
@@ -1389,18 +3917,11 @@ def upload_variant_image(variant_id):
         return jsonify({'error': 'No file selected'}), 400
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        # Add timestamp to filename to make it unique
-        timestamp = str(int(time.time()))
-        name, ext = os.path.splitext(filename)
-        filename = f"{name}_{timestamp}{ext}"
-        
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        filename = store_image_blob(cursor, file)
         
         # Get the current max display order
-        conn = sqlite3.connect('database.db')
-        cursor = conn.cursor()
         cursor.execute('SELECT MAX(display_order) FROM variant_images WHERE variant_id = ?', (variant_id,))
         max_order = cursor.fetchone()[0]
         display_order = (max_order or 0) + 1
@@ -1409,12 +3930,12 @@ def upload_variant_image(variant_id):
         is_primary = request.form.get('is_primary', 'false') == 'true'
         alt_text = request.form.get('alt_text', '')
         
-        cursor.execute('''
+        image_id = insert_returning_id(cursor, '''
             INSERT INTO variant_images (variant_id, image_path, display_order, is_primary, alt_text)
             VALUES (?, ?, ?, ?, ?)
         ''', (variant_id, filename, display_order, is_primary, alt_text))
-        
-        image_id = cursor.lastrowid
+        change_image_refs(cursor, added=[filename])
+        invalidate_product_caches(cursor, variant_product_ids(cursor, variant_ids=[variant_id]))
         conn.commit()
         conn.close()
         
@@ -1431,7 +3952,7 @@ def upload_variant_image(variant_id):
 @admin_required
 def delete_variant_image(image_id):
     """Delete a variant image"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -1443,21 +3964,18 @@ def delete_variant_image(image_id):
             conn.close()
             return jsonify({'error': 'Image not found'}), 404
         
-        image_path = result[0]
+        # The file may be shared with other variants; sweep_images removes it once unused
+        change_image_refs(cursor, removed=[result[0]])
         
-        # Delete file
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], image_path)
-        if os.path.exists(filepath):
-            try:
-                os.remove(filepath)
-            except:
-                pass
+        product_ids = variant_product_ids(cursor, image_ids=[image_id])
         
         # Delete from database
         cursor.execute('DELETE FROM variant_images WHERE id = ?', (image_id,))
+        invalidate_product_caches(cursor, product_ids)
         
         conn.commit()
         conn.close()
+        maybe_sweep_images()
         
         return jsonify({'success': True}), 200
     except Exception as e:
@@ -1474,11 +3992,12 @@ def reorder_variant_image(image_id):
     if new_order is None:
         return jsonify({'error': 'display_order is required'}), 400
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
         cursor.execute('UPDATE variant_images SET display_order = ? WHERE id = ?', (new_order, image_id))
+        invalidate_product_caches(cursor, variant_product_ids(cursor, image_ids=[image_id]))
         conn.commit()
         conn.close()
         
@@ -1487,6 +4006,137 @@ def reorder_variant_image(image_id):
         conn.close()
         return jsonify({'error': str(e)}), 500
 
+def validate_variant_operation(operation, variant_ids, images):
+    """Return an error message for an invalid batch operation, else None"""
+    op = operation.get('op') if isinstance(operation, dict) else None
+    if op == 'add':
+        if not operation.get('variant_name'):
+            return 'Variant name is required'
+    elif op in ('edit', 'delete'):
+        if operation.get('variant_id') not in variant_ids:
+            return 'Variant not found for this product'
+        if op == 'edit' and not any(field in operation for field in VARIANT_EDITABLE_FIELDS):
+            return 'No fields to update'
+    elif op in ('reorder_image', 'delete_image'):
+        if operation.get('image_id') not in images:
+            return 'Image not found for this product'
+        if op == 'reorder_image' and operation.get('display_order') is None:
+            return 'display_order is required'
+    else:
+        return f'Unknown op: {op}'
+    return None
+
+@app.route('/admin/product/<int:product_id>/variants/batch', methods=['POST'])
+@admin_required
+def batch_edit_variants(product_id):
+    """Apply a list of variant and image operations in one transaction.
+    
+    Body: {"operations": [
+        {"op": "add", "variant_name": ..., "variant_type": ..., "price": ..., "stock": ..., "sku": ..., "display_order": ...},
+        {"op": "edit", "variant_id": ..., <any of the add fields>},
+        {"op": "delete", "variant_id": ...},
+        {"op": "reorder_image", "image_id": ..., "display_order": ...},
+        {"op": "delete_image", "image_id": ...}
+    ]}
+    Returns the product's variants after the batch.
+    """
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'operations must be a non-empty list'}), 400
+    if len(operations) > VARIANT_BATCH_MAX_OPERATIONS:
+        return jsonify({'error': f'At most {VARIANT_BATCH_MAX_OPERATIONS} operations per batch'}), 400
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT id FROM products WHERE id = ?', (product_id,))
+    if not cursor.fetchone():
+        conn.close()
+        return jsonify({'error': 'Product not found'}), 404
+    
+    cursor.execute('SELECT id FROM product_variants WHERE product_id = ?', (product_id,))
+    variant_ids = {row[0] for row in cursor.fetchall()}
+    cursor.execute('''
+        SELECT vi.id, vi.variant_id, vi.image_path
+        FROM variant_images vi
+        JOIN product_variants v ON v.id = vi.variant_id
+        WHERE v.product_id = ?
+    ''', (product_id,))
+    images = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+    
+    # Validate everything before writing anything
+    for index, operation in enumerate(operations):
+        error = validate_variant_operation(operation, variant_ids, images)
+        if error:
+            conn.close()
+            return jsonify({'error': error, 'operation': index}), 400
+    
+    # Consecutive statements with the same SQL are sent together via executemany
+    pending_sql = None
+    pending_params = []
+    
+    def queue(sql, params):
+        nonlocal pending_sql, pending_params
+        if sql != pending_sql:
+            flush()
+            pending_sql = sql
+        pending_params.append(params)
+    
+    def flush():
+        nonlocal pending_sql, pending_params
+        if pending_params:
+            cursor.executemany(pending_sql, pending_params)
+        pending_sql = None
+        pending_params = []
+    
+    added_ids = []
+    removed_images = {}  # variant_images.id -> path; an image is released once per batch
+    try:
+        for operation in operations:
+            op = operation['op']
+            if op == 'add':
+                flush()
+                added_ids.append(insert_returning_id(cursor, '''
+                    INSERT INTO product_variants (product_id, variant_name, variant_type, price, stock, sku, display_order)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (product_id, operation['variant_name'], operation.get('variant_type', 'color'),
+                      operation.get('price'), operation.get('stock', 0), operation.get('sku', ''),
+                      operation.get('display_order', 0))))
+            elif op == 'edit':
+                fields = [field for field in VARIANT_EDITABLE_FIELDS if field in operation]
+                queue(f"UPDATE product_variants SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                      [operation[field] for field in fields] + [operation['variant_id']])
+            elif op == 'delete':
+                removed_images.update((image_id, path) for image_id, (variant_id, path) in images.items()
+                                      if variant_id == operation['variant_id'])
+                queue('DELETE FROM variant_images WHERE variant_id = ?', (operation['variant_id'],))
+                queue('DELETE FROM product_variants WHERE id = ?', (operation['variant_id'],))
+            elif op == 'reorder_image':
+                queue('UPDATE variant_images SET display_order = ? WHERE id = ?',
+                      (operation['display_order'], operation['image_id']))
+            elif op == 'delete_image':
+                removed_images[operation['image_id']] = images[operation['image_id']][1]
+                queue('DELETE FROM variant_images WHERE id = ?', (operation['image_id'],))
+        flush()
+        
+        if added_ids:
+            cursor.execute('UPDATE products SET has_variants = ? WHERE id = ?', (True, product_id))
+        change_image_refs(cursor, removed=list(removed_images.values()))
+        invalidate_product_caches(cursor, [product_id])
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'error': str(e)}), 500
+    maybe_sweep_images()
+    
+    variants = load_product_variants(cursor, product_id)
+    conn.close()
+    
+    return jsonify({'success': True, 'added_variant_ids': added_ids, 'variants': variants}), 200
+
 # ===== END VARIANT MANAGEMENT ROUTES =====
 
 # ===== AMAZON-STYLE PRODUCT PAGE =====
@@ -1494,34 +4144,207 @@ def reorder_variant_image(image_id):
 @app.route('/amazon-product/<int:product_id>')
 def amazon_product_page(product_id):
     """Amazon-style product detail page with hover zoom and carousel"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
     
-    # Get product details
-    cursor.execute('SELECT * FROM products WHERE id = ?', (product_id,))
+    # Get product details with aggregated price range and stock
+    cursor.execute(f'SELECT {PRODUCT_LISTING_COLUMNS} FROM product_listing WHERE product_id = ?', (product_id,))
     product = cursor.fetchone()
     
     if not product:
         flash('Product not found', 'error')
         conn.close()
         return redirect(url_for('products'))
-    
-    # Get related products (same category, exclude current product)
-    cursor.execute('''
-        SELECT * FROM products 
-        WHERE category = ? AND id != ? 
-        LIMIT 8
-    ''', (product[2], product_id))
+    product = listing_rows([product])[0]
+    
+    # Get related products from the recommendation index, falling back to the same category
+    # for products the last build did not cover
+    cursor.execute(f'''
+        SELECT {', '.join('l.' + column.strip() for column in PRODUCT_LISTING_COLUMNS.split(','))}
+        FROM product_recommendations r
+        JOIN product_listing l ON l.product_id = r.related_product_id
+        WHERE r.product_id = ?
+        ORDER BY r.rank
+    ''', (product_id,))
     related_products = cursor.fetchall()
+    if not related_products:
+        cursor.execute(f'''
+            SELECT {PRODUCT_LISTING_COLUMNS} FROM product_listing
+            WHERE category = ? AND product_id != ?
+            ORDER BY product_id
+            LIMIT ?
+        ''', (product[2], product_id, RECOMMENDATIONS_PER_PRODUCT))
+        related_products = cursor.fetchall()
+    related_products = listing_rows(related_products)
+    
+    in_wishlist = 'user_id' in session and bool(get_wishlist_ids(cursor, session['user_id'], [product_id]))
     
     conn.close()
     
     return render_template('amazon_style_product.html', 
                           product=product,
-                          related_products=related_products)
+                          related_products=related_products,
+                          in_wishlist=in_wishlist)
 
 # ===== END AMAZON-STYLE PRODUCT PAGE =====
 
+# ===== TRENDING PRODUCTS =====
+#
+# Forward decay: an event at time t adds weight * 2^((t - TRENDING_EPOCH) / half_life)
+# instead of decaying every stored score as time passes. Newer events weigh exponentially
+# more, so ordering by the stored score is ordering by the time-decayed score, and each
+# event is a single-row upsert. Wishlist adds count as interest; removals are not
+# subtracted, since today's weight would outweigh the original add. Scores double every
+# half-life, so at 7 days they near the float limit ~19 years after TRENDING_EPOCH: move the
+# epoch forward and run `flask rebuild-trending` (recomputes from history) long before that.
+
+def trending_weight(timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
+    return 2 ** ((timestamp - TRENDING_EPOCH) / (TRENDING_HALF_LIFE_DAYS * 86400))
+
+def record_trending(cursor, events, timestamp=None):
+    """Add (product_id, units_sold, wishlist_change) events to product_trending"""
+    weight = trending_weight(timestamp)
+    rows = []
+    for product_id, units_sold, wishlist_change in events:
+        sales = units_sold * weight
+        wishlist = wishlist_change * weight
+        rows.append((product_id, sales, wishlist, sales + TRENDING_WISHLIST_WEIGHT * wishlist))
+    cursor.executemany('''
+        INSERT INTO product_trending (product_id, sales_score, wishlist_score, score)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (product_id) DO UPDATE SET
+            sales_score = product_trending.sales_score + excluded.sales_score,
+            wishlist_score = product_trending.wishlist_score + excluded.wishlist_score,
+            score = product_trending.score + excluded.score
+    ''', rows)
+
+def get_trending_products(cursor, limit):
+    """Top in-stock product_listing rows by trending score, topped up with newest products"""
+    listing_columns = ', '.join('l.' + column.strip() for column in PRODUCT_LISTING_COLUMNS.split(','))
+    cursor.execute(f'''
+        SELECT {listing_columns}
+        FROM product_trending t
+        JOIN product_listing l ON l.product_id = t.product_id
+        WHERE t.score > 0 AND l.in_stock = ?
+        ORDER BY t.score DESC
+        LIMIT ?
+    ''', (True, limit))
+    products = cursor.fetchall()
+    
+    if len(products) < limit:
+        seen = [product[0] for product in products] or [0]
+        placeholders = ','.join('?' * len(seen))
+        cursor.execute(f'''
+            SELECT {PRODUCT_LISTING_COLUMNS} FROM product_listing
+            WHERE product_id NOT IN ({placeholders})
+            ORDER BY in_stock DESC, product_id DESC
+            LIMIT ?
+        ''', seen + [limit - len(products)])
+        products.extend(cursor.fetchall())
+    return products
+
+def parse_db_timestamp(value):
+    """Seconds since the epoch for a CURRENT_TIMESTAMP (UTC) column value"""
+    return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+
+@app.cli.command('rebuild-trending')
+def rebuild_trending_command():
+    """Recompute trending scores from order and wishlist history"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM product_trending')
+        for sql, kind in (('''
+                SELECT oi.product_id, oi.quantity, o.order_date
+                FROM order_items oi
+                JOIN orders o ON o.id = oi.order_id
+                WHERE o.order_status != 'cancelled'
+            ''', 'sale'), ('SELECT product_id, 1, added_date FROM wishlist', 'wishlist')):
+            for product_id, quantity, event_date in iter_query(conn, sql, (), EXPORT_CHUNK_SIZE):
+                event = (product_id, quantity, 0) if kind == 'sale' else (product_id, 0, quantity)
+                record_trending(cursor, [event], parse_db_timestamp(event_date))
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo('Trending scores rebuilt')
+
+# ===== END TRENDING PRODUCTS =====
+
+# ===== RELATED PRODUCT RECOMMENDATIONS =====
+#
+# Item-to-item similarity from co-occurrence: two products score when they appear in
+# the same order or the same user's wishlist. The pair counts are the sparse product x
+# product co-occurrence matrix, produced by SQL self-joins; scores are cosine-normalised
+# by how often each product occurs so best-sellers do not dominate every list.
+
+def count_cooccurrence(conn, scores, sql, weight):
+    """Add weight * pair_count / sqrt(count_a * count_b) for every pair the query yields.
+    The query returns (product_a, product_b, pair_count, count_a, count_b)."""
+    for product_a, product_b, pair_count, count_a, count_b in iter_query(conn, sql, (), EXPORT_CHUNK_SIZE):
+        key = (product_a, product_b)
+        scores[key] = scores.get(key, 0.0) + weight * pair_count / math.sqrt(count_a * count_b)
+
+def build_recommendations():
+    """Rebuild product_recommendations; returns the number of rows written"""
+    scores = {}
+    conn = get_db_connection(snapshot=True)
+    try:
+        count_cooccurrence(conn, scores, '''
+            WITH baskets AS (SELECT DISTINCT order_id, product_id FROM order_items),
+                 totals AS (SELECT product_id, COUNT(*) AS n FROM baskets GROUP BY product_id)
+            SELECT a.product_id, b.product_id, COUNT(*), ta.n, tb.n
+            FROM baskets a
+            JOIN baskets b ON b.order_id = a.order_id AND b.product_id != a.product_id
+            JOIN totals ta ON ta.product_id = a.product_id
+            JOIN totals tb ON tb.product_id = b.product_id
+            GROUP BY a.product_id, b.product_id, ta.n, tb.n
+        ''', 1.0)
+        count_cooccurrence(conn, scores, '''
+            WITH totals AS (SELECT product_id, COUNT(*) AS n FROM wishlist GROUP BY product_id)
+            SELECT a.product_id, b.product_id, COUNT(*), ta.n, tb.n
+            FROM wishlist a
+            JOIN wishlist b ON b.user_id = a.user_id AND b.product_id != a.product_id
+            JOIN totals ta ON ta.product_id = a.product_id
+            JOIN totals tb ON tb.product_id = b.product_id
+            GROUP BY a.product_id, b.product_id, ta.n, tb.n
+        ''', RECOMMENDATION_WISHLIST_WEIGHT)
+    finally:
+        conn.close()
+    
+    neighbours = {}
+    for (product_a, product_b), score in scores.items():
+        neighbours.setdefault(product_a, []).append((score, product_b))
+    
+    rows = []
+    for product_id, candidates in neighbours.items():
+        top = heapq.nlargest(RECOMMENDATIONS_PER_PRODUCT, candidates)
+        rows.extend((product_id, rank, related_id, score) for rank, (score, related_id) in enumerate(top))
+    
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM product_recommendations')
+        for start in range(0, len(rows), IMPORT_BATCH_SIZE):
+            cursor.executemany('''
+                INSERT INTO product_recommendations (product_id, rank, related_product_id, score)
+                VALUES (?, ?, ?, ?)
+            ''', rows[start:start + IMPORT_BATCH_SIZE])
+        conn.commit()
+    finally:
+        conn.close()
+    return len(rows)
+
+@app.cli.command('build-recommendations')
+def build_recommendations_command():
+    """Rebuild the related-products index from orders and wishlists"""
+    start = time.perf_counter()
+    count = build_recommendations()
+    click.echo(f'Wrote {count} recommendations in {time.perf_counter() - start:.2f}s')
+
+# ===== END RELATED PRODUCT RECOMMENDATIONS =====
+
 @app.route('/admin/add_product', methods=['POST'])
 @admin_required
 def add_product():
@@ -1536,12 +4359,14 @@ def add_product():
     sizes = request.form.get('sizes', '')
     colors = request.form.get('colors', '')
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('''
+    product_id = insert_returning_id(cursor, '''
         INSERT INTO products (name, category, subcategory, gender, price, description, images, stock, sizes, colors)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     ''', (name, category, subcategory, gender, price, description, images, stock, sizes, colors))
+    change_image_refs(cursor, added=split_image_list(images))
+    invalidate_product_caches(cursor, [product_id])
     conn.commit()
     conn.close()
     
@@ -1563,15 +4388,21 @@ def edit_product():
     sizes = request.form.get('sizes', '')
     colors = request.form.get('colors', '')
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.execute('SELECT images FROM products WHERE id = ?', (product_id,))
+    previous = cursor.fetchone()
     cursor.execute('''
         UPDATE products 
         SET name = ?, category = ?, subcategory = ?, gender = ?, price = ?, description = ?, images = ?, stock = ?, sizes = ?, colors = ?
         WHERE id = ?
     ''', (name, category, subcategory, gender, price, description, images, stock, sizes, colors, product_id))
+    if previous:
+        change_image_refs(cursor, removed=split_image_list(previous[0]), added=split_image_list(images))
+    invalidate_product_caches(cursor, [product_id])
     conn.commit()
     conn.close()
+    maybe_sweep_images()
     
     flash('Product updated successfully!', 'success')
     return redirect(url_for('admin'))
@@ -1581,24 +4412,422 @@ def edit_product():
 def delete_product():
     product_id = request.form['product_id']
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.execute('SELECT images FROM products WHERE id = ?', (product_id,))
+    removed = [image for row in cursor.fetchall() for image in split_image_list(row[0])]
+    cursor.execute('''
+        SELECT vi.image_path FROM variant_images vi
+        JOIN product_variants v ON v.id = vi.variant_id
+        WHERE v.product_id = ?
+    ''', (product_id,))
+    removed.extend(row[0] for row in cursor.fetchall())
+    change_image_refs(cursor, removed=removed)
+    
+    # Variants go with the product on SQLite too, where foreign keys are not enforced
+    cursor.execute('DELETE FROM variant_images WHERE variant_id IN (SELECT id FROM product_variants WHERE product_id = ?)',
+                   (product_id,))
+    cursor.execute('DELETE FROM product_variants WHERE product_id = ?', (product_id,))
     cursor.execute('DELETE FROM products WHERE id = ?', (product_id,))
+    invalidate_product_caches(cursor, [product_id])
     conn.commit()
     conn.close()
+    maybe_sweep_images()
     
     flash('Product deleted successfully!', 'success')
     return redirect(url_for('admin'))
 
+# ===== BULK CATALOG IMPORT/EXPORT =====
+#
+# CSV: one row per variant, Shopify-style. Consecutive rows sharing a `handle`
+# are one product; product columns are read from the first row. A product
+# without variants is a single row with empty variant columns. `product_id`
+# updates that existing product, otherwise a new product is created.
+#
+# JSONL: one product per line with the same product fields and an optional
+# "variants" list of {"name", "type", "price", "stock", "sku", "images"}.
+
+def split_image_list(value):
+    if isinstance(value, list):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [v.strip() for v in (value or '').split(',') if v.strip()]
+
+def read_catalog_records(stream, catalog_format):
+    """Yield (row_number, raw_product_record) from a CSV or JSONL text stream"""
+    if catalog_format == 'jsonl':
+        for row_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield row_number, {'_error': f'Invalid JSON: {e}'}
+                continue
+            if not isinstance(record, dict):
+                yield row_number, {'_error': 'Each line must be a JSON object'}
+                continue
+            yield row_number, record
+        return
+
+    current = None
+    for row_number, row in enumerate(csv.DictReader(stream), 2):  # row 1 is the header
+        handle = (row.get('handle') or '').strip()
+        if current is not None and handle and handle == current[1].get('handle'):
+            record = current[1]
+        else:
+            if current is not None:
+                yield current
+            record = {column: row.get(column, '') for column in CATALOG_PRODUCT_COLUMNS}
+            record['variants'] = []
+            current = (row_number, record)
+        if (row.get('variant_name') or '').strip():
+            record['variants'].append({
+                'name': row.get('variant_name'),
+                'type': row.get('variant_type'),
+                'price': row.get('variant_price'),
+                'stock': row.get('variant_stock'),
+                'sku': row.get('variant_sku'),
+                'images': row.get('variant_images')
+            })
+    if current is not None:
+        yield current
+
+def validate_catalog_record(record):
+    """Return (clean_product, error_message) for one raw import record"""
+    if '_error' in record:
+        return None, record['_error']
+
+    def text(value):
+        return str(value).strip() if value is not None else ''
+
+    name = text(record.get('name'))
+    category = text(record.get('category'))
+    if not name or not category:
+        return None, 'name and category are required'
+
+    try:
+        price = float(record.get('price'))
+        stock = int(record.get('stock') or 0)
+    except (TypeError, ValueError):
+        return None, 'price must be a number and stock a whole number'
+    if price < 0 or stock < 0:
+        return None, 'price and stock cannot be negative'
+
+    product_id = text(record.get('product_id'))
+    if product_id and not product_id.isdigit():
+        return None, 'product_id must be a number'
+
+    images = split_image_list(record.get('images'))
+    for image in images:
+        if image != secure_filename(image) or not allowed_file(image):
+            return None, f'Invalid image reference: {image}'
+
+    variants = []
+    for variant in record.get('variants') or []:
+        variant_name = text(variant.get('name'))
+        if not variant_name:
+            return None, 'variant name is required'
+        try:
+            variant_price = float(variant['price']) if text(variant.get('price')) else None
+            variant_stock = int(variant.get('stock') or 0)
+        except (TypeError, ValueError):
+            return None, f'Variant {variant_name}: price must be a number and stock a whole number'
+        variant_images = split_image_list(variant.get('images'))
+        for image in variant_images:
+            if image != secure_filename(image) or not allowed_file(image):
+                return None, f'Variant {variant_name}: invalid image reference: {image}'
+        variants.append({
+            'name': variant_name,
+            'type': text(variant.get('type')) or 'color',
+            'price': variant_price,
+            'stock': variant_stock,
+            'sku': text(variant.get('sku')),
+            'images': variant_images
+        })
+
+    return {
+        'product_id': int(product_id) if product_id else None,
+        'name': name,
+        'category': category,
+        'subcategory': text(record.get('subcategory')),
+        'gender': text(record.get('gender')),
+        'price': price,
+        'description': text(record.get('description')),
+        'images': ','.join(images) or 'tshirt.jpg',
+        'stock': stock,
+        'sizes': text(record.get('sizes')),
+        'colors': text(record.get('colors')),
+        'variants': variants
+    }, None
+
+def write_catalog_batch(conn, batch, report):
+    """Write a batch of validated (row_number, product) pairs in one transaction"""
+    cursor = conn.cursor()
+
+    existing_ids = set()
+    update_ids = [p['product_id'] for _, p in batch if p['product_id']]
+    if update_ids:
+        placeholders = ','.join('?' * len(update_ids))
+        cursor.execute(f'SELECT id FROM products WHERE id IN ({placeholders})', update_ids)
+        existing_ids = {row[0] for row in cursor.fetchall()}
+
+    # Image references the batch replaces: the images of updated products, and the variant
+    # images of products whose variants are replaced
+    removed_images = []
+    added_images = []
+    if existing_ids:
+        placeholders = ','.join('?' * len(existing_ids))
+        cursor.execute(f'SELECT images FROM products WHERE id IN ({placeholders})', list(existing_ids))
+        removed_images.extend(image for row in cursor.fetchall() for image in split_image_list(row[0]))
+
+    updates = []
+    plain_inserts = []
+    variant_products = []  # (product_id or None, product)
+    for row_number, product in batch:
+        if not product['product_id'] or product['product_id'] in existing_ids:
+            added_images.extend(split_image_list(product['images']))
+        values = (product['name'], product['category'], product['subcategory'], product['gender'],
+                  product['price'], product['description'], product['images'], product['stock'],
+                  product['sizes'], product['colors'], bool(product['variants']))
+        if product['product_id']:
+            if product['product_id'] not in existing_ids:
+                add_import_error(report, row_number, f"product_id {product['product_id']} does not exist")
+                continue
+            updates.append(values + (product['product_id'],))
+            report['updated'] += 1
+            if product['variants']:
+                variant_products.append((product['product_id'], product))
+        else:
+            report['created'] += 1
+            if product['variants']:
+                variant_products.append((None, product))
+            else:
+                plain_inserts.append(values)
+
+    product_columns = 'name, category, subcategory, gender, price, description, images, stock, sizes, colors, has_variants'
+    if updates:
+        cursor.executemany('''
+            UPDATE products
+            SET name = ?, category = ?, subcategory = ?, gender = ?, price = ?, description = ?,
+                images = ?, stock = ?, sizes = ?, colors = ?,
+                has_variants = (has_variants OR ?)
+            WHERE id = ?
+        ''', updates)
+    written_ids = [u[-1] for u in updates]
+    if plain_inserts:
+        # executemany returns no ids; ids are allocated increasingly, so the new rows are those above the old max
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM products')
+        last_id = cursor.fetchone()[0]
+        cursor.executemany(f'INSERT INTO products ({product_columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           plain_inserts)
+        cursor.execute('SELECT id FROM products WHERE id > ?', (last_id,))
+        written_ids.extend(row[0] for row in cursor.fetchall())
+
+    # Products that carry variants replace their variant set
+    replaced_ids = [pid for pid, _ in variant_products if pid]
+    if replaced_ids:
+        placeholders = ','.join('?' * len(replaced_ids))
+        cursor.execute(f'''
+            SELECT vi.image_path FROM variant_images vi
+            JOIN product_variants v ON v.id = vi.variant_id
+            WHERE v.product_id IN ({placeholders})
+        ''', replaced_ids)
+        removed_images.extend(row[0] for row in cursor.fetchall())
+        cursor.executemany('DELETE FROM variant_images WHERE variant_id IN '
+                           '(SELECT id FROM product_variants WHERE product_id = ?)',
+                           [(pid,) for pid in replaced_ids])
+        cursor.executemany('DELETE FROM product_variants WHERE product_id = ?', [(pid,) for pid in replaced_ids])
+
+    image_rows = []
+    for product_id, product in variant_products:
+        if product_id is None:
+            product_id = insert_returning_id(
+                cursor, f'INSERT INTO products ({product_columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (product['name'], product['category'], product['subcategory'], product['gender'],
+                 product['price'], product['description'], product['images'], product['stock'],
+                 product['sizes'], product['colors'], True))
+            written_ids.append(product_id)
+        for display_order, variant in enumerate(product['variants']):
+            variant_id = insert_returning_id(cursor, '''
+                INSERT INTO product_variants (product_id, variant_name, variant_type, price, stock, sku, display_order)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (product_id, variant['name'], variant['type'], variant['price'], variant['stock'],
+                  variant['sku'], display_order))
+            for image_order, image in enumerate(variant['images']):
+                image_rows.append((variant_id, image, image_order, image_order == 0, variant['name']))
+    if image_rows:
+        cursor.executemany('''
+            INSERT INTO variant_images (variant_id, image_path, display_order, is_primary, alt_text)
+            VALUES (?, ?, ?, ?, ?)
+        ''', image_rows)
+    added_images.extend(row[1] for row in image_rows)
+
+    change_image_refs(cursor, removed=removed_images, added=added_images)
+    invalidate_product_caches(cursor, written_ids)
+    conn.commit()
+
+def add_import_error(report, row_number, message):
+    report['failed'] += 1
+    if len(report['errors']) < IMPORT_MAX_ERRORS:
+        report['errors'].append({'row': row_number, 'error': message})
+
+def import_catalog(stream, catalog_format, dry_run=False):
+    """Validate and write a catalog file in one streaming pass; returns a report dict"""
+    report = {'processed': 0, 'created': 0, 'updated': 0, 'failed': 0, 'dry_run': dry_run, 'errors': []}
+    conn = None if dry_run else get_db_connection()
+    batch = []
+    try:
+        for row_number, record in read_catalog_records(stream, catalog_format):
+            report['processed'] += 1
+            product, error = validate_catalog_record(record)
+            if error:
+                add_import_error(report, row_number, error)
+                continue
+            if dry_run:
+                continue
+            batch.append((row_number, product))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                write_catalog_batch(conn, batch, report)
+                batch = []
+        if batch:
+            write_catalog_batch(conn, batch, report)
+    finally:
+        if conn is not None:
+            conn.close()
+    return report
+
+def export_catalog(catalog_format):
+    """Yield the catalog in the import format, reading products and variants as two ordered streams"""
+    conn = get_db_connection(readonly=True)
+    try:
+        products = iter_query(conn, '''
+            SELECT id, name, category, subcategory, gender, price, description, images, stock, sizes, colors
+            FROM products ORDER BY id
+        ''', (), EXPORT_CHUNK_SIZE)
+        variant_rows = iter_query(conn, '''
+            SELECT v.product_id, v.id, v.variant_name, v.variant_type, v.price, v.stock, v.sku, vi.image_path
+            FROM product_variants v
+            LEFT JOIN variant_images vi ON vi.variant_id = v.id
+            ORDER BY v.product_id, v.display_order, v.id, vi.display_order, vi.id
+        ''', (), EXPORT_CHUNK_SIZE)
+        pending_variant = next(variant_rows, None)
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if catalog_format == 'csv':
+            writer.writerow(CATALOG_PRODUCT_COLUMNS + CATALOG_VARIANT_COLUMNS)
+
+        for count, product in enumerate(products, 1):
+            product_id = product[0]
+            variants = []
+            while pending_variant is not None and pending_variant[0] <= product_id:
+                if pending_variant[0] == product_id:
+                    if not variants or variants[-1]['id'] != pending_variant[1]:
+                        variants.append({'id': pending_variant[1], 'name': pending_variant[2],
+                                         'type': pending_variant[3], 'price': pending_variant[4],
+                                         'stock': pending_variant[5], 'sku': pending_variant[6], 'images': []})
+                    if pending_variant[7]:
+                        variants[-1]['images'].append(pending_variant[7])
+                pending_variant = next(variant_rows, None)
+
+            record = dict(zip(CATALOG_PRODUCT_COLUMNS, (str(product_id),) + tuple(product)))
+            if catalog_format == 'jsonl':
+                record['product_id'] = product_id
+                record['images'] = split_image_list(record['images'])
+                record['variants'] = [{k: v for k, v in variant.items() if k != 'id'} for variant in variants]
+                buffer.write(json.dumps(record, ensure_ascii=False) + '\n')
+            else:
+                product_values = [record[column] for column in CATALOG_PRODUCT_COLUMNS]
+                if not variants:
+                    writer.writerow(product_values + [''] * len(CATALOG_VARIANT_COLUMNS))
+                for variant in variants:
+                    writer.writerow(product_values + [variant['name'], variant['type'], variant['price'],
+                                                      variant['stock'], variant['sku'], ','.join(variant['images'])])
+
+            if count % EXPORT_CHUNK_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    finally:
+        conn.close()
+
+def catalog_format_for(filename, requested=''):
+    if requested in ('csv', 'jsonl'):
+        return requested
+    if filename.lower().endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+@app.route('/admin/catalog/import', methods=['POST'])
+@admin_required
+def catalog_import():
+    """Bulk import products/variants/images from an uploaded CSV or JSONL file"""
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        return jsonify({'error': 'No file provided'}), 400
+
+    catalog_format = catalog_format_for(file.filename, request.form.get('format', ''))
+    dry_run = request.form.get('dry_run', 'false') == 'true'
+    stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+    try:
+        report = import_catalog(stream, catalog_format, dry_run=dry_run)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify(report), 200
+
+@app.route('/admin/catalog/export')
+@admin_required
+def catalog_export():
+    """Stream the whole catalog in the import format"""
+    catalog_format = request.args.get('format', 'csv')
+    if catalog_format not in ('csv', 'jsonl'):
+        return jsonify({'error': 'format must be csv or jsonl'}), 400
+
+    content_type = 'text/csv' if catalog_format == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(export_catalog(catalog_format)), content_type=content_type)
+    response.headers['Content-Disposition'] = (
+        f"attachment; filename=catalog_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{catalog_format}")
+    return response
+
+@app.cli.command('import-catalog')
+@click.argument('path')
+@click.option('--format', 'catalog_format', default='', help='csv or jsonl (default: from the file extension)')
+@click.option('--dry-run', is_flag=True, help='Validate only, write nothing')
+def import_catalog_command(path, catalog_format, dry_run):
+    """Import a catalog CSV/JSONL file"""
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        report = import_catalog(f, catalog_format_for(path, catalog_format), dry_run=dry_run)
+    for error in report['errors']:
+        click.echo(f"Row {error['row']}: {error['error']}", err=True)
+    click.echo(f"Processed {report['processed']}: {report['created']} created, "
+               f"{report['updated']} updated, {report['failed']} failed"
+               + (' (dry run)' if dry_run else ''))
+
+@app.cli.command('export-catalog')
+@click.argument('path')
+@click.option('--format', 'catalog_format', default='', help='csv or jsonl (default: from the file extension)')
+def export_catalog_command(path, catalog_format):
+    """Export the catalog to a CSV/JSONL file"""
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for chunk in export_catalog(catalog_format_for(path, catalog_format)):
+            f.write(chunk)
+    click.echo(f'Catalog exported to {path}')
+
+# ===== END BULK CATALOG IMPORT/EXPORT =====
+
 @app.route('/checkout')
 @login_required
 def checkout():
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
     cursor.execute('''
-        SELECT c.id, p.name, p.price, c.quantity, p.images, p.id as product_id
+        SELECT c.id,
+               CASE WHEN v.id IS NULL THEN p.name ELSE p.name || ' - ' || v.variant_name END,
+               COALESCE(v.price, p.price), c.quantity, p.images, p.id as product_id, c.variant_id
         FROM cart c
         JOIN products p ON c.product_id = p.id
+        LEFT JOIN product_variants v ON v.id = c.variant_id
         WHERE c.user_id = ?
     ''', (session['user_id'],))
     cart_items = cursor.fetchall()
@@ -1683,6 +4912,7 @@ def simulate_payment():
 
 @app.route('/process_payment', methods=['POST'])
 @login_required
+@rate_limit(user=(10, 60))
 def process_payment():
     try:
         payment_method = request.form.get('payment_method')
@@ -1701,12 +4931,14 @@ def process_payment():
             return redirect(url_for('checkout'))
         
         # Get cart items
-        conn = sqlite3.connect('database.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT c.id, p.id as product_id, p.name, p.price, c.quantity
+            SELECT c.id, p.id as product_id, p.name, COALESCE(v.price, p.price), c.quantity, c.variant_id,
+                   EXISTS (SELECT 1 FROM product_variants pv WHERE pv.product_id = p.id)
             FROM cart c
             JOIN products p ON c.product_id = p.id
+            LEFT JOIN product_variants v ON v.id = c.variant_id
             WHERE c.user_id = ?
         ''', (session['user_id'],))
         cart_items = cursor.fetchall()
@@ -1716,6 +4948,13 @@ def process_payment():
             flash('Your cart is empty!', 'error')
             return redirect(url_for('cart'))
         
+        # A product that has variants is only sold as one of them
+        for item in cart_items:
+            if not item[5] and item[6]:
+                conn.close()
+                flash(f'Please choose an option for {item[2]} before checking out.', 'error')
+                return redirect(url_for('cart'))
+        
         # Calculate total with proper type conversion
         total_amount = 0.0
         for item in cart_items:
@@ -1724,24 +4963,38 @@ def process_payment():
             total_amount += price * quantity
         
         # Create order
-        cursor.execute('''
+        order_id = insert_returning_id(cursor, '''
             INSERT INTO orders (user_id, total_amount, payment_method, shipping_address, phone_number)
             VALUES (?, ?, ?, ?, ?)
         ''', (session['user_id'], total_amount, payment_method, shipping_address, phone_number))
-        
-        order_id = cursor.lastrowid
+        record_order_status(cursor, order_id, None, 'processing', total_amount)
         
         # Add order items
         for item in cart_items:
             cursor.execute('''
-                INSERT INTO order_items (order_id, product_id, quantity, price)
-                VALUES (?, ?, ?, ?)
-            ''', (order_id, item[1], item[4], item[3]))
+                INSERT INTO order_items (order_id, product_id, variant_id, quantity, price)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (order_id, item[1], item[5] or None, item[4], item[3]))
             
-            # Update stock
-            cursor.execute('''
-                UPDATE products SET stock = stock - ? WHERE id = ?
-            ''', (item[4], item[1]))
+            # Take stock from the variant bought, or the product when it has none; the
+            # stock >= ? guard makes concurrent checkouts unable to oversell
+            if item[5]:
+                cursor.execute('''
+                    UPDATE product_variants SET stock = stock - ? WHERE id = ? AND stock >= ?
+                ''', (item[4], item[5], item[4]))
+            else:
+                cursor.execute('''
+                    UPDATE products SET stock = stock - ?
+                    WHERE id = ? AND stock >= ?
+                      AND NOT EXISTS (SELECT 1 FROM product_variants WHERE product_id = products.id)
+                ''', (item[4], item[1], item[4]))
+            if cursor.rowcount != 1:
+                conn.rollback()
+                conn.close()
+                flash(f'Sorry, {item[2]} no longer has {item[4]} in stock. Please update your cart.', 'error')
+                return redirect(url_for('cart'))
+        apply_stock_sale(cursor, cart_items)
+        record_trending(cursor, [(item[1], item[4], 0) for item in cart_items])
         
         # Clear cart
         cursor.execute('DELETE FROM cart WHERE user_id = ?', (session['user_id'],))
@@ -1749,6 +5002,9 @@ def process_payment():
         conn.commit()
         conn.close()
         
+        inc_counter('orders_placed_total', {'payment_method': payment_method})
+        inc_counter('order_revenue_total', {'payment_method': payment_method}, total_amount)
+        
         flash('Order placed successfully!', 'success')
         return redirect(url_for('order_confirmation', order_id=order_id))
     
@@ -1758,76 +5014,49 @@ def process_payment():
         flash(f'An error occurred while processing your payment: {str(e)}', 'error')
         return redirect(url_for('checkout'))
 
-@app.route('/order_confirmation/<int:order_id>')
-@login_required
-def order_confirmation(order_id):
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT o.*, oi.product_id, p.name, oi.quantity, oi.price
-        FROM orders o
-        JOIN order_items oi ON o.id = oi.order_id
-        JOIN products p ON oi.product_id = p.id
-        WHERE o.id = ? AND o.user_id = ?
-    ''', (order_id, session['user_id']))
-    order_details = cursor.fetchall()
-    conn.close()
-    
-    if not order_details:
-        flash('Order not found!', 'error')
-        return redirect(url_for('index'))
-    
-    return render_template('order_confirmation.html', order_details=order_details, order_id=order_id)
-
-@app.route('/orders')
-@login_required
-def orders():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, order_date, total_amount, payment_method, order_status
-        FROM orders WHERE user_id = ? ORDER BY order_date DESC
-    ''', (session['user_id'],))
-    user_orders = cursor.fetchall()
-    conn.close()
-    
-    return render_template('orders.html', orders=user_orders)
+# ===== ORDER READ MODEL =====
+#
+# load_order() is how every order page and invoice reads an order: the header, customer
+# and items (with product names and primary images) come back from one query.
+# order:  (id, user_id, order_date, total_amount, payment_method, order_status,
+#          shipping_address, phone_number, customer_name, email, payment_status)
+# items:  [(name, category, quantity, price, image, product_id, variant_id)]
 
-@app.route('/download_bill/<int:order_id>')
-@login_required
-def download_bill(order_id):
-    if not REPORTLAB_AVAILABLE:
-        flash('PDF generation is not available. Please install ReportLab.', 'error')
-        return redirect(url_for('orders'))
-    
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    # Get order details
+def load_order(cursor, order_id):
+    """(order, items) for order_id, or (None, [])"""
     cursor.execute('''
-        SELECT o.*, u.name as customer_name, u.email
+        SELECT o.id, o.user_id, o.order_date, o.total_amount, o.payment_method, o.order_status,
+               o.shipping_address, o.phone_number, u.name, u.email, o.payment_status,
+               CASE WHEN v.id IS NULL THEN COALESCE(p.name, 'Product no longer available')
+                    ELSE p.name || ' - ' || v.variant_name END,
+               p.category, oi.quantity, oi.price, COALESCE(pl.primary_image, 'tshirt.jpg'),
+               oi.product_id, COALESCE(oi.variant_id, 0)
         FROM orders o
-        JOIN users u ON o.user_id = u.id
-        WHERE o.id = ? AND o.user_id = ?
-    ''', (order_id, session['user_id']))
-    order = cursor.fetchone()
-    
-    if not order:
-        flash('Order not found!', 'error')
-        return redirect(url_for('orders'))
-    
-    # Get order items
-    cursor.execute('''
-        SELECT p.name, oi.quantity, oi.price
-        FROM order_items oi
-        JOIN products p ON oi.product_id = p.id
-        WHERE oi.order_id = ?
+        JOIN users u ON u.id = o.user_id
+        LEFT JOIN order_items oi ON oi.order_id = o.id
+        LEFT JOIN products p ON p.id = oi.product_id
+        LEFT JOIN product_listing pl ON pl.product_id = oi.product_id
+        LEFT JOIN product_variants v ON v.id = oi.variant_id
+        WHERE o.id = ?
+        ORDER BY oi.id
     ''', (order_id,))
-    items = cursor.fetchall()
-    
-    conn.close()
+    rows = cursor.fetchall()
+    if not rows:
+        return None, []
     
-    # Generate PDF bill
+    order = tuple(rows[0][:11])
+    items = [tuple(row[11:]) for row in rows if row[16] is not None]
+    return order, items
+
+def load_user_order(cursor, order_id, user_id):
+    """load_order() for the order's owner only"""
+    order, items = load_order(cursor, order_id)
+    if order is None or order[1] != user_id:
+        return None, []
+    return order, items
+
+def invoice_response(order, items, audience):
+    """Render an order's PDF invoice as a download"""
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=letter)
     story = []
@@ -1843,7 +5072,7 @@ def download_bill(order_id):
     )
     
     # Title
-    story.append(Paragraph("TEXTILE STORE", title_style))
+    story.append(Paragraph("LUXE TEXTILE", title_style))
     story.append(Paragraph("INVOICE", styles['Heading2']))
     story.append(Spacer(1, 20))
     
@@ -1851,10 +5080,11 @@ def download_bill(order_id):
     order_info = [
         ['Invoice No:', f'#{order[0]}'],
         ['Date:', order[2]],
-        ['Customer:', order[7]],
-        ['Email:', order[8]],
+        ['Customer:', order[8]],
+        ['Email:', order[9]],
+        ['Phone:', order[7]],
         ['Payment Method:', order[4]],
-        ['Status:', order[8]]
+        ['Status:', order[5].replace('_', ' ').title() if order[5] else 'Processing']
     ]
     
     order_table = Table(order_info, colWidths=[2*inch, 3*inch])
@@ -1867,20 +5097,25 @@ def download_bill(order_id):
     story.append(order_table)
     story.append(Spacer(1, 20))
     
+    # Shipping Address
+    story.append(Paragraph("<b>Shipping Address:</b>", styles['Normal']))
+    story.append(Paragraph(order[6] or '', styles['Normal']))
+    story.append(Spacer(1, 20))
+    
     # Items table
     items_data = [['Product', 'Quantity', 'Price', 'Total']]
     total = 0
     for item in items:
-        item_total = item[1] * item[2]
+        item_total = item[2] * item[3]
         total += item_total
         items_data.append([
             item[0],
-            str(item[1]),
-            f'${item[2]:.2f}',
-            f'${item_total:.2f}'
+            str(item[2]),
+            f'₹{item[3]:.2f}',
+            f'₹{item_total:.2f}'
         ])
     
-    items_data.append(['', '', 'TOTAL:', f'${total:.2f}'])
+    items_data.append(['', '', 'TOTAL:', f'₹{total:.2f}'])
     
     items_table = Table(items_data, colWidths=[3*inch, 1*inch, 1*inch, 1*inch])
     items_table.setStyle(TableStyle([
@@ -1899,21 +5134,190 @@ def download_bill(order_id):
     # Footer
     story.append(Spacer(1, 30))
     story.append(Paragraph("Thank you for your business!", styles['Normal']))
-    story.append(Paragraph("Textile Store - Quality Textiles for Every Need", styles['Normal']))
+    story.append(Paragraph("LUXE TEXTILE - Premium Quality Textiles", styles['Normal']))
     
     doc.build(story)
     buffer.seek(0)
+    inc_counter('invoice_renders_total', {'audience': audience})
     
     response = make_response(buffer.getvalue())
     response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = f'attachment; filename=invoice_{order_id}.pdf'
+    response.headers['Content-Disposition'] = f'attachment; filename=invoice_{order[0]}.pdf'
     
     return response
 
+# ===== END ORDER READ MODEL =====
+
+# ===== ORDER STATUS =====
+#
+# Every status change goes through set_order_status (or record_order_status for a new
+# order), which appends to order_events and moves the order between the rows of
+# order_status_counts in the same transaction. Badges and the analytics status table
+# read those counters instead of grouping all orders, and order_events gives the
+# fulfillment time series.
+
+def record_order_status(cursor, order_id, from_status, to_status, amount):
+    """Log a status change and update the per-status counters; from_status None for a new order"""
+    record_order_status_changes(cursor, [(order_id, from_status, amount)], to_status)
+
+def record_order_status_changes(cursor, changes, to_status):
+    """record_order_status for many orders moving to to_status:
+    changes is [(order_id, from_status, total_amount)]"""
+    if not changes:
+        return
+    actor_id = session.get('user_id') if has_request_context() else None
+    cursor.executemany('INSERT INTO order_events (order_id, from_status, to_status, actor_id) VALUES (?, ?, ?, ?)',
+                       [(order_id, from_status, to_status, actor_id) for order_id, from_status, _ in changes])
+    
+    moved_out = {}  # from_status -> [orders, amount]
+    for _, from_status, amount in changes:
+        if from_status is not None:
+            totals = moved_out.setdefault(from_status, [0, 0.0])
+            totals[0] += 1
+            totals[1] += amount
+    if moved_out:
+        cursor.executemany('''
+            UPDATE order_status_counts
+            SET order_count = order_count - ?, total_amount = total_amount - ?
+            WHERE status = ?
+        ''', [(count, amount, status) for status, (count, amount) in moved_out.items()])
+    cursor.execute('''
+        INSERT INTO order_status_counts (status, order_count, total_amount) VALUES (?, ?, ?)
+        ON CONFLICT (status) DO UPDATE
+        SET order_count = order_status_counts.order_count + excluded.order_count,
+            total_amount = order_status_counts.total_amount + excluded.total_amount
+    ''', (to_status, len(changes), sum(amount for _, _, amount in changes)))
+
+def set_order_status(cursor, order_id, new_status, allowed_from=None, user_id=None):
+    """Move an order to new_status if its current status is in allowed_from (any when None).
+    Returns the status it had, or None when there is no such order (belonging to user_id)."""
+    while True:
+        cursor.execute('SELECT order_status, total_amount, user_id FROM orders WHERE id = ?', (order_id,))
+        row = cursor.fetchone()
+        if not row or (user_id is not None and row[2] != user_id):
+            return None
+        previous = row[0]
+        if previous == new_status or (allowed_from is not None and previous not in allowed_from):
+            return previous
+        # Only applies if nobody changed the status since the read; otherwise read it again
+        cursor.execute('UPDATE orders SET order_status = ? WHERE id = ? AND order_status = ?',
+                       (new_status, order_id, previous))
+        if cursor.rowcount == 1:
+            record_order_status(cursor, order_id, previous, new_status, row[1])
+            return previous
+
+def order_status_sources(new_status):
+    """The statuses ORDER_STATUS_TRANSITIONS allows an order to move to new_status from"""
+    return tuple(status for status, targets in ORDER_STATUS_TRANSITIONS.items() if new_status in targets)
+
+def order_status_change_error(order_id, previous, new_status):
+    """Why set_order_status left an admin's status change undone, or None if it was made"""
+    if previous is None:
+        return f'Order #{order_id} not found'
+    if previous in ORDER_FINAL_STATUSES:
+        return f'Order #{order_id} is {previous} and can no longer change'
+    if previous in ORDER_RETURN_STATUSES or new_status in ORDER_RETURN_STATUSES:
+        return f'Order #{order_id}: returns are handled from the returns queue'
+    if new_status not in ORDER_STATUS_TRANSITIONS.get(previous, ()):
+        return (f'Order #{order_id} cannot move from {previous.replace("_", " ").title()} '
+                f'to {new_status.replace("_", " ").title()}')
+    return None
+
+def move_order_statuses(cursor, order_ids, from_status, to_status):
+    """Move the given orders that are still in from_status to to_status and record it,
+    500 ids per UPDATE. Returns the ids moved."""
+    moved = []
+    for i in range(0, len(order_ids), 500):
+        chunk = order_ids[i:i + 500]
+        cursor.execute(f'''
+            UPDATE orders SET order_status = ?
+            WHERE order_status = ? AND id IN ({",".join("?" * len(chunk))})
+            RETURNING id, total_amount
+        ''', [to_status, from_status] + list(chunk))
+        changes = [(row[0], from_status, row[1]) for row in cursor.fetchall()]
+        record_order_status_changes(cursor, changes, to_status)
+        moved.extend(order_id for order_id, _, _ in changes)
+    return moved
+
+def get_order_status_counts(cursor):
+    """{status: (orders, total_amount)} from the counters"""
+    cursor.execute('SELECT status, order_count, total_amount FROM order_status_counts WHERE order_count > 0')
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+def rebuild_order_status_counts(cursor):
+    """Recompute the counters from the orders table"""
+    cursor.execute('DELETE FROM order_status_counts')
+    cursor.execute('''
+        INSERT INTO order_status_counts (status, order_count, total_amount)
+        SELECT COALESCE(order_status, 'processing'), COUNT(*), COALESCE(SUM(total_amount), 0)
+        FROM orders
+        GROUP BY COALESCE(order_status, 'processing')
+    ''')
+
+@app.cli.command('rebuild-order-counts')
+def rebuild_order_counts_command():
+    """Recompute the per-status order counters from the orders table"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    rebuild_order_status_counts(cursor)
+    conn.commit()
+    counts = get_order_status_counts(cursor)
+    conn.close()
+    for status, (count, amount) in sorted(counts.items()):
+        click.echo(f'{status}: {count} orders, {amount:.2f}')
+
+# ===== END ORDER STATUS =====
+
+@app.route('/order_confirmation/<int:order_id>')
+@login_required
+def order_confirmation(order_id):
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    order, items = load_user_order(cursor, order_id, session['user_id'])
+    conn.close()
+    
+    if not order:
+        flash('Order not found!', 'error')
+        return redirect(url_for('index'))
+    
+    return render_template('order_confirmation.html', order=order, items=items, order_id=order_id)
+
+@app.route('/orders')
+@login_required
+def orders():
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, order_date, total_amount, payment_method, order_status
+        FROM orders WHERE user_id = ? ORDER BY order_date DESC
+    ''', (session['user_id'],))
+    user_orders = cursor.fetchall()
+    conn.close()
+    
+    return render_template('orders.html', orders=user_orders)
+
+@app.route('/download_bill/<int:order_id>')
+@login_required
+def download_bill(order_id):
+    if not REPORTLAB_AVAILABLE:
+        flash('PDF generation is not available. Please install ReportLab.', 'error')
+        return redirect(url_for('orders'))
+    
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    order, items = load_user_order(cursor, order_id, session['user_id'])
+    conn.close()
+    
+    if not order:
+        flash('Order not found!', 'error')
+        return redirect(url_for('orders'))
+    
+    return invoice_response(order, items, 'customer')
+
 @app.route('/admin/orders')
 @admin_required
 def admin_orders():
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
     cursor.execute('''
         SELECT o.id, o.order_date, o.total_amount, o.payment_method, o.order_status, 
@@ -1923,9 +5327,77 @@ def admin_orders():
         ORDER BY o.order_date DESC
     ''')
     all_orders = cursor.fetchall()
+    order_counts = {status: count for status, (count, amount) in get_order_status_counts(cursor).items()}
     conn.close()
     
-    return render_template('admin_orders.html', orders=all_orders)
+    return render_template('admin_orders.html', orders=all_orders, order_counts=order_counts)
+
+@app.route('/admin/orders/export')
+@admin_required
+def export_orders():
+    """Stream orders as CSV or NDJSON for accounting/BI.
+
+    Query args: format=csv|ndjson, status, from=YYYY-MM-DD, to=YYYY-MM-DD (inclusive).
+    Rows are read from the cursor in chunks and written out as they arrive, so
+    memory stays constant however many orders match.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+
+    query = '''
+        SELECT o.id, o.order_date, u.name, u.email, o.total_amount, o.payment_method,
+               o.payment_status, o.order_status, o.shipping_address, o.phone_number
+        FROM orders o
+        JOIN users u ON o.user_id = u.id
+        WHERE 1=1
+    '''
+    params = []
+
+    status = request.args.get('status', '')
+    if status:
+        query += ' AND o.order_status = ?'
+        params.append(status)
+
+    try:
+        if request.args.get('from'):
+            start_date = datetime.strptime(request.args['from'], '%Y-%m-%d')
+            query += ' AND o.order_date >= ?'
+            params.append(start_date.strftime('%Y-%m-%d'))
+        if request.args.get('to'):
+            end_date = datetime.strptime(request.args['to'], '%Y-%m-%d') + timedelta(days=1)
+            query += ' AND o.order_date < ?'
+            params.append(end_date.strftime('%Y-%m-%d'))
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+
+    query += ' ORDER BY o.id'
+
+    def generate():
+        conn = get_db_connection(readonly=True)
+        try:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            if export_format == 'csv':
+                writer.writerow(ORDER_EXPORT_COLUMNS)
+            for count, row in enumerate(iter_query(conn, query, params, EXPORT_CHUNK_SIZE), 1):
+                if export_format == 'csv':
+                    writer.writerow(row)
+                else:
+                    buffer.write(json.dumps(dict(zip(ORDER_EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n')
+                if count % EXPORT_CHUNK_SIZE == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        finally:
+            conn.close()
+
+    filename = f"orders_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    content_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(generate()), content_type=content_type)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
 
 @app.route('/admin/update_order_status', methods=['POST'])
 @admin_required
@@ -1938,15 +5410,18 @@ def update_order_status():
             flash('Order ID and status are required', 'error')
             return redirect(url_for('admin_orders'))
         
-        conn = sqlite3.connect('database.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE orders SET order_status = ? WHERE id = ?
-        ''', (new_status, order_id))
+        previous = set_order_status(cursor, int(order_id), new_status,
+                                    allowed_from=order_status_sources(new_status))
         conn.commit()
         conn.close()
         
-        flash(f'Order #{order_id} status updated to {new_status.replace("_", " ").title()}', 'success')
+        error = order_status_change_error(order_id, previous, new_status)
+        if error:
+            flash(error, 'error')
+        else:
+            flash(f'Order #{order_id} status updated to {new_status.replace("_", " ").title()}', 'success')
         return redirect(url_for('admin_orders'))
     except Exception as e:
         flash(f'Error updating order status: {str(e)}', 'error')
@@ -1963,80 +5438,166 @@ def admin_update_order_status():
             flash('Order ID and status are required', 'error')
             return redirect(url_for('admin_orders'))
         
-        conn = sqlite3.connect('database.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE orders SET order_status = ? WHERE id = ?
-        ''', (new_status, order_id))
+        previous = set_order_status(cursor, int(order_id), new_status,
+                                    allowed_from=order_status_sources(new_status))
         conn.commit()
         conn.close()
         
-        flash(f'Order #{order_id} status updated to {new_status.replace("_", " ").title()}!', 'success')
+        error = order_status_change_error(order_id, previous, new_status)
+        if error:
+            flash(error, 'error')
+        else:
+            flash(f'Order #{order_id} status updated to {new_status.replace("_", " ").title()}!', 'success')
         return redirect(url_for('admin_order_details', order_id=order_id))
     except Exception as e:
         flash(f'Error updating order status: {str(e)}', 'error')
         return redirect(url_for('admin_orders'))
 
+@app.route('/admin/orders/bulk_status', methods=['POST'])
+@admin_required
+def bulk_update_order_status():
+    """Move many orders to one status in a single transaction.
+
+    Takes status plus either order_ids (a JSON list or repeated form fields) or filters:
+    from_status (required), from=YYYY-MM-DD, to=YYYY-MM-DD (inclusive). Orders that cannot
+    move to the new status (see ORDER_STATUS_TRANSITIONS) are left as they are and reported.
+    """
+    data = request.get_json(silent=True) if request.is_json else request.form
+    data = data or {}
+    new_status = data.get('status')
+    if new_status not in ORDER_STATUSES:
+        return bulk_status_error('Unknown status')
+    
+    try:
+        if request.is_json:
+            order_ids = [int(order_id) for order_id in data.get('order_ids') or []]
+        else:
+            order_ids = [int(order_id) for order_id in request.form.getlist('order_ids')]
+    except (TypeError, ValueError):
+        return bulk_status_error('order_ids must be order numbers')
+    
+    if order_ids:
+        order_ids = sorted(set(order_ids))
+        if len(order_ids) > BULK_ORDER_STATUS_MAX:
+            return bulk_status_error(f'At most {BULK_ORDER_STATUS_MAX} orders can be updated at once')
+        selections = [(f'id IN ({",".join("?" * len(chunk))})', chunk)
+                      for chunk in (order_ids[i:i + 500] for i in range(0, len(order_ids), 500))]
+    else:
+        from_status = data.get('from_status')
+        if from_status not in ORDER_STATUSES:
+            return bulk_status_error('Select orders or give from_status')
+        where, params = 'order_status = ?', [from_status]
+        try:
+            if data.get('from'):
+                where += ' AND order_date >= ?'
+                params.append(datetime.strptime(data['from'], '%Y-%m-%d').strftime('%Y-%m-%d'))
+            if data.get('to'):
+                where += ' AND order_date < ?'
+                params.append((datetime.strptime(data['to'], '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+        except ValueError:
+            return bulk_status_error('Dates must be in YYYY-MM-DD format')
+        selections = [(where, params)]
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    orders = []
+    for where, params in selections:
+        cursor.execute(f'SELECT id, order_status, total_amount FROM orders WHERE {where} LIMIT ?',
+                       list(params) + [BULK_ORDER_STATUS_MAX + 1])
+        orders.extend(cursor.fetchall())
+    if len(orders) > BULK_ORDER_STATUS_MAX:
+        conn.close()
+        return bulk_status_error(f'More than {BULK_ORDER_STATUS_MAX} orders match; narrow the filter')
+    
+    summary = {'status': new_status, 'updated': 0, 'unchanged': [], 'rejected': [], 'conflicts': [],
+               'not_found': sorted(set(order_ids) - {order[0] for order in orders})}
+    by_status = {}
+    for order_id, status, amount in orders:
+        if status == new_status:
+            summary['unchanged'].append(order_id)
+        elif new_status in ORDER_STATUS_TRANSITIONS.get(status, ()):
+            by_status.setdefault(status, []).append(order_id)
+        else:
+            summary['rejected'].append({'id': order_id, 'status': status})
+    
+    # The status guard in move_order_statuses skips orders changed since the SELECT
+    for status, ids in by_status.items():
+        moved = move_order_statuses(cursor, sorted(ids), status, new_status)
+        summary['updated'] += len(moved)
+        summary['conflicts'].extend(sorted(set(ids) - set(moved)))
+    conn.commit()
+    conn.close()
+    
+    if request.is_json:
+        return jsonify(summary)
+    skipped = len(summary['rejected']) + len(summary['conflicts']) + len(summary['not_found'])
+    flash(f'{summary["updated"]} orders moved to {new_status.replace("_", " ").title()}'
+          + (f', {skipped} skipped' if skipped else ''),
+          'success' if summary['updated'] else 'warning')
+    return redirect(url_for('admin_orders'))
+
+def bulk_status_error(message):
+    if request.is_json:
+        return jsonify({'error': message}), 400
+    flash(message, 'error')
+    return redirect(url_for('admin_orders'))
+
 @app.route('/customer_order_details/<int:order_id>')
 @login_required
 def customer_order_details(order_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
-    
-    # Get order details for the logged-in user only
-    cursor.execute('''
-        SELECT o.id, o.user_id, o.order_date, o.total_amount, o.payment_method, 
-               o.order_status, o.shipping_address, o.phone_number
-        FROM orders o
-        WHERE o.id = ? AND o.user_id = ?
-    ''', (order_id, session['user_id']))
-    order = cursor.fetchone()
+    order, items = load_user_order(cursor, order_id, session['user_id'])
+    conn.close()
     
     if not order:
         flash('Order not found!', 'error')
         return redirect(url_for('orders'))
     
-    # Get order items
-    cursor.execute('''
-        SELECT p.name, p.category, oi.quantity, oi.price, p.images
-        FROM order_items oi
-        JOIN products p ON oi.product_id = p.id
-        WHERE oi.order_id = ?
-    ''', (order_id,))
-    items = cursor.fetchall()
-    
-    conn.close()
-    
     return render_template('customer_order_details.html', order=order, items=items)
 
 @app.route('/cancel_order/<int:order_id>', methods=['POST'])
 @login_required
 def cancel_order(order_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Check if order belongs to the user and is cancellable
-    cursor.execute('''
-        SELECT order_status FROM orders 
-        WHERE id = ? AND user_id = ?
-    ''', (order_id, session['user_id']))
-    order = cursor.fetchone()
+    # Only the owner can cancel, and only before the order ships
+    previous = set_order_status(cursor, order_id, 'cancelled', allowed_from=('processing', 'confirmed'),
+                                user_id=session['user_id'])
+    conn.commit()
+    conn.close()
     
-    if not order:
+    if previous is None:
         return jsonify({'success': False, 'message': 'Order not found'})
     
-    if order[0] not in ['processing', 'confirmed']:
+    if previous not in ['processing', 'confirmed']:
         return jsonify({'success': False, 'message': 'This order cannot be cancelled'})
     
-    # Update order status to cancelled
-    cursor.execute('''
-        UPDATE orders SET order_status = 'cancelled' WHERE id = ?
-    ''', (order_id,))
-    conn.commit()
-    conn.close()
-    
     return jsonify({'success': True})
 
+# ===== RETURNS =====
+#
+# A customer asks to return a delivered order with return_order: the order moves to
+# return_requested and a pending row is added to returns. Admins work through the queue
+# at /admin/returns; each action moves the return and its order together:
+#   approve  pending -> approved, order -> returned, items go back into stock
+#   reject   pending -> rejected, order -> delivered
+#   refund   approved -> refunded, order -> refunded, payment_status -> refunded
+# Bulk actions commit every RETURNS_BATCH_SIZE returns, so a large batch never holds
+# the write lock for long.
+
+RETURN_ACTIONS = {
+    # action: (return status before, after, order status before, after)
+    'approve': ('pending', 'approved', 'return_requested', 'returned'),
+    'reject': ('pending', 'rejected', 'return_requested', 'delivered'),
+    'refund': ('approved', 'refunded', 'returned', 'refunded'),
+}
+RETURN_STATUSES = ('pending', 'approved', 'rejected', 'refunded')
+
 @app.route('/return_order/<int:order_id>', methods=['POST'])
 @login_required
 def return_order(order_id):
@@ -2046,52 +5607,160 @@ def return_order(order_id):
     if not reason:
         return jsonify({'success': False, 'message': 'Return reason is required'})
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Check if order belongs to the user and is delivered
-    cursor.execute('''
-        SELECT order_status FROM orders 
-        WHERE id = ? AND user_id = ?
-    ''', (order_id, session['user_id']))
-    order = cursor.fetchone()
-    
-    if not order:
+    # Only the owner can return an order, and only once it is delivered
+    previous = set_order_status(cursor, order_id, 'return_requested', allowed_from=('delivered',),
+                                user_id=session['user_id'])
+    if previous is None:
+        conn.close()
         return jsonify({'success': False, 'message': 'Order not found'})
     
-    if order[0] != 'delivered':
+    if previous != 'delivered':
+        conn.close()
         return jsonify({'success': False, 'message': 'Only delivered orders can be returned'})
     
-    # Create returns table if it doesn't exist
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS returns (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            order_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            reason TEXT NOT NULL,
-            status TEXT DEFAULT 'pending',
-            request_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (order_id) REFERENCES orders (id),
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Insert return request
     cursor.execute('''
         INSERT INTO returns (order_id, user_id, reason)
         VALUES (?, ?, ?)
     ''', (order_id, session['user_id'], reason))
     
-    # Update order status to indicate return requested
-    cursor.execute('''
-        UPDATE orders SET order_status = 'return_requested' WHERE id = ?
-    ''', (order_id,))
-    
     conn.commit()
     conn.close()
     
     return jsonify({'success': True})
 
+def restock_returned_orders(cursor, order_ids):
+    """Put the items of the given orders back into stock"""
+    placeholders = ','.join('?' * len(order_ids))
+    cursor.execute(f'''
+        SELECT product_id, COALESCE(variant_id, 0), SUM(quantity)
+        FROM order_items
+        WHERE order_id IN ({placeholders})
+        GROUP BY product_id, COALESCE(variant_id, 0)
+    ''', order_ids)
+    lines = cursor.fetchall()
+    if not lines:
+        return
+    
+    cursor.executemany('UPDATE product_variants SET stock = stock + ? WHERE id = ? AND product_id = ?',
+                       [(quantity, variant_id, product_id) for product_id, variant_id, quantity in lines if variant_id])
+    cursor.executemany('UPDATE products SET stock = stock + ? WHERE id = ?',
+                       [(quantity, product_id) for product_id, variant_id, quantity in lines if not variant_id])
+    invalidate_product_caches(cursor, {product_id for product_id, _, _ in lines})
+
+def apply_return_action(action, return_ids):
+    """Approve, reject or refund returns, RETURNS_BATCH_SIZE per transaction.
+    Returns {'action', 'processed', 'skipped'}; skipped returns were not waiting for this action."""
+    return_from, return_to, order_from, order_to = RETURN_ACTIONS[action]
+    summary = {'action': action, 'processed': 0, 'skipped': []}
+    
+    for i in range(0, len(return_ids), RETURNS_BATCH_SIZE):
+        batch = return_ids[i:i + RETURNS_BATCH_SIZE]
+        conn = get_db_connection()
+        cursor = conn.cursor()
+    
+        # Claim the returns still waiting for this action whose order is where the return left it
+        cursor.execute(f'''
+            UPDATE returns SET status = ?, resolved_at = CURRENT_TIMESTAMP
+            WHERE status = ? AND id IN ({','.join('?' * len(batch))})
+              AND order_id IN (SELECT id FROM orders WHERE order_status = ?)
+            RETURNING id, order_id
+        ''', [return_to, return_from] + batch + [order_from])
+        claimed = cursor.fetchall()
+        order_ids = sorted({order_id for _, order_id in claimed})
+    
+        if order_ids:
+            move_order_statuses(cursor, order_ids, order_from, order_to)
+            placeholders = ','.join('?' * len(order_ids))
+            if action == 'approve':
+                restock_returned_orders(cursor, order_ids)
+            elif action == 'refund':
+                cursor.execute(f"UPDATE orders SET payment_status = 'refunded' WHERE id IN ({placeholders})", order_ids)
+                cursor.execute(f'''
+                    UPDATE returns SET refund_amount = (SELECT total_amount FROM orders WHERE orders.id = returns.order_id)
+                    WHERE id IN ({','.join('?' * len(claimed))})
+                ''', [return_id for return_id, _ in claimed])
+    
+        conn.commit()
+        conn.close()
+        summary['processed'] += len(claimed)
+        summary['skipped'].extend(sorted(set(batch) - {return_id for return_id, _ in claimed}))
+    
+    return summary
+
+@app.route('/admin/returns')
+@admin_required
+def admin_returns():
+    """Returns queue, newest first; ?status= picks the tab and ?before=<id> pages back"""
+    status = request.args.get('status', 'pending')
+    if status not in RETURN_STATUSES:
+        status = 'pending'
+    before = request.args.get('before', type=int)
+    
+    conn = get_db_connection(readonly=True)
+    cursor = conn.cursor()
+    
+    # Keyset pagination over the (status, id) index
+    query = '''
+        SELECT r.id, r.order_id, u.name, u.email, r.reason, r.status, r.request_date,
+               o.total_amount, r.resolved_at, r.refund_amount
+        FROM returns r
+        JOIN users u ON u.id = r.user_id
+        JOIN orders o ON o.id = r.order_id
+        WHERE r.status = ?
+    '''
+    params = [status]
+    if before:
+        query += ' AND r.id < ?'
+        params.append(before)
+    query += ' ORDER BY r.id DESC LIMIT ?'
+    params.append(RETURNS_PAGE_SIZE + 1)
+    cursor.execute(query, params)
+    returns = cursor.fetchall()
+    
+    cursor.execute('SELECT status, COUNT(*) FROM returns GROUP BY status')
+    return_counts = dict(cursor.fetchall())
+    conn.close()
+    
+    next_before = returns[RETURNS_PAGE_SIZE - 1][0] if len(returns) > RETURNS_PAGE_SIZE else None
+    return render_template('admin_returns.html', returns=returns[:RETURNS_PAGE_SIZE], status=status,
+                           return_counts=return_counts, next_before=next_before,
+                           statuses=RETURN_STATUSES)
+
+@app.route('/admin/returns/bulk', methods=['POST'])
+@admin_required
+def bulk_return_action():
+    """Approve, reject or refund returns: action plus return_ids (JSON list or repeated form fields)"""
+    data = (request.get_json(silent=True) if request.is_json else request.form) or {}
+    action = data.get('action')
+    try:
+        if request.is_json:
+            return_ids = sorted({int(return_id) for return_id in data.get('return_ids') or []})
+        else:
+            return_ids = sorted({int(return_id) for return_id in request.form.getlist('return_ids')})
+    except (TypeError, ValueError):
+        return_ids = None
+    
+    if action not in RETURN_ACTIONS or not return_ids:
+        message = 'Choose an action and at least one return'
+        if request.is_json:
+            return jsonify({'error': message}), 400
+        flash(message, 'error')
+        return redirect(request.referrer or url_for('admin_returns'))
+    
+    summary = apply_return_action(action, return_ids)
+    if request.is_json:
+        return jsonify(summary)
+    
+    flash(f'{summary["processed"]} returns {RETURN_ACTIONS[action][1]}'
+          + (f', {len(summary["skipped"])} skipped' if summary['skipped'] else ''),
+          'success' if summary['processed'] else 'warning')
+    return redirect(request.referrer or url_for('admin_returns'))
+
+# ===== END RETURNS =====
+
 @app.route('/admin/download_bill/<int:order_id>')
 @admin_required
 def admin_download_bill(order_id):
@@ -2099,171 +5768,42 @@ def admin_download_bill(order_id):
         flash('PDF generation is not available. Please install ReportLab.', 'error')
         return redirect(url_for('admin_orders'))
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
-    
-    # Get order details (no user_id check for admins)
-    # Order: id, user_id, order_date, total_amount, payment_method, order_status, shipping_address, phone_number, customer_name, email
-    cursor.execute('''
-        SELECT o.id, o.user_id, o.order_date, o.total_amount, o.payment_method, 
-               o.order_status, o.shipping_address, o.phone_number,
-               u.name as customer_name, u.email
-        FROM orders o
-        JOIN users u ON o.user_id = u.id
-        WHERE o.id = ?
-    ''', (order_id,))
-    order = cursor.fetchone()
+    order, items = load_order(cursor, order_id)
+    conn.close()
     
     if not order:
         flash('Order not found!', 'error')
         return redirect(url_for('admin_orders'))
     
-    # Get order items
-    cursor.execute('''
-        SELECT p.name, oi.quantity, oi.price
-        FROM order_items oi
-        JOIN products p ON oi.product_id = p.id
-        WHERE oi.order_id = ?
-    ''', (order_id,))
-    items = cursor.fetchall()
-    
-    conn.close()
-    
-    # Generate PDF bill
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
-    story = []
-    
-    # Styles
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=24,
-        spaceAfter=30,
-        alignment=1
-    )
-    
-    # Title
-    story.append(Paragraph("LUXE TEXTILE", title_style))
-    story.append(Paragraph("INVOICE", styles['Heading2']))
-    story.append(Spacer(1, 20))
-    
-    # Order info - indices: 0=id, 2=order_date, 8=customer_name, 9=email, 4=payment_method, 5=order_status
-    order_info = [
-        ['Invoice No:', f'#{order[0]}'],
-        ['Date:', order[2]],
-        ['Customer:', order[8]],
-        ['Email:', order[9]],
-        ['Phone:', order[7]],
-        ['Payment Method:', order[4]],
-        ['Status:', order[5].replace('_', ' ').title() if order[5] else 'Processing']
-    ]
-    
-    order_table = Table(order_info, colWidths=[2*inch, 3*inch])
-    order_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-    ]))
-    story.append(order_table)
-    story.append(Spacer(1, 20))
-    
-    # Shipping Address
-    story.append(Paragraph("<b>Shipping Address:</b>", styles['Normal']))
-    story.append(Paragraph(order[6], styles['Normal']))
-    story.append(Spacer(1, 20))
-    
-    # Items table
-    items_data = [['Product', 'Quantity', 'Price', 'Total']]
-    total = 0
-    for item in items:
-        item_total = item[1] * item[2]
-        total += item_total
-        items_data.append([
-            item[0],
-            str(item[1]),
-            f'₹{item[2]:.2f}',
-            f'₹{item_total:.2f}'
-        ])
-    
-    items_data.append(['', '', 'TOTAL:', f'₹{total:.2f}'])
-    
-    items_table = Table(items_data, colWidths=[3*inch, 1*inch, 1*inch, 1*inch])
-    items_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-    ]))
-    story.append(items_table)
-    
-    # Footer
-    story.append(Spacer(1, 30))
-    story.append(Paragraph("Thank you for your business!", styles['Normal']))
-    story.append(Paragraph("LUXE TEXTILE - Premium Quality Textiles", styles['Normal']))
-    
-    doc.build(story)
-    buffer.seek(0)
-    
-    response = make_response(buffer.getvalue())
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = f'attachment; filename=invoice_{order_id}.pdf'
-    
-    return response
+    return invoice_response(order, items, 'admin')
 
 @app.route('/admin/order_details/<int:order_id>')
 @admin_required
 def admin_order_details(order_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
-    
-    # Get order details - specify exact columns in expected order
-    # Expected order: id, user_id, order_date, total_amount, payment_method, order_status, shipping_address, phone_number, customer_name, email
-    cursor.execute('''
-        SELECT o.id, o.user_id, o.order_date, o.total_amount, o.payment_method, 
-               o.order_status, o.shipping_address, o.phone_number,
-               u.name as customer_name, u.email
-        FROM orders o
-        JOIN users u ON o.user_id = u.id
-        WHERE o.id = ?
-    ''', (order_id,))
-    order = cursor.fetchone()
+    order, items = load_order(cursor, order_id)
+    conn.close()
     
     if not order:
         flash('Order not found!', 'error')
         return redirect(url_for('admin_orders'))
     
-    # Get order items
-    cursor.execute('''
-        SELECT p.name, p.category, oi.quantity, oi.price, p.images
-        FROM order_items oi
-        JOIN products p ON oi.product_id = p.id
-        WHERE oi.order_id = ?
-    ''', (order_id,))
-    items = cursor.fetchall()
-    
-    conn.close()
-    
     return render_template('admin_order_details.html', order=order, items=items)
 
 # Initialize database when app starts (important for Render deployment)
 init_db()
 
 # Add admin user if not exists
-conn = sqlite3.connect('database.db')
+conn = get_db_connection()
 cursor = conn.cursor()
 
 # Add admin user if not exists
 cursor.execute('SELECT COUNT(*) FROM users WHERE email = ?', ('admin@textile.com',))
 if cursor.fetchone()[0] == 0:
-    admin_password = generate_password_hash('admin123')
+    admin_password = generate_password_hash('admin123', PASSWORD_HASH_METHOD)
     cursor.execute('''
         INSERT INTO users (name, email, password, is_admin)
         VALUES (?, ?, ?, ?)